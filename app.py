@@ -5,87 +5,294 @@ Date: September 30, 2024
 Initial web app using dash
 """
 # Initial import
+import collections
+import hashlib
 import json
+import logging
+import math
 import os
+import re
 import sys
+import threading
+import time
+from datetime import datetime, timezone
 from pathlib import Path
 
 # Dash imports
 import dash
 import dash_bootstrap_components as dbc
 import dash_leaflet as dl
-import pandas as pd
+import flask
 import pymongo
+from pymongo.errors import PyMongoError
 from dash import dcc, html, callback_context
 from dash.dash_table import DataTable
 from dash.dependencies import Input, Output, State
 
 # visualizaton imports
+import plotly
 import plotly.graph_objs as go 
 
 
 # other scripts import
+import bulk_import
+import challenges
+import hill_map
+import http_caching
+import image_derivatives
+import leaderboard_snapshot
+import leaderboard_watcher
+import link_verifier
+import metrics
 import robo_adam
+import submission_queue
+
+logger = logging.getLogger(__name__)
+
+# Number of past leaderboard versions kept for sending partial updates
+PORTAL_HISTORY_SIZE = 8
+
+# After a submission the leaderboards are polled until the write-behind queue inserted it
+LEADERBOARD_POLL_MS = 1000
+LEADERBOARD_POLL_COUNT = 10
+
+# Reads made for a request give up after this long and fall back to the leaderboard snapshot
+REQUEST_QUERY_TIMEOUT = float(os.getenv("REQUEST_QUERY_TIMEOUT_SECONDS", "3"))
+
+# After the database failed, requests are served from the snapshot this long before trying it again
+DATABASE_RETRY_SECONDS = 15
+
+# Browsers check for new leaderboards this often, answered with a 204 until they change
+LEADERBOARD_LIVE_POLL_MS = 5000
+
+# Idempotency keys the browser may send with a submission, e.g. a UUID
+SUBMISSION_KEY_PATTERN = re.compile(r"^[A-Za-z0-9-]{8,64}$")
+
+# Pixels within which the hill map clusters hills
+HILL_MAP_CLUSTER_RADIUS = 60
+
+# Choices of the windowed leaderboard
+WINDOW_OPTIONS = [
+    {'label': "Today", 'value': "today"},
+    {'label': "This Week", 'value': "week"},
+    {'label': "Whole Challenge", 'value': "challenge"},
+]
+
+
+def join_names(names):
+    """Names the way a sentence lists them, e.g. A, B, and C"""
+    if len(names) > 1:
+        return f"{', '.join(names[:-1])}, and {names[-1]}"
+    return "".join(names)
+
+
+def patch_rows(old_rows, new_rows):
+    """Returns a Patch turning old_rows into new_rows, or the full rows when old_rows is unknown"""
+    if old_rows is None:
+        return new_rows
+    if old_rows == new_rows:
+        return dash.no_update
+
+    changed = [index for index, row in enumerate(new_rows[:len(old_rows)]) if row != old_rows[index]]
+    # A row inserted near the top shifts everything below it, the full rows are smaller then
+    if len(changed) * 2 > len(new_rows):
+        return new_rows
+
+    patch = dash.Patch()
+    for index in changed:
+        patch[index] = new_rows[index]
+    if len(new_rows) > len(old_rows):
+        patch.extend(new_rows[len(old_rows):])
+    # Delete from the end so earlier indexes stay valid
+    for index in range(len(old_rows) - 1, len(new_rows) - 1, -1):
+        del patch[index]
+    return patch
+
+
+# DataTable filter operators -> RoboAdam filter operators
+FILTER_OPERATORS = {
+    '=': '$eq', 'eq': '$eq',
+    '!=': '$ne', 'ne': '$ne',
+    '<': '$lt', 'lt': '$lt',
+    '<=': '$lte', 'le': '$lte',
+    '>': '$gt', 'gt': '$gt',
+    '>=': '$gte', 'ge': '$gte',
+    'contains': 'contains',
+}
+FILTER_PART = re.compile(r"^\{(?P<column>[^}]+)\}\s+[si]?(?P<operator>\S+)\s+(?P<value>.+)$")
+
+
+def parse_filter_query(filter_query):
+    """Turns a DataTable filter_query into RoboAdam filters, skipping parts it can't express
+
+    Values compared with anything but "contains" are numbers when they parse as one.
+    """
+    filters = []
+    for part in (filter_query or "").split(" && "):
+        match = FILTER_PART.match(part.strip())
+        if match is None or match["operator"] not in FILTER_OPERATORS:
+            continue
+        operator = FILTER_OPERATORS[match["operator"]]
+        value = match["value"].strip()
+        if len(value) > 1 and value[0] == value[-1] and value[0] in "'\"`":
+            value = value[1:-1].replace("\\" + value[0], value[0])
+        elif operator != 'contains':
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+        filters.append((match["column"], operator, value))
+    return tuple(filters)
 
 
 class Application:
-
-    def __init__(self):
-        # initial dash app
-        self.hill_data_loader = self.load_json()
-        self.db = robo_adam.RoboAdam()
-
-        # Load data once during app initialization
-        self.location_data = self.db.get_unique_location_counts().to_dict('records')
-        self.reps_data = self.db.get_top_reps_per_location().to_dict('records')
-        self.total_vertical_data = self.db.get_total_vertical_per_person().to_dict('records')
-        top_10_df = self.db.get_total_vertical_per_person().nlargest(10, 'Total Vertical Feet')
-        self.locations_covered = self.db.get_locations_covered()
-
-        self.bar_vert_graph = dcc.Graph(
-            id='total-vertical-bar-graph',
-            figure={
-                'data': [
-                    go.Bar(
-                        x=top_10_df['Name'],
-                        y=top_10_df['Total Vertical Feet'],
-                        marker=dict(color=self.get_colors())  # Soft salmon color for the bars
-                    )
-                ],
-                'layout': go.Layout(
-                    title="Top 10 Vert (Feet)",
-                    xaxis=dict(title="",tickangle=-45, automargin=True),
-                    yaxis=dict(title="Total Vert (Feet)", title_standoff=10),
-                    plot_bgcolor='rgba(0,0,0,0)',  # Transparent background
-                    paper_bgcolor='rgba(0,0,0,0)',
-                    margin=dict(l=60, r=20, t=40, b=120),  # Increase bottom margin for x-axis labels
-                )
-            },
-            style={'width': '100%', 'padding': '10px'}
-        )
-        self._app = dash.Dash(__name__, external_stylesheets=[
+    """A challenge's Dash app, served with the other challenges' by a Site"""
+
+    def __init__(self, challenge=None, db=None, journal_directory=None, snapshot_directory=None):
+        # initial dash app, the challenge and database can be passed in, e.g. by the benchmarks
+        self.challenge = challenge if challenge is not None else challenges.get_challenge()
+        self.catalog = self.challenge.catalog
+        self.db = db if db is not None else robo_adam.RoboAdam(challenge=self.challenge)
+        self.submission_deadline = self.challenge.deadline
+        if journal_directory is None:
+            # The default challenge keeps the journals written before there were several challenges
+            journal_directory = submission_queue.JOURNAL_DIRECTORY
+            if not self.challenge.default:
+                journal_directory = journal_directory / self.challenge.challenge_id
+        # Links are checked in the background once their submission is in the database
+        self.link_verifier = link_verifier.get_verifier()
+        self.submission_queue = submission_queue.SubmissionQueue(
+            self.db, journal_directory, on_written=lambda submissions: self.link_verifier.verify_submissions(self.db, submissions))
+        if snapshot_directory is None:
+            snapshot_directory = leaderboard_snapshot.challenge_directory(self.challenge)
+        self.snapshot_directory = snapshot_directory
+        self.snapshot_writer = leaderboard_snapshot.SnapshotWriter(self.db, snapshot_directory)
+
+        # The default challenge is served at / and the others under their ID, on the Site's server
+        self._app = dash.Dash(__name__, server=False, title=self.challenge.name,
+                                    url_base_pathname="/" if self.challenge.default else f"/{self.challenge.challenge_id}/",
+                                    external_stylesheets=[
                                         dbc.themes.BOOTSTRAP,
                                         "https://fonts.googleapis.com/css2?family=Roboto:wght@300;400;700&family=Merriweather:wght@300;400;700&family=Montserrat:wght@300;500;700&display=swap"
                                     ])
-
-        # Create Layout
-        self.create_layout()
+        self.layout_path = self._app.config.routes_pathname_prefix + http_caching.LAYOUT_ROUTE
+
+        # Start from the latest snapshot file or empty leaderboards, the database is only queried once serving
+        self.portal_history = collections.OrderedDict()  # portal version -> leaderboard records
+        self.portal_lock = threading.Lock()
+        self.portal_snapshot = None
+        self.portal_stale = False  # True while the database fails and older leaderboards are shown
+        self.database_retry_at = 0  # time.monotonic() until which requests don't try the database
+        saved = leaderboard_snapshot.latest_snapshot(snapshot_directory)
+        if saved is not None:
+            self.load_portal_data(saved['portal'], saved['created_at'])
+        else:
+            self.load_portal_data(self.db.empty_portal_snapshot())
+
+        # Reloads the leaderboards once per database write, for every browser viewing them
+        self.leaderboard_watcher = leaderboard_watcher.LeaderboardWatcher(self.db, self.load_portal_data)
+
+        # Build the static sections once, the leaderboards are filled in per page load
+        self.rules_section = self.paragraph_rules()
+        self.hill_table = self.generate_hill_table()
+        self.hill_map = self.create_map()
+        self.submission_form = self.layout_submission_form()
+        self.progress_section = self.layout_progress_section()
+        self.static_layout_hash = hashlib.sha1(json.dumps(
+            [self.rules_section, self.hill_table, self.hill_map, self.submission_form, self.progress_section],
+            cls=plotly.utils.PlotlyJSONEncoder
+        ).encode()).hexdigest()[:16]
+        self._app.layout = self.serve_layout
+
+        # Form Submission Response and Leaderboard Refresh
+        self.submission_callback()
+        self.submission_key_callback()
+
+        # A participant's own progress
+        self.progress_callback()
+        self.leaderboard_refresh_callback()
+
+        # Hills on the map for the part of it in view, and the dropdown by distance
+        self.hill_map_viewport_callback()
+        self.nearest_hills_callback()
+
+        # Today, this week and whole challenge leaderboard from the daily rollups
+        self.window_leaderboard_callback()
+
+        # Leaderboard tables page, sort and filter in the database
+        self.leaderboard_page_callback('location-table-portal', 'location_counts')
+        self.leaderboard_page_callback('top-reps-table', 'top_reps')
+        self.leaderboard_page_callback('total-vertical-table', 'total_vertical')
+
+        # Background threads start in the process serving requests, see start_background_work
+        self.background_pid = None
+        self.background_lock = threading.Lock()
+
+    def start_background_work(self):
+        """Starts the submission writer and warms the database, once per process
+
+        gunicorn.conf.py calls this right after a worker forks, otherwise it runs on the
+        first request. Threads started before a fork (gunicorn --preload) don't exist in the worker.
+        """
+        if self.background_pid == os.getpid():
+            return
+        with self.background_lock:
+            if self.background_pid == os.getpid():
+                return
+            self.background_pid = os.getpid()
+        self.submission_queue.start()
+        self.link_verifier.start()
+        self.leaderboard_watcher.start()
+        self.snapshot_writer.start()
+        # Ensure indexes and warm the leaderboards without blocking the worker from serving
+        threading.Thread(target=self.warm_portal_data, name="warm-portal-data", daemon=True).start()
+
+    def serve_layout(self):
+        """Layout function so every page load gets the latest leaderboards"""
+        # Dash also calls this to validate the layout, without a request and on whatever request
+        # comes first, only the layout request itself touches the DB
+        if flask.has_request_context() and flask.request.path == self.layout_path:
+            self.refresh_portal_data()
+        return self.create_layout()
+
+    def layout_etag(self):
+        """ETag of the layout from the static sections and the current leaderboard version"""
+        self.refresh_portal_data()
+        if self.portal_stale:
+            return None  # the layout shows how old the leaderboards are, build it every time
+        return f"{self.static_layout_hash}-{self.portal_version}"
+
+    def warm_portal_data(self):
+        """Opens the connection pool, ensures the indexes and loads the leaderboards into the query cache"""
+        try:
+            self.db.warm_pool()
+            self.db.ensure_indexes()
+            self.load_portal_data()
+        except PyMongoError:
+            logger.exception("Could not warm the leaderboards, they will load on the first request")
 
     def create_layout(self):
-        dropdown_options = self.dropdown_name_options()
-        self._app.layout = dbc.Container([
+        """Assembles the page from the static sections and the current leaderboards"""
+        return dbc.Container([
 
             dcc.Location(id="url", refresh=False),
 
+            # Version of the leaderboards shown, a poll that runs until a new submission shows up,
+            # and a slower one picking up everyone else's
+            dcc.Store(id="leaderboard-version", data=self.portal_version),
+            dcc.Interval(id="leaderboard-poll", interval=LEADERBOARD_POLL_MS, max_intervals=LEADERBOARD_POLL_COUNT, disabled=True),
+            dcc.Interval(id="leaderboard-live", interval=LEADERBOARD_LIVE_POLL_MS),
+
             # Navigation Bar with Rounded Corners
             dbc.NavbarSimple(
                 children=[
-                    dbc.NavItem(dbc.NavLink("Hill Yeah Locations and Descriptions", href="#locations")),
-                    dbc.NavItem(dbc.NavLink("Map of All Hill Yeah Locations", href="#map")),
+                    dbc.NavItem(dbc.NavLink(f"{self.challenge.name} Locations and Descriptions", href="#locations")),
+                    dbc.NavItem(dbc.NavLink(f"Map of All {self.challenge.name} Locations", href="#map")),
                     dbc.NavItem(dbc.NavLink("Robo-Adam Resource Portal", href="#scores")),
-                    dbc.NavItem(dbc.NavLink("Hill Yeah Submission Form", href="#form")),
+                    dbc.NavItem(dbc.NavLink(f"{self.challenge.name} Submission Form", href="#form")),
+                    dbc.NavItem(dbc.NavLink("My Progress", href="#progress")),
                 ],
-                brand="Hill Yeah",
+                brand=self.challenge.name,
                 brand_href="#",
                 color="primary",
                 dark=True,
@@ -95,12 +302,12 @@ class Application:
                 }
             ),
 
-            # Updated "November Project's Exploration Elevation Challenge Across LA" Section
+            # The challenge's name, city, hills and dates
             dbc.Row(
                 dbc.Col(
                     html.Div(
                          html.H2(
-                            html.Span("HILL YEAH\nAn Exploration Elevation Challenge Across LA\n40 Hills\nNovember 1 - November 24\n LET'S GOOO!!!!", className="gradient-text"),
+                            html.Span(self.challenge_title(), className="gradient-text"),
                             className="resource-portal-title mt-4"
                         ),
                         style={
@@ -126,7 +333,7 @@ class Application:
             dbc.Row(
                 dbc.Col(
                     html.Div(
-                        children=self.paragraph_rules(),
+                        children=self.rules_section,
                         style={
                             'backgroundColor': '#e8e8e8',  # Light gray background
                             'padding': '15px',  # Adds padding inside the box
@@ -151,10 +358,10 @@ class Application:
                         id="locations",
                         children=[
                             html.H2(
-                                html.Span("Hill Yeah Locations and Descriptions", className="gradient-text"),
+                                html.Span(f"{self.challenge.name} Locations and Descriptions", className="gradient-text"),
                                 className="resource-portal-title mt-4"
                         ),
-                            self.generate_hill_table()
+                            self.hill_table
                         ],
                         style={
                             'marginTop': '100px',
@@ -181,7 +388,7 @@ class Application:
                     [
                         html.Div(id="map"),
                         html.H2(
-                            html.Span("Map of All Hill Yeah Locations", className="gradient-text"),
+                            html.Span(f"Map of All {self.challenge.name} Locations", className="gradient-text"),
                             className="resource-portal-title mt-4"
                         ),
                         html.P("Double click a pin and google maps will give you directions to the starting location", 
@@ -198,7 +405,7 @@ class Application:
                             }, 
                         
                         ),
-                        self.create_map(),
+                        self.hill_map,
                     ],
                     xs=12,  # Full width on extra small screens (e.g., iPhones)
                     sm=12,  # Full width on small screens
@@ -219,6 +426,7 @@ class Application:
                             html.Span("Robo-Adam Resource Portal", className="gradient-text"),
                             className="resource-portal-title mt-4"
                         ),
+                        html.Div(self.stale_notice(), id="portal-notice"),
                         self.create_resource_portal_layout(),
                     ],
                     xs=12,  # Full width on extra small screens (e.g., iPhones)
@@ -237,11 +445,11 @@ class Application:
                     [
                         html.Div(id="form"),                    
                         html.H3(
-                            html.Span("Hill Yeah Submission Form", className="gradient-text"),
+                            html.Span(f"{self.challenge.name} Submission Form", className="gradient-text"),
                             className="resource-portal-title mt-4"
                         ),
 
-                        self.layout_submission_form(),
+                        self.submission_form,
                     ],
                     width={"size": 8, "offset":2}
                 )
@@ -249,6 +457,25 @@ class Application:
 
             # Output Container For Results
             html.Div(id="output-container", className="mt-4"),
+            dcc.Store(id="submission-key"),  # idempotency key of the next submission, see submission_key_callback
+
+            # Divider
+            html.Hr(),
+
+            # A participant's own progress
+            dbc.Row(
+                dbc.Col(
+                    [
+                        html.Div(id="progress"),
+                        html.H3(
+                            html.Span("My Progress", className="gradient-text"),
+                            className="resource-portal-title mt-4"
+                        ),
+                        self.progress_section,
+                    ],
+                    width={"size": 8, "offset":2}
+                )
+            ),
 
             # Add a footer at the bottom
             dbc.Row(
@@ -256,7 +483,7 @@ class Application:
                     html.Div(
                         children=[
                             html.P(
-                                "© 2024 Hill Yeah Challenge.",
+                                f"© {self.challenge.start.year} {self.challenge.name} Challenge.",
                                 style={'color': '#6c757d', 'margin': '0'}
                             ),
                             html.P(
@@ -285,24 +512,8 @@ class Application:
         },
         fluid=True)
 
-        # Form Submission Response and Page Refresh
-        self.combined_callback()
-
-    def create_map(self, locations=None):
-        """Filter hill data json and create a map"""
-        locations = [{'name': item['name'], 'lat': item['lat'], 'lon': item['lon']} for item in self.hill_data_loader]
-        markers = [dl.Marker(position=[loc["lat"], loc["lon"]],
-                             children=[
-                                dl.Tooltip(loc["name"]),
-                                dl.Popup(html.A(
-                                    "Open in Google Maps",
-                                    href=f"https://www.google.com/maps?q={loc['lat']}, {loc['lon']}",
-                                    target="_blank",
-                                    style={"color": "blue", "text-decoration": "underline"}
-                                )) 
-                             ]
-                             ) for loc in locations
-                ]
+    def create_map(self):
+        """Create the map, its hills are one clustered GeoJSON layer loaded per viewport (see hill_map)"""
         # Responsive style for all devices
         map_style = {
             'width': '100%',
@@ -311,16 +522,21 @@ class Application:
             'margin': '10px auto',  # Centers and adds spacing for smaller screens
         }
 
-        # Find the center for all locations
-        latitudes = [loc['lat'] for loc in locations]
-        longitudes = [loc['lon'] for loc in locations]
-        # Calculate the center by averaging the latitude and longitude
-        center_lat = sum(latitudes) / len(latitudes) if latitudes else 34.0522
-        center_lon = sum(longitudes) / len(longitudes) if longitudes else -118.2437
-
-        return dl.Map(center=[center_lat, center_lon], zoom=10, children=[
+        # Center precomputed from all locations
+        center_lat, center_lon = self.catalog.center
+
+        # The whole catalog until the map reports its bounds, which it only does once moved,
+        # then the hills in view, see hill_map_viewport_callback
+        hills_layer = dl.GeoJSON(
+            id="hill-map-layer",
+            url=hill_map.url(self.challenge),
+            cluster=True,
+            zoomToBoundsOnClick=True,
+            superClusterOptions={'radius': HILL_MAP_CLUSTER_RADIUS},
+        )
+        return dl.Map(id="hill-map", center=[center_lat, center_lon], zoom=10, children=[
             dl.TileLayer(), # Base map layer
-            *markers
+            hills_layer
         ],style=map_style)
 
     def create_resource_portal_layout(self):
@@ -330,9 +546,11 @@ class Application:
             id='location-table-portal',
             columns=[
             {"name": "Hills Yeah Leaderboard", "id": "Name"},
-            {"name": "Hills Count", "id": "Locations Covered"}
+            {"name": "Hills Count", "id": "Locations Covered", "type": "numeric"}
             ],
             data= self.location_data,
+            page_count=self.page_count('location_counts'),
+            **self.leaderboard_table_options(),
             style_table={'overflowX': 'auto'},
             style_cell={'textAlign': 'left'},
             style_header={'backgroundColor': 'rgb(230, 230, 230)', 'fontWeight': 'bold'}
@@ -343,9 +561,26 @@ class Application:
             id='total-vertical-table',
             columns=[
                 {"name": "Name", "id": "Name"},
-                {"name": "Total Vert (Feet)", "id": "Total Vertical Feet"}
+                {"name": "Total Vert (Feet)", "id": "Total Vertical Feet", "type": "numeric"}
             ],
             data=self.total_vertical_data,
+            page_count=self.page_count('total_vertical'),
+            **self.leaderboard_table_options(),
+            style_table={'overflowX': 'auto'},
+            style_cell={'textAlign': 'left'},
+            style_header={'backgroundColor': 'rgb(230, 230, 230)', 'fontWeight': 'bold'}
+        )
+
+        # Vertical feet of a day range, filled in by window_leaderboard_callback
+        window_table = DataTable(
+            id='window-leaderboard-table',
+            columns=[
+                {"name": "Name", "id": "Name"},
+                {"name": "Total Vert (Feet)", "id": "Total Vertical Feet"},
+                {"name": "Reps", "id": "Reps"},
+                {"name": "Hills", "id": "Hills"}
+            ],
+            data=[],
             style_table={'overflowX': 'auto'},
             style_cell={'textAlign': 'left'},
             style_header={'backgroundColor': 'rgb(230, 230, 230)', 'fontWeight': 'bold'}
@@ -353,15 +588,14 @@ class Application:
 
         # Generate a bar graph showing repetitions per location
         # Bar Graph component
-        total_vertical_df = self.db.get_total_vertical_per_person()
-        top_10_df = total_vertical_df.nlargest(10, 'Total Vertical Feet')
+        top_10 = self.top_10
         bar_graph_wth = dcc.Graph(
             id='total-vertical-bar-graph',
             figure={
                 'data': [
                     go.Bar(
-                        x=top_10_df['Name'],
-                        y=top_10_df['Total Vertical Feet'],
+                        x=[row['Name'] for row in top_10],
+                        y=[row['Total Vertical Feet'] for row in top_10],
                         marker=dict(color=self.get_colors())  # Soft salmon color for the bars
                     )
                 ],
@@ -378,14 +612,13 @@ class Application:
         )
 
         # Create a Pie chart showing other statistics (e.g., total vertical feet distribution)
-        self.locations_covered = self.db.get_locations_covered()
         pie_chart = dcc.Graph(
             id='vertical-feet-pie-chart',
             figure={
                 'data': [
                     go.Pie(
-                        labels=self.locations_covered["Status"],
-                        values=self.locations_covered["Count"],
+                        labels=[row["Status"] for row in self.locations_covered],
+                        values=[row["Count"] for row in self.locations_covered],
                         hoverinfo='label+percent+value',
                         textinfo='label+percent+value',
                         marker=dict(colors=['#66cc66', '#ff9966'])  # Custom colors for pie sections
@@ -406,10 +639,12 @@ class Application:
             id='top-reps-table',
             columns=[
                 {"name": "Location", "id": "Location"},
-                {"name": "Reps", "id": "Reps"},
+                {"name": "Reps", "id": "Reps", "type": "numeric"},
                 {"name": "Name", "id": "Name"}
             ],
             data=self.reps_data,
+            page_count=self.page_count('top_reps'),
+            **self.leaderboard_table_options(),
             style_table={'overflowX': 'auto'},  # Keeps horizontal scroll but minimizes it
             style_cell={
                 'textAlign': 'left',
@@ -517,6 +752,31 @@ class Application:
                 ),
                 wth_table
             ], className="mb-4"),
+
+            html.Div([
+                html.H4(
+                    f"{self.challenge.name} Live",
+                    className="mt-4",
+                    style={
+                        "textAlign": "center",
+                        "whiteSpace": "pre-line",
+                        "fontFamily": "'Montserrat', sans-serif",
+                        "fontWeight": "700",
+                        "fontSize": "24px",
+                        "textShadow": "1px 1px 2px rgba(0, 0, 0, 0.2)",
+                        "color": "#007bff"
+                    }
+                ),
+                dcc.RadioItems(
+                    id='leaderboard-window',
+                    options=WINDOW_OPTIONS,
+                    value="today",
+                    inline=True,
+                    inputStyle={'marginLeft': '12px', 'marginRight': '4px'},
+                    style={'textAlign': 'center', 'fontFamily': "'Montserrat', sans-serif", 'marginBottom': '10px'}
+                ),
+                window_table
+            ], className="mb-4"),
             
             html.Div([
                 html.H4(
@@ -556,23 +816,128 @@ class Application:
             
         ], fluid=True)
 
+    def leaderboard_table_options(self):
+        """DataTable settings for leaderboards paged, sorted and filtered by leaderboard_page_callback"""
+        return dict(
+            page_action='custom',
+            sort_action='custom',
+            filter_action='custom',
+            page_current=0,
+            page_size=robo_adam.LEADERBOARD_PAGE_SIZE,
+            sort_by=[],
+            filter_query='',
+            filter_options={'case': 'insensitive'},
+        )
+
+    def page_count(self, leaderboard, row_count=None):
+        """Number of pages of a leaderboard, from the loaded snapshot's row count by default"""
+        if row_count is None:
+            row_count = self.row_counts[leaderboard]
+        return max(1, math.ceil(row_count / robo_adam.LEADERBOARD_PAGE_SIZE))
+
+    def refresh_portal_data(self):
+        """Loads the leaderboards, unless the watcher already reloads them on every write
+
+        When the database fails, the last leaderboards loaded or a newer snapshot file are kept.
+        """
+        if self.leaderboard_watcher.current or not self.database_available():
+            return
+        try:
+            with pymongo.timeout(REQUEST_QUERY_TIMEOUT):
+                self.load_portal_data()
+        except PyMongoError:
+            logger.exception("Could not load the leaderboards, serving the last ones loaded")
+            self.database_failed(portal=True)
+
+    def database_available(self):
+        """False for a while after the database failed, so requests don't each wait for it"""
+        return time.monotonic() >= self.database_retry_at
+
+    def database_failed(self, portal=False):
+        """Serves snapshots for DATABASE_RETRY_SECONDS
+
+        When loading the leaderboards themselves failed, portal, they are marked stale until loaded again,
+        switching to a newer snapshot file if there is one.
+        """
+        self.database_retry_at = time.monotonic() + DATABASE_RETRY_SECONDS
+        if not portal:
+            return
+        with self.portal_lock:
+            self.portal_stale = True
+        saved = leaderboard_snapshot.latest_snapshot(self.snapshot_directory)
+        if saved is not None and (self.portal_loaded_at is None or saved['created_at'] > self.portal_loaded_at):
+            self.load_portal_data(saved['portal'], saved['created_at'])
+
+    def stale_notice(self):
+        """Tells how old the leaderboards are while the database is unavailable, None otherwise"""
+        if not self.portal_stale:
+            return None
+        message = "Live results are temporarily unavailable"
+        if self.portal_loaded_at is not None:
+            message += f", showing the leaderboards from {leaderboard_snapshot.describe_age(self.portal_loaded_at)} ago"
+        return dbc.Alert(message + ".", color="warning", className="text-center")
+
+    def load_portal_data(self, snapshot=None, loaded_at=None):
+        """Loads the Resource Portal leaderboards from a single database snapshot
+
+        A snapshot read before, e.g. from a snapshot file, can be passed in with the time it was taken.
+        """
+        from_database = snapshot is None
+        if from_database:
+            snapshot = self.db.get_portal_snapshot()
+            loaded_at = datetime.now(timezone.utc)
+        with self.portal_lock:
+            if from_database:
+                self.portal_stale = False
+            self.portal_loaded_at = loaded_at
+            if snapshot is self.portal_snapshot:
+                return
+
+        # Remember recent leaderboards by content, so refreshes can send only what changed
+        portal_data = {
+            'location_data': snapshot['location_counts'],
+            'reps_data': snapshot['top_reps'],
+            'total_vertical_data': snapshot['total_vertical'],
+            'top_10': snapshot['top_vertical'],
+            'locations_covered': snapshot['locations_covered'],
+            'row_counts': snapshot['row_counts'],
+            # Changes with every submission, including those below the first pages
+            'total_repetitions': snapshot['total_repetitions'],
+        }
+        portal_version = hashlib.sha1(json.dumps(portal_data, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+        # The watcher thread and requests load concurrently, readers see one version's data as a whole
+        with self.portal_lock:
+            self.location_data = portal_data['location_data']
+            self.reps_data = portal_data['reps_data']
+            self.total_vertical_data = portal_data['total_vertical_data']
+            self.top_10 = portal_data['top_10']
+            self.locations_covered = portal_data['locations_covered']
+            self.row_counts = portal_data['row_counts']
+            self.portal_history[portal_version] = portal_data
+            self.portal_history.move_to_end(portal_version)
+            while len(self.portal_history) > PORTAL_HISTORY_SIZE:
+                self.portal_history.popitem(last=False)
+            self.portal_snapshot = snapshot
+            self.portal_version = portal_version
+
     def dropdown_name_options(self, data=None):
-        """Returns the dropdown options from the json data"""
-        return [{'label': item["name"], 'value': item['name']} for item in self.hill_data_loader]
+        """Returns the dropdown options from the hill catalog"""
+        return self.catalog.dropdown_options
 
     def generate_hill_table(self):
-        """Data Table that reads the json file and displays info on the website"""
+        """Data Table that displays the hill catalog on the website"""
         return dbc.Table(
             # Table header
             [html.Thead(html.Tr([html.Th('Name'), html.Th('Description'), html.Th('Length (Miles)'), html.Th('Vertical (Feet)'), html.Th('Strava Link')])),
                 html.Tbody([
                     html.Tr([
-                        html.Td(item.get('name', 'N/A')),
-                        html.Td(item.get('description', 'N/A')),
-                        html.Td(item.get('length', 'N/A')),
-                        html.Td(item.get('vertical', 'N/A')),
-                        html.Td(html.A(item.get('strava_link', '#'), href=item.get('strava_link', '#'), target="_blank"))
-                ]) for item in self.hill_data_loader
+                        html.Td(name),
+                        html.Td(description),
+                        html.Td(length),
+                        html.Td(vertical),
+                        html.Td(html.A(strava_link, href=strava_link, target="_blank"))
+                ]) for name, description, length, vertical, strava_link in self.catalog.table_rows
                 ])
             ],
             bordered=True, striped=True, hover=True, responsive=True, className="table-class"
@@ -592,18 +957,71 @@ class Application:
                     '#DAA520'   # Goldenrod
                 ]
 
+    def layout_progress_section(self):
+        """layout for looking up a participant's progress by e-mail, see progress_callback"""
+        return dbc.Row([
+            dbc.Col([
+                dbc.InputGroup([
+                    dbc.Input(id="progress-email", type="email", placeholder="Enter the e-mail you submit with"),
+                    dbc.Button("Show My Progress", id="progress-button", color="primary"),
+                ]),
+                html.Small("Anyone who knows a participant's e-mail can look up their progress.", className="text-muted"),
+                html.Div(id="progress-container", className="mt-3"),
+            ])
+        ], className="mb-3")
+
+    def progress_view(self, progress):
+        """A participant's locations done and left, reps per hill, total vertical and rank
+
+        An e-mail without submissions gets the same view with nothing done. Progress is public,
+        anyone entering a participant's e-mail sees it.
+        """
+        done = {row['location'] for row in progress['locations']}
+        done_count = sum(1 for hill in self.catalog if hill.name in done)
+        left = [hill.name for hill in self.catalog if hill.name not in done]
+        summary = [
+            ("Locations Done", f"{done_count} of {len(self.catalog)}"),
+            ("Locations Left", len(left)),
+            ("Total Vertical Feet", f"{progress['total_vertical']:,}"),
+            ("Rank", f"#{progress['rank']}" if progress['rank'] is not None else "-"),
+        ]
+        return html.Div([
+            dbc.Row([
+                dbc.Col(html.Div([html.H4(value), html.P(label)], style={'textAlign': 'center'}), xs=6, md=3)
+                for label, value in summary
+            ]),
+            dbc.Table(
+                [html.Thead(html.Tr([html.Th('Location'), html.Th('Reps'), html.Th('Vertical (Feet)')])),
+                    html.Tbody([
+                        html.Tr([
+                            html.Td(row['location']),
+                            html.Td(row['repetitions']),
+                            html.Td(row['vertical_feet'])
+                        ]) for row in progress['locations']
+                    ])
+                ],
+                bordered=True, striped=True, hover=True, responsive=True, className="table-class"
+            ),
+            html.P(f"Still to go: {', '.join(left)}" if left else "Every hill done. Hill Yeah!", style={'textAlign': 'center'}),
+        ])
+
     def get_vertical_value(self, name=""):
-        """Calculates the vertical feet by multiplying reps and feet"""
-        for item in self.hill_data_loader:
-            if item["name"] == name:
-                return item["vertical"]
+        """Returns the vertical feet of a location from the hill catalog"""
+        return self.catalog.vertical(name)
 
     def image_placer(self, image_path="/assets/hill_yeah_img.jpg"):
-        """Used for placing images in assets directory"""
-        return html.Img(
-            src=image_path,
-            style={"width": "100%", "max-width": "250px", "margin": "10px auto"}
-        )
+        """Used for placing images in assets directory, as resized WebP/JPEG derivatives when possible"""
+        style = {"width": "100%", "max-width": "250px", "margin": "10px auto"}
+        srcsets = image_derivatives.srcsets(image_path)
+        if srcsets is None:
+            return html.Img(src=image_path, style=style)
+
+        # Browsers pick the smallest variant covering the 250px display width and their pixel density
+        sizes = "(max-width: 250px) 100vw, 250px"
+        return html.Picture([
+            html.Source(type="image/webp", srcSet=srcsets["webp"], sizes=sizes),
+            html.Img(src=srcsets["fallback"], srcSet=srcsets["jpg"], sizes=sizes, style=style),
+        ])
 
     def layout_submission_form(self):
         """layout for the submission form"""
@@ -632,6 +1050,9 @@ class Application:
                             dbc.Col([
                                 dbc.Label("Select Location"),
                                 dcc.Dropdown(id="location-dropdown", options=dropdown_options, placeholder="Select Location"),
+                                # Sorts the hills by distance from the browser's location, see nearest_hills_callback
+                                dbc.Button("Sort by distance from me", id="locate-button", color="link", size="sm", className="px-0"),
+                                dcc.Store(id="browser-location"),
                                 ])
                         ], className="mb-3"),
 
@@ -676,25 +1097,28 @@ class Application:
             ], xs=12, sm=10, md=8, lg=6, xl=6, className="mx-auto") # Set the width and use "mx-auto" for centering
         ]) 
 
-    def load_json(self, file_path=None):
-        """Loads hill data json file
+    def challenge_days(self):
+        """First and last day of the challenge, e.g. ("November 1", "November 24")"""
+        return tuple(f"{day:%B} {day.day}" for day in (self.challenge.start, self.challenge.last_day))
 
-        Returns:
-            hill data json file
-        """
-        file_directory = Path(os.path.dirname(os.path.realpath(__file__)))
-        hill_data_file = file_directory / Path("_data/hill_data.json")
-        with open(hill_data_file, "r") as _file:
-            data = json.load(_file)
-        return data
+    def challenge_title(self):
+        """Header text naming the challenge, its city, hill count and dates"""
+        across = f" Across {self.challenge.city}" if self.challenge.city else ""
+        return (f"{self.challenge.name.upper()}\nAn Exploration Elevation Challenge{across}\n"
+                f"{len(self.catalog)} Hills\n{' - '.join(self.challenge_days())}\n LET'S GOOO!!!!")
 
     def paragraph_rules(self):
         # Paragraph explaining the rules
+        hill_count = len(self.catalog)
+        first_day, last_day = self.challenge_days()
+        places = join_names(self.challenge.areas) or self.challenge.city
+        across = f" across {places}" if places else ""
+        groups = join_names(self.challenge.running_groups)
         return [
             # Introductory Paragraph
             html.P(
-                "Welcome to a collaboration between November Project and Saturday Stairs for the Hill Yeah Challenge! Inspired by November Project San Francisco's Hill Climb Challenge in 2021, "
-                "this adventure will have you exploring 40 elevation-based locations across Santa Monica, West Hollywood, Culver City, Hollywood Bowl, Los Feliz, Griffith Park, Highland Park, Pasadena, Echo Park, and Silver Lake. "
+                f"Welcome to a collaboration between November Project and Saturday Stairs for the {self.challenge.name} Challenge! Inspired by November Project San Francisco's Hill Climb Challenge in 2021, "
+                f"this adventure will have you exploring {hill_count} elevation-based locations{across}. "
                 "The routes include staircases, steep streets, and hills, which you’ll conquer using only your own body power—no motorized assistance allowed. "
                 "There are three categories to win:",
                 className="intro-paragraph"
@@ -725,7 +1149,7 @@ class Application:
                     html.Ul([
                         html.Li([
                             html.B("HILLS YEAH: "), 
-                            "Visit as many of the 40 listed locations as possible."
+                            f"Visit as many of the {hill_count} listed locations as possible."
                         ]),
                         html.Li([
                             html.B("REPSertoire REPSresentative: "), 
@@ -741,8 +1165,8 @@ class Application:
 
             # Additional Paragraph
             html.P(
-                "The data table below lists all 40 locations, including their name, description, length, vertical feet, and a Strava link to the segment. "
-                "Only repetitions completed between November 1 and November 24 count toward the challenge. We've pre-calculated the vertical feet for each location. "
+                f"The data table below lists all {hill_count} locations, including their name, description, length, vertical feet, and a Strava link to the segment. "
+                f"Only repetitions completed between {first_day} and {last_day} count toward the challenge. We've pre-calculated the vertical feet for each location. "
                 "You’ll also find a map with pins showing directions to the start of each location.",
                 className="intro-paragraph"
             ),
@@ -779,8 +1203,8 @@ class Application:
 
             # Unordered List
             html.Ul([
-                html.Li("Discover new parts of LA you’ve never explored before!"),
-                html.Li("Connect with other running groups at these locations. Ex: MRC, NPLA, NPWLA, Struggle Bus, and DHRC."),
+                html.Li(f"Discover new parts of {self.challenge.city or 'the city'} you’ve never explored before!"),
+                html.Li("Connect with other running groups at these locations." + (f" Ex: {groups}." if groups else "")),
                 html.Li("Got questions or need support? Reach out to leadership or email Adam at amwermus@gmail.com."),
                 html.Li("Above all—have fun, push yourself, support each other, and aim to conquer the challenge!"),
             ]),
@@ -812,221 +1236,399 @@ class Application:
                     )
         ]
 
-    def combined_callback(self):
-        """Handles submission form response, updating data, and visualization and a page refresh"""
+    def submission_callback(self):
+        """Handles the submission form response, the leaderboards refresh in their own callback"""
         @self._app.callback(
             [
                 Output("output-container", "children"),
-                Output("location-table-portal", "data"),
-                Output("top-reps-table", "data"),
-                Output("total-vertical-bar-graph", "figure"),
-                Output("total-vertical-table", "data"),
-                Output("vertical-feet-pie-chart", "figure"),
-                Output("submit-button", "style")
-            ],
-            [
-                Input("submit-button", "n_clicks"),
-                Input("url", "pathname")
+                Output("submit-button", "style"),
+                Output("leaderboard-poll", "n_intervals"),
+                Output("leaderboard-poll", "disabled", allow_duplicate=True)
             ],
+            Input("submit-button", "n_clicks"),
             [
                 State("name", "value"),
                 State("email", "value"),
                 State("location-dropdown", "value"),
                 State("num-repetitions", "value"),
-                State("optional-link", "value")
+                State("optional-link", "value"),
+                State("submission-key", "data")
             ],
             prevent_initial_call=True
         )
-        def handle_submission_form(n_clicks, pathname, name, email, location, num_repetitions, optional_link):
+        def handle_submission_form(n_clicks, name, email, location, num_repetitions, optional_link, submission_key):
             
             # Button Color
-            default_button_style = {'background': 'linear-gradient(to right, #FF6F61, #007bff)', 'color': 'white', 'borderRadius': '8px'}
             successful_button_style = {'background': 'green', 'color': 'white', 'borderRadius': '8px'}
             error_button_style = {'background': 'red', 'color': 'white', 'borderRadius': '8px'}
-            button_style = default_button_style
-            
-            # Trigger
-            trigger = callback_context.triggered[0]["prop_id"].split(".")[0]
-
-            # Determine if this callback was triggered by the form submission or by the page load
-            if trigger == "submit-button" and n_clicks:
-
-                # Check each field individually
-                if not name:
-                    return (
-                        html.Div("Please enter a name!", style={"color": "red", 'textAlign': 'center'}),
-                        [],  # Placeholder for location-table-portal.data
-                        [],  # Placeholder for top-reps-table.data
-                        {},  # Placeholder for total-vertical-bar-graph.figure
-                        [],  # Placeholder for total-vertical-table.data
-                        {}, # Placeholder for pie chart
-                        error_button_style
-                        
-                    )
-                if not email:
-                    return (
-                        html.Div("Please enter a valid e-mail!", style={"color": "red", 'textAlign': 'center'}),
-                        [], [], {}, [], {}, error_button_style
-                    )
-                if not location:
-                    return (
-                        html.Div("Please select a location!", style={"color": "red", 'textAlign': 'center'}),
-                        [], [], {}, [], {}, error_button_style
-                    )
-                if not num_repetitions:
-                    return (
-                        html.Div("Please enter number of repetitions!", style={"color": "red", 'textAlign': 'center'}),
-                        [], [], {}, [], {}, error_button_style
-                    )
-                
-                # Check if any fields were missed (might be redundant)
-                if not (name and email and location and num_repetitions):
-                    return (
-                        html.Div("Please fill out all required fields.", style={"color": "red"}),
-                        [], [], {}, [], {}, error_button_style
-                    )
 
+            if not n_clicks:
+                raise dash.exceptions.PreventUpdate
+
+            # Failed validation only updates the message and button, the leaderboards are left alone
+            # Check each field individually
+            if not name:
+                return html.Div("Please enter a name!", style={"color": "red", 'textAlign': 'center'}), error_button_style, dash.no_update, dash.no_update
+            if not email:
+                return html.Div("Please enter a valid e-mail!", style={"color": "red", 'textAlign': 'center'}), error_button_style, dash.no_update, dash.no_update
+            if not location:
+                return html.Div("Please select a location!", style={"color": "red", 'textAlign': 'center'}), error_button_style, dash.no_update, dash.no_update
+            if not num_repetitions:
+                return html.Div("Please enter number of repetitions!", style={"color": "red", 'textAlign': 'center'}), error_button_style, dash.no_update, dash.no_update
+
+            # Validate number of repetitions
+            if not isinstance(num_repetitions, int) or num_repetitions <= 0:
+                return html.Div("Number of repetitions must be a positive integer.", style={"color": "red"}), error_button_style, dash.no_update, dash.no_update
+
+            # Prevent submission starting at the deadline
+            if self.submission_deadline is not None and datetime.now(timezone.utc) >= self.submission_deadline:
+                return html.Div("Challenge ended. Thank you for participating!", style={"color": "red"}), error_button_style, dash.no_update, dash.no_update
+
+            # Get the vertical value from the selected location and date
+            vertical_value = self.get_vertical_value(location)
+            total_submitted_feet = num_repetitions * vertical_value
+
+            # submission data to insert to database
+            # The browser's key is the same for every click until a response comes back
+            if not isinstance(submission_key, str) or not SUBMISSION_KEY_PATTERN.match(submission_key):
+                submission_key = None
+            submission_data = robo_adam.make_submission(
+                self.challenge, name, email, location, num_repetitions, vertical_value, optional_link, submission_key)
+
+            # journal the submission, the background writer inserts it into MongoDB
+            if not self.submission_queue.submit(submission_data):
+                # Sent twice, the first one is already on its way to the leaderboards
+                return html.Div("This submission was already received!", style={'textAlign': 'center'}), successful_button_style, dash.no_update, dash.no_update
+
+            result = html.Div(
+                [
+                    html.H4("Form Submission Results"),
+                    html.P(f"Name: {submission_data['name']}"),
+                    html.P(f"Email: {submission_data['email']}"),
+                    html.P(f"Location: {submission_data['location']}"),
+                    html.P(f"Number of Repetitions:  {submission_data['repetitions']}"),
+                    html.P(f"Vertical Value: {vertical_value}"),
+                    html.P(f"Total Feet: {total_submitted_feet}"),
+                    html.P(f"Optional Link: {submission_data['strava_link']}"),
+                
+                ],
+                style={
+                    "display": 'flex',
+                    'flexDirection': 'column',
+                    'justifyContent': 'center',
+                    'alignItems': 'center',
+                    'textAlign': 'center',
 
-                # Validate number of repetitions
-                if not isinstance(num_repetitions, int) or num_repetitions <= 0:
-                    return (
-                        html.Div("Number of repetitions must be a positive integer.", style={"color": "red"}),
-                        [], [], {}, [], {}, error_button_style
-                    )
+                }
+            )
 
-                # Prevent submission starting 11/24/2024
-                # Date
-                date = pd.Timestamp.now().strftime("%Y-%m-%d")
-                date_time = date = pd.Timestamp.now().strftime("%Y-%m-%d %H:%M:%S")
-                # Define a target date for comparison
-                target_date = pd.Timestamp('2024-11-25')
-                # Convert current date to a Timestamp for comparison
-                current_date = pd.Timestamp(date)
-                if current_date >= target_date:
-                    return (
-                        html.Div("Challenge ended. Thank you for participating!", style={"color": "red"}),
-                        [], [], {}, [], {}, error_button_style
-                    )
+            # Poll for the leaderboards until the writer has inserted the submission
+            return result, successful_button_style, 0, False
 
-                # Good submission
-                button_style = successful_button_style
-                
-                # Get the vertical value from the selected location and date
-                vertical_value = self.get_vertical_value(location)
-                total_submitted_feet = num_repetitions * vertical_value
-
-                # Date
-                date = pd.Timestamp.now().strftime("%Y-%m-%d")
-                date_time = date = pd.Timestamp.now().strftime("%Y-%m-%d %H:%M:%S")
-
-                # Handle optional link
-                link_text = optional_link if optional_link else "No link provided"
-
-                # submission data to insert to database
-                submission_data = {
-                    "name": name,
-                    "email": email,
-                    "location": location,
-                    "repetitions": num_repetitions,
-                    "vertical_gain": vertical_value,
-                    "strava_link": link_text,
-                    "date": date,
-                    "date_time": date_time,
+    def progress_callback(self):
+        """Shows a participant's progress for their e-mail, and again when the leaderboards change"""
+        @self._app.callback(
+            Output("progress-container", "children"),
+            [
+                Input("progress-button", "n_clicks"),
+                Input("progress-email", "n_submit"),
+                Input("leaderboard-version", "data")
+            ],
+            State("progress-email", "value"),
+            prevent_initial_call=True
+        )
+        def serve_progress(n_clicks, n_submit, leaderboard_version, email):
+            if not email:
+                if callback_context.triggered_id == "leaderboard-version":
+                    raise dash.exceptions.PreventUpdate
+                return html.Div("Please enter a valid e-mail!", style={"color": "red", 'textAlign': 'center'})
+            if not self.database_available():
+                return html.Div("Progress is temporarily unavailable, please try again soon.", style={'textAlign': 'center'})
+            try:
+                with pymongo.timeout(REQUEST_QUERY_TIMEOUT):
+                    progress = self.db.get_participant_progress(email)
+            except PyMongoError:
+                logger.exception("Could not load a participant's progress")
+                self.database_failed()
+                return html.Div("Progress is temporarily unavailable, please try again soon.", style={'textAlign': 'center'})
+            return self.progress_view(progress)
+
+    def submission_key_callback(self):
+        """Gives the form a new idempotency key when the page loads and after every response to it"""
+        self._app.clientside_callback(
+            """
+            function(children) {
+                if (window.crypto && window.crypto.randomUUID) {
+                    return window.crypto.randomUUID();
                 }
+                return Date.now().toString(36) + "-" + Math.random().toString(36).slice(2);
+            }
+            """,
+            Output("submission-key", "data"),
+            Input("output-container", "children"),
+        )
 
-                # insert the submission data into MongoDB
-                self.db.insert_submitted_data(submission_data)
-
-                result = html.Div(
-                    [
-                        html.H4("Form Submission Results"),
-                        html.P(f"Name: {submission_data['name']}"),
-                        html.P(f"Email: {submission_data['email']}"),
-                        html.P(f"Location: {submission_data['location']}"),
-                        html.P(f"Number of Repetitions:  {submission_data['repetitions']}"),
-                        html.P(f"Vertical Value: {vertical_value}"),
-                        html.P(f"Total Feet: {total_submitted_feet}"),
-                        html.P(f"Optional Link: {submission_data['strava_link']}"),
-                    
-                    ],
-                    style={
-                        "display": 'flex',
-                        'flexDirection': 'column',
-                        'justifyContent': 'center',
-                        'alignItems': 'center',
-                        'textAlign': 'center',
+    def hill_map_viewport_callback(self):
+        """Points the hill layer at the features inside the map's bounds, snapped so small pans reuse them"""
+        self._app.clientside_callback(
+            """
+            function(bounds, url) {
+                if (!bounds) {
+                    return window.dash_clientside.no_update;
+                }
+                const grid = %s;
+                const bbox = [
+                    Math.floor(bounds[0][1] / grid) * grid, Math.floor(bounds[0][0] / grid) * grid,
+                    Math.ceil(bounds[1][1] / grid) * grid, Math.ceil(bounds[1][0] / grid) * grid
+                ].join(",");
+                const viewportUrl = "%s&bbox=" + bbox;
+                return viewportUrl === url ? window.dash_clientside.no_update : viewportUrl;
+            }
+            """ % (hill_map.BBOX_GRID_DEGREES, hill_map.url(self.challenge)),
+            Output("hill-map-layer", "url"),
+            Input("hill-map", "bounds"),
+            State("hill-map-layer", "url"),
+        )
 
+    def nearest_hills_callback(self):
+        """Sorts the location dropdown by distance from the browser's location, when it shares it"""
+        self._app.clientside_callback(
+            """
+            function(n_clicks) {
+                return new Promise(function(resolve) {
+                    if (!n_clicks || !navigator.geolocation) {
+                        resolve(window.dash_clientside.no_update);
+                        return;
                     }
-                ),
-
-            else:
-                result = None
-            
-            # Load data once during app initialization
-            self.location_data = self.db.get_unique_location_counts().to_dict('records')
-            self.reps_data = self.db.get_top_reps_per_location().to_dict('records')
-            self.total_vertical_data = self.db.get_total_vertical_per_person().to_dict('records')
-            self.locations_covered = self.db.get_locations_covered()
-
-            # Update bar graph
-            # Top 10 for the bar graph
-            top_10_df = self.db.get_total_vertical_per_person().nlargest(10, 'Total Vertical Feet')
-    
-            # Create figure for the bar graph
-            self.bar_vert_graph = {
-                'data': [
-                    go.Bar(
-                        x=top_10_df['Name'],
-                        y=top_10_df['Total Vertical Feet'],
-                        marker=dict(color=self.get_colors())
-                    )
-                ],
-                'layout': go.Layout(
-                    title="",
-                    xaxis=dict(title="", tickangle=-45, automargin=True),
-                    yaxis=dict(title="Total Vert<br>(Feet)", title_standoff=10),
-                    plot_bgcolor='#e6f2ff',
-                    paper_bgcolor='rgba(0,0,0,0)',
-                    margin=dict(l=60, r=20, t=40, b=120),
-                )
+                    navigator.geolocation.getCurrentPosition(
+                        function(position) {
+                            resolve({lat: position.coords.latitude, lon: position.coords.longitude});
+                        },
+                        function() { resolve(window.dash_clientside.no_update); },
+                        {maximumAge: 600000, timeout: 10000}
+                    );
+                });
             }
+            """,
+            Output("browser-location", "data"),
+            Input("locate-button", "n_clicks"),
+            prevent_initial_call=True
+        )
 
-            # Update pie chart
-            pie_chart = {
-                'data': [
-                    go.Pie(
-                        labels=self.locations_covered["Status"],
-                        values=self.locations_covered["Count"],
-                        hoverinfo='label+percent+value',
-                        textinfo='label+percent+value',
-                        marker=dict(colors=['#66cc66', '#ff9966']),  # You can customize colors
-                    )
-                ],
-                'layout': go.Layout(
-                    title="",
-                    plot_bgcolor='#e6f2ff',
-                    paper_bgcolor='rgba(0,0,0,0)',
-                )
+        @self._app.callback(
+            Output("location-dropdown", "options"),
+            Input("browser-location", "data"),
+            prevent_initial_call=True
+        )
+        def sort_by_distance(location):
+            if not location:
+                raise dash.exceptions.PreventUpdate
+            return [
+                {'label': f"{hill.name} ({distance_km:.1f} km)", 'value': hill.name}
+                for distance_km, hill in self.catalog.nearest(location['lat'], location['lon'], k=len(self.catalog))
+            ]
+
+    def leaderboard_refresh_callback(self):
+        """Refreshes the leaderboards when their data changed, sending only what changed"""
+        @self._app.callback(
+            [
+                Output("total-vertical-bar-graph", "figure"),
+                Output("vertical-feet-pie-chart", "figure"),
+                Output("leaderboard-version", "data"),
+                Output("leaderboard-poll", "disabled"),
+                Output("portal-notice", "children")
+            ],
+            [
+                Input("leaderboard-poll", "n_intervals"),
+                Input("leaderboard-live", "n_intervals")
+            ],
+            State("leaderboard-version", "data"),
+            prevent_initial_call=True
+        )
+        def refresh_leaderboards(n_intervals, live_intervals, leaderboard_version):
+
+            # Load every leaderboard in a single round trip, when the watcher hasn't already
+            self.refresh_portal_data()
+            with self.portal_lock:
+                portal_version = self.portal_version
+                # Diff against the leaderboards the browser has, everything is sent when this worker forgot them
+                shown = self.portal_history.get(leaderboard_version, {})
+                current = self.portal_history.get(portal_version) or {
+                    'top_10': self.top_10, 'locations_covered': self.locations_covered}
+            if portal_version == leaderboard_version:
+                raise dash.exceptions.PreventUpdate
+
+            # Bar graph and pie chart only need their traces patched
+            bar_graph = dash.no_update
+            if shown.get('top_10') != current['top_10']:
+                bar_graph = dash.Patch()
+                bar_graph['data'][0]['x'] = [row['Name'] for row in current['top_10']]
+                bar_graph['data'][0]['y'] = [row['Total Vertical Feet'] for row in current['top_10']]
+
+            pie_chart = dash.no_update
+            if shown.get('locations_covered') != current['locations_covered']:
+                pie_chart = dash.Patch()
+                pie_chart['data'][0]['labels'] = [row['Status'] for row in current['locations_covered']]
+                pie_chart['data'][0]['values'] = [row['Count'] for row in current['locations_covered']]
+
+            # The new version refreshes the leaderboard tables through leaderboard_page_callback
+            return bar_graph, pie_chart, portal_version, True, self.stale_notice()  # stop polling
+
+    def window_leaderboard_callback(self):
+        """Fills the windowed leaderboard on page load, and when its window or the leaderboards change
+
+        Not part of the layout, its rows change at midnight without the leaderboard version changing.
+        """
+        @self._app.callback(
+            Output("window-leaderboard-table", "data"),
+            [
+                Input("leaderboard-window", "value"),
+                Input("leaderboard-version", "data")
+            ]
+        )
+        def serve_window_leaderboard(window, leaderboard_version):
+            if window not in challenges.LEADERBOARD_WINDOWS:
+                raise dash.exceptions.PreventUpdate
+            start, end = self.challenge.window(window)
+            if self.database_available():
+                try:
+                    with pymongo.timeout(REQUEST_QUERY_TIMEOUT):
+                        return self.db.get_window_leaderboard(start, end)
+                except PyMongoError:
+                    logger.exception("Could not load the windowed leaderboard, serving it from the snapshot")
+                    self.database_failed()
+            saved = leaderboard_snapshot.latest_snapshot(self.snapshot_directory)
+            if saved is None:
+                raise dash.exceptions.PreventUpdate
+            return leaderboard_snapshot.snapshot_window(saved, start, end)
+
+    def leaderboard_page_callback(self, table_id, leaderboard):
+        """Serves a leaderboard table's current page, sort and filter from the database
+
+        Pages are re-read when the leaderboards change, sending only the rows that changed.
+        """
+        @self._app.callback(
+            [
+                Output(table_id, "data"),
+                Output(table_id, "page_count"),
+                Output(table_id, "page_current")
+            ],
+            [
+                Input(table_id, "page_current"),
+                Input(table_id, "sort_by"),
+                Input(table_id, "filter_query"),
+                Input("leaderboard-version", "data")
+            ],
+            State(table_id, "data"),
+            prevent_initial_call=True
+        )
+        def serve_leaderboard_page(page_current, sort_by, filter_query, leaderboard_version, shown_rows):
+            page_size = robo_adam.LEADERBOARD_PAGE_SIZE
+            page_current = page_current or 0
+            sort = tuple(
+                (column['column_id'], pymongo.ASCENDING if column['direction'] == 'asc' else pymongo.DESCENDING)
+                for column in sort_by or []
+            )
+            filters = parse_filter_query(filter_query)
+
+            page = self.leaderboard_page(leaderboard, page_current * page_size, page_size, sort, filters)
+            page_count = self.page_count(leaderboard, page['total'])
+            # A new filter can leave fewer pages than the one shown
+            if page_current >= page_count:
+                page_current = page_count - 1
+                page = self.leaderboard_page(leaderboard, page_current * page_size, page_size, sort, filters)
+
+            rows = page['rows']
+            if callback_context.triggered_id == "leaderboard-version":
+                rows = patch_rows(shown_rows, rows)
+            return rows, page_count, page_current
+
+    def leaderboard_page(self, leaderboard, skip, limit, sort, filters):
+        """A leaderboard page from the database, or from the latest snapshot while the database fails"""
+        if self.database_available():
+            try:
+                with pymongo.timeout(REQUEST_QUERY_TIMEOUT):
+                    return self.db.get_leaderboard_page(leaderboard, skip, limit, sort, filters)
+            except PyMongoError:
+                logger.exception("Could not load a leaderboard page, serving it from the snapshot")
+                self.database_failed()
+        saved = leaderboard_snapshot.latest_snapshot(self.snapshot_directory)
+        if saved is None:
+            raise dash.exceptions.PreventUpdate
+        return leaderboard_snapshot.snapshot_page(saved, leaderboard, skip, limit, sort, filters)
+
+
+
+class Site:
+    """Serves every challenge's Application from one Flask server"""
+
+    def __init__(self, applications):
+        self.applications = {application.challenge.challenge_id: application for application in applications}
+        self.server = flask.Flask(__name__)
+        for application in self.applications.values():
+            application._app.init_app(self.server)
+
+        # Request, callback and query timings at /metrics, first so it times every request
+        metrics.install(self.server, [application._app.callback_map for application in self.applications.values()])
+
+        # Compression, and ETags so repeat visits get 304s
+        assets_folder = next(iter(self.applications.values()))._app.config.assets_folder
+        http_caching.install(self.server, {
+            application.layout_path: application.layout_etag for application in self.applications.values()
+        }, assets_folder)
+
+        # CSV upload endpoint for group leaders
+        bulk_import.register_upload_route(self.server, {
+            challenge_id: application.db for challenge_id, application in self.applications.items()
+        })
+
+        # Hill map features per viewport and nearest hills
+        hill_map.register_routes(self.server, {
+            challenge_id: application.catalog for challenge_id, application in self.applications.items()
+        })
+
+        # Resized images for the rules section
+        image_derivatives.register_route(self.server)
+
+        # Health check for the load balancer
+        self.health_route()
+
+        # Background threads start in the process serving requests
+        self.server.before_request(self.start_background_work)
+
+    def start_background_work(self):
+        """Starts every challenge's background work, see Application.start_background_work"""
+        for application in self.applications.values():
+            application.start_background_work()
+
+    def health_route(self):
+        """Adds /healthz, 200 while the database answers a ping and 503 when it doesn't"""
+        @self.server.route("/healthz")
+        def health():
+            # Every challenge shares the process's client, one ping checks them all
+            health = next(iter(self.applications.values())).db.health_check()
+            health['challenges'] = {
+                challenge_id: {
+                    'pending_submissions': application.submission_queue.pending,
+                    'leaderboard_watcher': application.leaderboard_watcher.mode,
+                }
+                for challenge_id, application in self.applications.items()
             }
-
-            return result, self.location_data, self.reps_data, self.bar_vert_graph, self.total_vertical_data, pie_chart, button_style
-
-
+            health['pending_link_checks'] = link_verifier.get_verifier().pending
+            return flask.jsonify(health), 200 if health['ok'] else 503
 
     def run(self):
-        """Runs the application"""
-        self._app.run(debug=True)
-    
+        """Runs every challenge's app with the default challenge's debug tools"""
+        next(application for application in self.applications.values() if application.challenge.default)._app.run(debug=True)
 
 
-# Initialize and configure the application
-run_app = Application()
+# Initialize and configure the application, a Dash app per challenge
+site = Site([Application(challenge) for challenge in challenges.get_registry()])
 
 # Expose the server to Gunicorn
-server = run_app._app.server
+server = site.server
 
 
 # Run the app
 if __name__ == "__main__":
-    run_app.run()
-
+    site.run()
@@ -0,0 +1,348 @@
+"""
+Benchmarks for the RoboAdam queries and the Dash callbacks
+
+Generates synthetic participants, hills and submissions, loads them into a
+local mongod (or mongomock as an in-process stand-in), then times every
+RoboAdam query and write, the layout and the submission and leaderboard
+callbacks. Results are written as JSON so runs can be compared between
+commits.
+
+Hill popularity and participant activity follow a Zipf-like skew, so a few
+hills and a few regulars get most of the submissions, like the real challenge.
+
+    python benchmark.py --users 2000 --hills 40 --submissions 100000 --output results.json
+    python benchmark.py --in-process --submissions 5000 --compare results.json
+
+The benchmark database is dropped and reloaded on every run. mongomock is
+far slower than mongod and has no query planner, its numbers are only good
+for comparing runs with each other.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from pymongo.mongo_client import MongoClient
+from pymongo.server_api import ServerApi
+
+import challenges
+import hill_catalog
+import robo_adam
+
+BENCHMARK_DATABASE_NAME = "wth_benchmark"
+BENCHMARK_URI = os.getenv("BENCHMARK_MONGODB_URI", "mongodb://localhost:27017")
+LOAD_BATCH_SIZE = 10000
+
+# Synthetic hills are spread around Los Angeles
+SYNTHETIC_CENTER = (34.05, -118.25)
+SYNTHETIC_SPREAD = 0.5  # degrees
+
+
+def zipf_weights(count, skew):
+    """Weights making the first items the most popular, skew 0 is uniform"""
+    return [1 / (rank ** skew) for rank in range(1, count + 1)]
+
+
+def make_catalog(hill_count, rng):
+    """The real hills, plus synthetic ones when more are asked for"""
+    hills = list(hill_catalog.get_catalog())[:hill_count]
+    for location_id in range(len(hills) + 1, hill_count + 1):
+        hills.append(hill_catalog.Hill(
+            location_id=location_id,
+            name=f"Synthetic Hill {location_id}",
+            description="Generated for benchmarking",
+            length=f"{rng.uniform(0.1, 2):.1f} miles",
+            vertical=rng.randint(50, 600),
+            strava_link="#",
+            lat=SYNTHETIC_CENTER[0] + rng.uniform(-SYNTHETIC_SPREAD, SYNTHETIC_SPREAD),
+            lon=SYNTHETIC_CENTER[1] + rng.uniform(-SYNTHETIC_SPREAD, SYNTHETIC_SPREAD),
+        ))
+    return hill_catalog.HillCatalog(hills)
+
+
+def make_challenge(catalog):
+    """A challenge running from two weeks ago to two weeks from now, so every window has submissions"""
+    today = datetime.now(timezone.utc).date()
+    return challenges.Challenge("benchmark", "Hill Yeah Benchmark", today - timedelta(days=14), today + timedelta(days=14),
+                                catalog=catalog, default=True)
+
+
+def generate_submissions(challenge, user_count, submission_count, skew, rng):
+    """Yields submissions from skewed participants at skewed hills"""
+    users = [(f"Participant {number}", f"participant{number}@example.com") for number in range(user_count)]
+    hills = list(challenge.catalog)
+    # Shuffle so popularity doesn't follow the catalog order
+    rng.shuffle(hills)
+    user_weights = zipf_weights(len(users), skew)
+    hill_weights = zipf_weights(len(hills), skew)
+
+    for _ in range(submission_count):
+        name, email = rng.choices(users, user_weights)[0]
+        hill = rng.choices(hills, hill_weights)[0]
+        # Random keys, the same entry made again within a minute is a real submission here
+        yield robo_adam.make_submission(
+            challenge, name, email, hill.name, rng.randint(1, 20), hill.vertical, key=f"benchmark-{rng.getrandbits(64):016x}")
+
+
+def load_submissions(db, args, rng):
+    """Insert the synthetic submissions in batches through RoboAdam, returns the seconds taken"""
+    started = time.perf_counter()
+    batch = []
+    for submission in generate_submissions(db.challenge, args.users, args.submissions, args.skew, rng):
+        batch.append(submission)
+        if len(batch) == LOAD_BATCH_SIZE:
+            db.insert_submissions_bulk(batch)
+            batch = []
+    if batch:
+        db.insert_submissions_bulk(batch)
+    return time.perf_counter() - started
+
+
+def time_call(function, repeats, setup=None):
+    """Milliseconds of each of repeats calls, running setup untimed before each"""
+    timings = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def summarize(timings):
+    ordered = sorted(timings)
+    return {
+        'repeats': len(ordered),
+        'min_ms': round(ordered[0], 3),
+        'median_ms': round(statistics.median(ordered), 3),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+        'mean_ms': round(statistics.fmean(ordered), 3),
+    }
+
+
+def query_benchmarks(db):
+    """RoboAdam reads to time, by name, each run with an empty query cache"""
+    page_size = robo_adam.LEADERBOARD_PAGE_SIZE
+    snapshot = db.get_portal_snapshot()
+    busiest_email = db.user_rollups_test.find_one(sort=[('total_vertical', -1)])['_id']
+
+    benchmarks = {
+        'get_portal_snapshot': db.get_portal_snapshot,
+        'get_location_reps_by_email': lambda: db.get_location_reps_by_email(busiest_email),
+        'get_participant_progress (busiest participant)': lambda: db.get_participant_progress(busiest_email),
+        'get_locations_covered': db.get_locations_covered,
+        'get_top_reps_per_location': db.get_top_reps_per_location,
+        'get_total_vertical_per_person': db.get_total_vertical_per_person,
+        'get_unique_location_counts': db.get_unique_location_counts,
+        'get_window_leaderboard (week)': lambda: db.get_window_leaderboard(*db.challenge.window("week")),
+    }
+    for leaderboard in robo_adam.LEADERBOARDS:
+        last_page = max(0, (snapshot['row_counts'][leaderboard] - 1) // page_size)
+        benchmarks[f'get_leaderboard_page ({leaderboard}, first page)'] = (
+            lambda leaderboard=leaderboard: db.get_leaderboard_page(leaderboard, 0, page_size))
+        benchmarks[f'get_leaderboard_page ({leaderboard}, last page)'] = (
+            lambda leaderboard=leaderboard, skip=last_page * page_size: db.get_leaderboard_page(leaderboard, skip, page_size))
+        benchmarks[f'get_leaderboard_page ({leaderboard}, sorted by name)'] = (
+            lambda leaderboard=leaderboard: db.get_leaderboard_page(leaderboard, 0, page_size, sort=(('Name', 1),)))
+        benchmarks[f'get_leaderboard_page ({leaderboard}, name filter)'] = (
+            lambda leaderboard=leaderboard: db.get_leaderboard_page(
+                leaderboard, 0, page_size, filters=(('Name', 'contains', '7'),)))
+    return benchmarks
+
+
+def write_benchmarks(db, args, rng):
+    """RoboAdam writes to time, by name"""
+    submissions = generate_submissions(db.challenge, args.users, args.submissions, args.skew, rng)
+    return {
+        'insert_submitted_data': lambda: db.insert_submitted_data(next(submissions)),
+        'insert_submissions_bulk (100)': lambda: db.insert_submissions_bulk([next(submissions) for _ in range(100)]),
+    }
+
+
+def callback_request(dash_app, output_id, inputs, state=()):
+    """Body of a Dash callback request, inputs and state given as (id, property, value)"""
+    callback = next(key for key in dash_app.callback_map if f"..{output_id}." in key)
+    outputs = callback.strip(".").split("...")
+
+    def props(items):
+        return [{'id': item_id, 'property': prop, 'value': value} for item_id, prop, value in items]
+
+    return {
+        'output': callback,
+        'outputs': [{'id': output.rsplit(".", 1)[0], 'property': output.rsplit(".", 1)[1]} for output in outputs],
+        'inputs': props(inputs),
+        'state': props(state),
+        'changedPropIds': [f"{inputs[0][0]}.{inputs[0][1]}"],
+    }
+
+
+def app_benchmarks(db, journal_directory, rng):
+    """The layout and callbacks to time through the Flask test client, by name"""
+    import app  # only needed here, importing it builds the default site as well
+
+    application = app.Application(
+        db.challenge, db=db, journal_directory=journal_directory, snapshot_directory=journal_directory)
+    client = app.Site([application]).server.test_client()
+    hills = list(db.challenge.catalog)
+
+    def post(body):
+        response = client.post("/_dash-update-component", json=body)
+        if response.status_code != 200:
+            raise RuntimeError(f"Callback failed with {response.status_code}: {response.get_data(as_text=True)[:500]}")
+
+    def submit():
+        hill = rng.choice(hills)
+        post(callback_request(application._app, "output-container", [('submit-button', 'n_clicks', 1)], [
+            ('name', 'value', "Benchmark Participant"),
+            ('email', 'value', "benchmark@example.com"),
+            ('location-dropdown', 'value', hill.name),
+            ('num-repetitions', 'value', rng.randint(1, 20)),
+            ('optional-link', 'value', None),
+            ('submission-key', 'data', f"benchmark-{rng.getrandbits(64):016x}"),
+        ]))
+
+    def leaderboard_page():
+        post(callback_request(application._app, "total-vertical-table", [
+            ('total-vertical-table', 'page_current', 1),
+            ('total-vertical-table', 'sort_by', []),
+            ('total-vertical-table', 'filter_query', ""),
+            ('leaderboard-version', 'data', None),
+        ], [('total-vertical-table', 'data', [])]))
+
+    def layout():
+        response = client.get("/_dash-layout")
+        if response.status_code != 200:
+            raise RuntimeError(f"Layout failed with {response.status_code}")
+
+    return {
+        'layout': layout,
+        'handle_submission_form': submit,
+        'serve_leaderboard_page (total_vertical, second page)': leaderboard_page,
+    }, application
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.realpath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, max_regression):
+    """Print median changes against a baseline run, returns the names that regressed"""
+    regressions = []
+    for name, timing in results['results'].items():
+        base = baseline['results'].get(name)
+        if base is None or not base['median_ms']:
+            print(f"{name:70} {timing['median_ms']:10.2f} ms  (new)")
+            continue
+        ratio = timing['median_ms'] / base['median_ms']
+        flag = ""
+        if ratio > max_regression:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:70} {timing['median_ms']:10.2f} ms  x{ratio:.2f}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    """Command line entry point for running the benchmarks"""
+    parser = argparse.ArgumentParser(description="Benchmark the RoboAdam queries and the Dash callbacks")
+    parser.add_argument("--users", type=int, default=1000, help="participants (default 1000)")
+    parser.add_argument("--hills", type=int, default=40, help="hills, beyond the real ones are synthetic (default 40)")
+    parser.add_argument("--submissions", type=int, default=10000, help="submissions to load (default 10000)")
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of hill and participant popularity (default 1.1)")
+    parser.add_argument("--repeats", type=int, default=20, help="timed runs of each benchmark (default 20)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the synthetic data")
+    parser.add_argument("--uri", default=BENCHMARK_URI, help="mongod to benchmark against (default $BENCHMARK_MONGODB_URI or localhost)")
+    parser.add_argument("--in-process", action="store_true", help="use mongomock instead of a mongod")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare against the results in this JSON file")
+    parser.add_argument("--max-regression", type=float, default=1.25,
+                        help="with --compare, exit 1 when a median grows by more than this factor (default 1.25)")
+    args = parser.parse_args(argv)
+
+    if args.in_process:
+        try:
+            import mongomock
+        except ImportError:
+            parser.error("--in-process needs mongomock, pip install mongomock")
+        client = mongomock.MongoClient()
+        backend = f"mongomock {mongomock.__version__}"
+    else:
+        client = MongoClient(args.uri, server_api=ServerApi('1'))
+        backend = f"mongod {client.server_info()['version']}"
+
+    rng = random.Random(args.seed)
+    client.drop_database(BENCHMARK_DATABASE_NAME)
+    catalog = make_catalog(args.hills, rng)
+    db = robo_adam.RoboAdam(client=client, database_name=BENCHMARK_DATABASE_NAME, challenge=make_challenge(catalog))
+    db.ensure_indexes()
+
+    print(f"Loading {args.submissions} submissions from {args.users} participants at {len(catalog)} hills into {backend}")
+    load_seconds = load_submissions(db, args, rng)
+    print(f"Loaded in {load_seconds:.1f} s")
+
+    timings = {}
+    # Reads run against an empty query cache, so they measure the pipelines
+    for name, function in query_benchmarks(db).items():
+        timings[name] = summarize(time_call(function, args.repeats, setup=db.cache.invalidate))
+    timings['rebuild_rollups'] = summarize(time_call(db.rebuild_rollups, min(args.repeats, 3)))
+    for name, function in write_benchmarks(db, args, rng).items():
+        timings[name] = summarize(time_call(function, args.repeats))
+
+    with tempfile.TemporaryDirectory() as journal_directory:
+        benchmarks, application = app_benchmarks(db, journal_directory, rng)
+        for name, function in benchmarks.items():
+            timings[name] = summarize(time_call(function, args.repeats, setup=db.cache.invalidate))
+        # Let the write-behind queue finish before its journal directory goes away
+        while application.submission_queue.pending:
+            time.sleep(0.1)
+
+    results = {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'backend': backend,
+        'parameters': {
+            'users': args.users,
+            'hills': len(catalog),
+            'submissions': args.submissions,
+            'skew': args.skew,
+            'seed': args.seed,
+        },
+        'load_seconds': round(load_seconds, 3),
+        'results': timings,
+    }
+
+    if args.output:
+        with open(args.output, "w") as _file:
+            json.dump(results, _file, indent=2)
+        print(f"Wrote {args.output}")
+
+    if args.compare:
+        with open(args.compare) as _file:
+            baseline = json.load(_file)
+        if baseline['parameters'] != results['parameters'] or baseline['backend'] != results['backend']:
+            print("The baseline used different parameters or a different backend, ratios are not comparable")
+        if compare(results, baseline, args.max_regression):
+            sys.exit(1)
+    else:
+        for name, timing in timings.items():
+            print(f"{name:70} median {timing['median_ms']:10.2f} ms  p95 {timing['p95_ms']:10.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
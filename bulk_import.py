@@ -0,0 +1,161 @@
+"""
+Bulk submission import for group leaders
+
+Reads a CSV with one row per member entry, validates every row against the
+challenge's hill catalog and inserts the valid rows in a single unordered batch.
+
+CSV columns: name, email, location, repetitions and an optional strava_link.
+
+    python bulk_import.py members.csv [--challenge ID] [--batch-id ID] [--dry-run]
+
+Rows are keyed by their file and line number, so importing the same file
+again inserts nothing. A file is identified by a digest of its content, or
+by an explicit batch ID, so a corrected file imported under the same batch
+ID adds only the rows rejected before.
+"""
+
+import argparse
+import csv
+import hashlib
+import hmac
+import io
+import os
+import sys
+
+import flask
+
+import challenges
+import robo_adam
+import submission_queue
+
+REQUIRED_COLUMNS = ("name", "email", "location", "repetitions")
+
+# Uploads must send "Authorization: Bearer <token>", the endpoint is disabled without a token
+UPLOAD_TOKEN = os.getenv("BULK_UPLOAD_TOKEN")
+MAX_UPLOAD_BYTES = 5 * 1024 * 1024  # also caps every other request body, the largest is an upload
+
+
+def parse_submissions_csv(csv_file, challenge, batch_id):
+    """Validate CSV rows and build their submissions for a challenge, keyed by batch_id and line number
+
+    Returns the submissions for the valid rows and a list of {'row', 'message'}
+    errors, where row is the line number in the file.
+    """
+    catalog = challenge.catalog
+    reader = csv.DictReader(csv_file)
+    missing_columns = [column for column in REQUIRED_COLUMNS if column not in (reader.fieldnames or [])]
+    if missing_columns:
+        return [], [{'row': 1, 'message': f"Missing columns: {', '.join(missing_columns)}"}]
+
+    submissions = []
+    errors = []
+    for row_number, row in enumerate(reader, start=2):  # the header is line 1
+        name = (row["name"] or "").strip()
+        email = (row["email"] or "").strip()
+        location = (row["location"] or "").strip()
+        repetitions = (row["repetitions"] or "").strip()
+
+        # Same checks as the submission form
+        if not name:
+            errors.append({'row': row_number, 'message': "Missing name"})
+            continue
+        if "@" not in email:
+            errors.append({'row': row_number, 'message': f"Invalid e-mail: {email!r}"})
+            continue
+        if location not in catalog:
+            errors.append({'row': row_number, 'message': f"Unknown location: {location!r}"})
+            continue
+        if not repetitions.isdigit() or int(repetitions) <= 0:
+            errors.append({'row': row_number, 'message': f"Repetitions must be a positive integer: {repetitions!r}"})
+            continue
+
+        # Identical rows of a file are all kept, while importing the file again, at any time, is absorbed
+        key = robo_adam.content_key(challenge, "bulk", batch_id, row_number)
+        submissions.append(robo_adam.make_submission(
+            challenge, name, email, location, int(repetitions), catalog.vertical(location), (row.get("strava_link") or "").strip(), key
+        ))
+    return submissions, errors
+
+
+def import_submissions_csv(db, text, dry_run=False, batch_id=None):
+    """Validate a CSV's text and insert its valid rows into db's challenge, returning a report of what happened
+
+    batch_id identifies the file, a digest of its text by default.
+    """
+    if not batch_id:
+        batch_id = hashlib.sha256(text.encode()).hexdigest()
+    submissions, errors = parse_submissions_csv(io.StringIO(text, newline=""), db.challenge, batch_id)
+    inserted = duplicates = 0
+    if submissions and not dry_run:
+        result = db.insert_submissions_bulk(submissions)
+        inserted = result['inserted']
+        for error in result['errors']:
+            # Rows of the same file, or batch, imported before
+            if error['code'] == submission_queue.DUPLICATE_KEY_ERROR:
+                duplicates += 1
+            else:
+                errors.append({'row': None, 'message': error['message']})
+    return {'valid_rows': len(submissions), 'inserted': inserted, 'duplicates': duplicates, 'errors': errors}
+
+
+def register_upload_route(server, databases):
+    """Add the POST /api/submissions/bulk CSV upload endpoint to the Flask server
+
+    databases maps challenge IDs to their RoboAdam, ?challenge=<id> picks one and the default challenge is used without.
+    ?batch_id=<id> keys the rows by a batch ID instead of the file's content.
+    """
+    # Flask answers 413 to a Content-Length past the limit, and reads chunked bodies, which have none, no further
+    server.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
+
+    @server.route("/api/submissions/bulk", methods=["POST"])
+    def upload_submissions():
+        if not UPLOAD_TOKEN:
+            flask.abort(404)
+        authorization = flask.request.headers.get("Authorization", "")
+        if not hmac.compare_digest(authorization.encode(), f"Bearer {UPLOAD_TOKEN}".encode()):
+            flask.abort(401)
+        db = databases.get(flask.request.args.get("challenge", challenges.get_challenge().challenge_id))
+        if db is None:
+            flask.abort(404)
+
+        # Accept either a multipart "file" field or the CSV as the request body
+        upload = flask.request.files.get("file")
+        raw = upload.read() if upload else flask.request.get_data()
+        # Werkzeug cuts a streamed body off at MAX_CONTENT_LENGTH instead of refusing it
+        if len(raw) >= MAX_UPLOAD_BYTES:
+            flask.abort(413)
+        try:
+            text = raw.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            return flask.jsonify({'errors': [{'row': None, 'message': "The CSV must be UTF-8"}]}), 400
+
+        dry_run = flask.request.args.get("dry_run") in ("1", "true")
+        report = import_submissions_csv(db, text, dry_run=dry_run, batch_id=flask.request.args.get("batch_id"))
+        return flask.jsonify(report), 422 if report['errors'] else 200
+
+
+def main(argv=None):
+    """Command line entry point for importing a CSV"""
+    parser = argparse.ArgumentParser(description="Import Hill Yeah submissions from a CSV")
+    parser.add_argument("csv_path", help="CSV with name, email, location, repetitions and optional strava_link columns")
+    parser.add_argument("--challenge", help="challenge ID, the default challenge by default")
+    parser.add_argument("--batch-id", help="key the rows by this ID instead of the file's content")
+    parser.add_argument("--dry-run", action="store_true", help="only validate the rows")
+    args = parser.parse_args(argv)
+
+    db = robo_adam.RoboAdam(challenge=challenges.get_challenge(args.challenge))
+    with open(args.csv_path, newline="", encoding="utf-8-sig") as csv_file:
+        text = csv_file.read()
+    report = import_submissions_csv(db, text, dry_run=args.dry_run, batch_id=args.batch_id)
+
+    for error in report['errors']:
+        location = f"line {error['row']}" if error['row'] else "database"
+        print(f"{location}: {error['message']}")
+    print(f"{report['valid_rows']} valid rows, {report['inserted']} inserted, {report['duplicates']} already imported, "
+          f"{len(report['errors'])} errors")
+    if report['errors']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Challenge registry
+
+Each challenge has its own hill catalog, dates, time zone and leaderboards.
+They are listed in _data/challenges.json (or CHALLENGES_FILE) and loaded
+once per process, as are their catalogs. The default challenge is served
+at / and every other one at /<challenge id>/.
+
+    [{"id": "hill-yeah-2024", "name": "Hill Yeah", "city": "Los Angeles",
+      "timezone": "America/Los_Angeles", "start": "2024-11-01",
+      "end": "2024-11-25", "hill_data": "hill_data.json", "default": true}]
+
+end is the first day after the challenge. hill_data is relative to the
+challenges file. The optional "areas" and "running_groups" list the
+neighbourhoods the hills are in and the local running groups, for the rules.
+"""
+
+import functools
+import json
+import os
+import re
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+import hill_catalog
+
+CHALLENGES_FILE = Path(os.getenv(
+    "CHALLENGES_FILE", Path(os.path.dirname(os.path.realpath(__file__))) / "_data/challenges.json"))
+
+# Challenge IDs name URL paths and collections
+CHALLENGE_ID_PATTERN = re.compile(r"^[a-z0-9][a-z0-9-]{0,39}$")
+RESERVED_IDS = {"api", "assets", "images", "metrics", "healthz"}
+
+# Date windowed leaderboards, see Challenge.window
+LEADERBOARD_WINDOWS = ("today", "week", "challenge")
+
+
+class Challenge:
+
+    def __init__(self, challenge_id, name, start, end, timezone_name="America/Los_Angeles",
+                 hill_data_file=hill_catalog.HILL_DATA_FILE, city=None, areas=(), running_groups=(), default=False, catalog=None):
+        if not CHALLENGE_ID_PATTERN.match(challenge_id) or challenge_id in RESERVED_IDS:
+            raise ValueError(f"Invalid challenge ID {challenge_id!r}")
+        if end <= start:
+            raise ValueError(f"Challenge {challenge_id!r} ends before it starts")
+        self.challenge_id = challenge_id
+        self.name = name
+        self.city = city
+        self.areas = tuple(areas)  # neighbourhoods the hills are in
+        self.running_groups = tuple(running_groups)
+        self.start = start  # first day
+        self.end = end  # first day after the challenge
+        self.timezone = ZoneInfo(timezone_name)
+        self.hill_data_file = Path(hill_data_file)
+        self.default = default
+        self._catalog = catalog  # passed in, e.g. by the benchmarks, or loaded from hill_data_file
+
+    @property
+    def catalog(self):
+        """The challenge's hill catalog, loaded once per process"""
+        if self._catalog is None:
+            self._catalog = hill_catalog.get_catalog(self.hill_data_file)
+        return self._catalog
+
+    @property
+    def last_day(self):
+        return self.end - timedelta(days=1)
+
+    @property
+    def deadline(self):
+        """Submissions are closed from the start of the end day on, in the challenge's time"""
+        return datetime.combine(self.end, datetime.min.time(), tzinfo=self.timezone)
+
+    def day(self, moment=None):
+        """Midnight of the challenge's local calendar day at a moment (now by default)
+
+        Submissions' date and the daily rollups are keyed by it.
+        """
+        local = (moment or datetime.now(timezone.utc)).astimezone(self.timezone)
+        return datetime(local.year, local.month, local.day)
+
+    def window(self, window, today=None):
+        """First day and the day after the last of a window in LEADERBOARD_WINDOWS
+
+        "today", "week" (from Monday) or the whole "challenge", as day() midnights.
+        """
+        today = today or self.day()
+        if window == "today":
+            return today, today + timedelta(days=1)
+        if window == "week":
+            monday = today - timedelta(days=today.weekday())
+            return monday, monday + timedelta(days=7)
+        if window == "challenge":
+            return datetime.combine(self.start, datetime.min.time()), datetime.combine(self.end, datetime.min.time())
+        raise ValueError(f"Unknown leaderboard window {window!r}")
+
+    def collection_name(self, base_name):
+        """Name of this challenge's partition of a per-challenge collection, e.g. user_rollups.hill-yeah-2024"""
+        return f"{base_name}.{self.challenge_id}"
+
+    @classmethod
+    def from_dict(cls, item, directory):
+        return cls(
+            challenge_id=item['id'],
+            name=item['name'],
+            start=date.fromisoformat(item['start']),
+            end=date.fromisoformat(item['end']),
+            timezone_name=item.get('timezone', "America/Los_Angeles"),
+            hill_data_file=Path(directory) / item.get('hill_data', hill_catalog.HILL_DATA_FILE.name),
+            city=item.get('city'),
+            areas=item.get('areas', ()),
+            running_groups=item.get('running_groups', ()),
+            default=item.get('default', False),
+        )
+
+
+class ChallengeRegistry:
+
+    def __init__(self, challenges):
+        self.challenges = tuple(challenges)
+        self.by_id = {challenge.challenge_id: challenge for challenge in self.challenges}
+        if not self.challenges:
+            raise ValueError("No challenges configured")
+        if len(self.by_id) != len(self.challenges):
+            raise ValueError("Duplicate challenge IDs")
+
+        # DEFAULT_CHALLENGE picks the challenge served at /, otherwise the one marked default or the first
+        default_id = os.getenv("DEFAULT_CHALLENGE")
+        if default_id is None:
+            default_id = next((challenge.challenge_id for challenge in self.challenges if challenge.default),
+                              self.challenges[0].challenge_id)
+        if default_id not in self.by_id:
+            raise ValueError(f"Unknown default challenge {default_id!r}")
+        for challenge in self.challenges:
+            challenge.default = challenge.challenge_id == default_id
+        self.default = self.by_id[default_id]
+
+    @classmethod
+    def from_json(cls, file_path=CHALLENGES_FILE):
+        file_path = Path(file_path)
+        with open(file_path, "r") as _file:
+            data = json.load(_file)
+        return cls(Challenge.from_dict(item, file_path.parent) for item in data)
+
+    def __len__(self):
+        return len(self.challenges)
+
+    def __iter__(self):
+        return iter(self.challenges)
+
+    def get(self, challenge_id):
+        """Challenge for an ID, or None"""
+        return self.by_id.get(challenge_id)
+
+
+@functools.lru_cache(maxsize=None)
+def get_registry(file_path=CHALLENGES_FILE):
+    """The process-wide challenge registry, loaded on first use"""
+    return ChallengeRegistry.from_json(file_path)
+
+
+def get_challenge(challenge_id=None):
+    """A configured challenge, the default one without an ID"""
+    registry = get_registry()
+    if challenge_id is None:
+        return registry.default
+    challenge = registry.get(challenge_id)
+    if challenge is None:
+        raise KeyError(f"Unknown challenge {challenge_id!r}")
+    return challenge
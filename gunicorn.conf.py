@@ -0,0 +1,24 @@
+"""
+gunicorn settings, read from the working directory by `gunicorn app:server`
+
+Every worker creates its own MongoDB client and background threads after
+the fork, so the app can be preloaded (--preload) to share its memory.
+
+Set PROMETHEUS_MULTIPROC_DIR to an empty directory so /metrics adds up
+every worker's metrics.
+"""
+
+import os
+
+
+def post_fork(server, worker):
+    # Open this worker's connection pool and start its submission writer before it takes requests
+    import app
+    app.site.start_background_work()
+
+
+def child_exit(server, worker):
+    # Stop reporting the exited worker's live metrics
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,153 @@
+"""
+Indexed hill catalog
+
+Loads _data/hill_data.json once per process into compact Hill records with
+a name index, so lookups stay O(1) however many hills the challenge has.
+The dropdown options, table rows, map features and a spatial index of the
+hills are derived once here and shared by the layout, the callbacks and the
+hill endpoints.
+"""
+
+import bisect
+import functools
+import hashlib
+import html
+import json
+import os
+from pathlib import Path
+
+import spatial_index
+
+HILL_DATA_FILE = Path(os.path.dirname(os.path.realpath(__file__))) / Path("_data/hill_data.json")
+
+# Used when the catalog is empty
+DEFAULT_CENTER = (34.0522, -118.2437)
+
+
+class Hill:
+
+    __slots__ = ("location_id", "name", "description", "length", "vertical", "strava_link", "lat", "lon")
+
+    def __init__(self, location_id, name, description, length, vertical, strava_link, lat, lon):
+        self.location_id = location_id
+        self.name = name
+        self.description = description
+        self.length = length
+        self.vertical = vertical
+        self.strava_link = strava_link
+        self.lat = lat
+        self.lon = lon
+
+    @property
+    def google_maps_link(self):
+        return f"https://www.google.com/maps?q={self.lat}, {self.lon}"
+
+
+def hill_feature(hill):
+    """A hill as a GeoJSON point, with the tooltip and popup the map layer binds"""
+    return {
+        'type': "Feature",
+        'geometry': {'type': "Point", 'coordinates': [hill.lon, hill.lat]},
+        'properties': {
+            'name': hill.name,
+            'tooltip': html.escape(hill.name),
+            'popup': (f'<a href="{html.escape(hill.google_maps_link)}" target="_blank" '
+                      'style="color: blue; text-decoration: underline">Open in Google Maps</a>'),
+        },
+    }
+
+
+class HillCatalog:
+
+    def __init__(self, hills):
+        self.hills = tuple(hills)
+        self.by_name = {hill.name: hill for hill in self.hills}
+        self.by_location_id = {hill.location_id: hill for hill in self.hills}
+
+        # Everything the layout needs, derived once
+        self.dropdown_options = [{'label': hill.name, 'value': hill.name} for hill in self.hills]
+        self.table_rows = [
+            (hill.name, hill.description, hill.length, hill.vertical, hill.strava_link) for hill in self.hills
+        ]
+        # GeoJSON points for the map layer, sorted by longitude so viewport queries bisect
+        self.features = [hill_feature(hill) for hill in sorted(self.hills, key=lambda hill: hill.lon)]
+        self.feature_lons = [feature['geometry']['coordinates'][0] for feature in self.features]
+        self.features_version = hashlib.sha1(
+            json.dumps(self.features, sort_keys=True).encode()).hexdigest()[:12]
+        # Nearest hills to a point, see nearest
+        self.spatial_index = spatial_index.SpatialIndex((hill.lat, hill.lon, hill) for hill in self.hills)
+        if self.hills:
+            self.center = (
+                sum(hill.lat for hill in self.hills) / len(self.hills),
+                sum(hill.lon for hill in self.hills) / len(self.hills),
+            )
+        else:
+            self.center = DEFAULT_CENTER
+
+    @classmethod
+    def from_json(cls, file_path=HILL_DATA_FILE):
+        """Build a catalog from a hill data json file
+
+        Location IDs come from an "id" field when a hill has one, otherwise from
+        its 1-based position in the file, so append new hills at the end.
+        """
+        with open(file_path, "r") as _file:
+            data = json.load(_file)
+        return cls(
+            Hill(
+                location_id=item.get('id', position),
+                name=item['name'],
+                description=item.get('description', 'N/A'),
+                length=item.get('length', 'N/A'),
+                vertical=item.get('vertical', 'N/A'),
+                strava_link=item.get('strava_link', '#'),
+                lat=item['lat'],
+                lon=item['lon'],
+            )
+            for position, item in enumerate(data, start=1)
+        )
+
+    def __len__(self):
+        return len(self.hills)
+
+    def __iter__(self):
+        return iter(self.hills)
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def get(self, name):
+        """Hill for a name, or None"""
+        return self.by_name.get(name)
+
+    def features_in(self, west, south, east, north):
+        """Map features inside a bounding box in degrees, west may be east of east across the antimeridian"""
+        if east - west >= 360:
+            lon_ranges = [(-180, 180)]
+        else:
+            west = (west + 180) % 360 - 180
+            east = (east + 180) % 360 - 180
+            lon_ranges = [(west, east)] if west <= east else [(west, 180), (-180, east)]
+
+        features = []
+        for range_west, range_east in lon_ranges:
+            start = bisect.bisect_left(self.feature_lons, range_west)
+            end = bisect.bisect_right(self.feature_lons, range_east)
+            features.extend(feature for feature in self.features[start:end]
+                            if south <= feature['geometry']['coordinates'][1] <= north)
+        return features
+
+    def nearest(self, lat, lon, k=1, radius_km=None):
+        """Up to k (distance_km, Hill) closest to a point, optionally only those within radius_km"""
+        return self.spatial_index.nearest(lat, lon, k, radius_km)
+
+    def vertical(self, name):
+        """Vertical feet of the hill with this name, or None"""
+        hill = self.by_name.get(name)
+        return hill.vertical if hill is not None else None
+
+
+@functools.lru_cache(maxsize=None)
+def get_catalog(file_path=HILL_DATA_FILE):
+    """The process-wide catalog for a hill data file, loaded on first use"""
+    return HillCatalog.from_json(file_path)
@@ -0,0 +1,124 @@
+"""
+Hill map layer and nearest hill endpoints
+
+The map shows the hills through one clustered GeoJSON layer instead of a
+marker component per hill in the layout. Its features are derived once per
+catalog (HillCatalog.features) and served here per viewport: the browser
+asks for the hills inside its map bounds, snapped outward to a
+BBOX_GRID_DEGREES grid so panning around reuses cached responses. The
+map only reports its bounds once moved, so the page starts with the whole
+catalog.
+
+    GET /api/hills.geojson?challenge=<id>&bbox=<west>,<south>,<east>,<north>&v=<version>
+
+The default challenge is used without challenge and the whole catalog
+without bbox. v is the catalog's features_version, responses asking for
+the current one are cached by browsers for a year.
+
+The hills closest to a point, from the catalog's spatial index, for
+clients that want them without the whole catalog:
+
+    GET /api/hills/nearest?challenge=<id>&lat=<lat>&lon=<lon>[&k=<count>][&radius_km=<km>]
+"""
+
+import functools
+import json
+import math
+
+import flask
+
+import challenges
+
+ROUTE = "/api/hills.geojson"
+NEAREST_ROUTE = "/api/hills/nearest"
+MIMETYPE = "application/geo+json"
+
+# Viewport bounds are snapped outward to this grid, in degrees
+BBOX_GRID_DEGREES = 0.5
+# Serialized responses kept per process, by catalog and bounding box
+RESPONSE_CACHE_SIZE = 256
+# Hills returned by the nearest endpoint, by default and at most
+NEAREST_DEFAULT = 5
+NEAREST_MAX = 50
+
+
+def snap_bbox(west, south, east, north, grid=BBOX_GRID_DEGREES):
+    """A bounding box grown outward to the grid"""
+    return (math.floor(west / grid) * grid, max(math.floor(south / grid) * grid, -90),
+            math.ceil(east / grid) * grid, min(math.ceil(north / grid) * grid, 90))
+
+
+def parse_bbox(value):
+    """(west, south, east, north) from "west,south,east,north", ValueError when it isn't one"""
+    west, south, east, north = (float(part) for part in value.split(","))
+    if not all(math.isfinite(part) for part in (west, south, east, north)) or south > north or west > east:
+        raise ValueError(f"Invalid bounding box {value!r}")
+    return west, south, east, north
+
+
+def format_bbox(bbox):
+    return ",".join(f"{part:g}" for part in bbox)
+
+
+@functools.lru_cache(maxsize=RESPONSE_CACHE_SIZE)
+def feature_collection(catalog, bbox=None):
+    """The catalog's features, or those inside bbox, as a serialized FeatureCollection"""
+    features = catalog.features if bbox is None else catalog.features_in(*bbox)
+    return json.dumps({'type': "FeatureCollection", 'features': features}, separators=(",", ":"))
+
+
+def url(challenge):
+    """URL of a challenge's map features, versioned by the catalog, the browser adds &bbox="""
+    return f"{ROUTE}?challenge={challenge.challenge_id}&v={challenge.catalog.features_version}"
+
+
+def parse_point(args):
+    """(lat, lon, k, radius_km) from the nearest endpoint's query, ValueError when they aren't valid"""
+    lat, lon = float(args["lat"]), float(args["lon"])
+    k = int(args.get("k", NEAREST_DEFAULT))
+    radius_km = float(args["radius_km"]) if "radius_km" in args else None
+    if not (-90 <= lat <= 90 and math.isfinite(lon) and 1 <= k <= NEAREST_MAX):
+        raise ValueError("Invalid point or count")
+    if radius_km is not None and not radius_km >= 0:
+        raise ValueError("Invalid radius")
+    return lat, lon, k, radius_km
+
+
+def register_routes(server, catalogs):
+    """Add the map features and nearest hill endpoints, catalogs maps challenge IDs to their hill catalog"""
+    def requested_catalog():
+        catalog = catalogs.get(flask.request.args.get("challenge", challenges.get_challenge().challenge_id))
+        if catalog is None:
+            flask.abort(404)
+        return catalog
+
+    @server.route(ROUTE)
+    def hill_features():
+        catalog = requested_catalog()
+        bbox = None
+        if "bbox" in flask.request.args:
+            try:
+                bbox = snap_bbox(*parse_bbox(flask.request.args["bbox"]))
+            except ValueError:
+                flask.abort(400)
+
+        response = flask.Response(feature_collection(catalog, bbox), mimetype=MIMETYPE)
+        response.set_etag(f"{catalog.features_version}-{format_bbox(bbox) if bbox else 'all'}")
+        if flask.request.args.get("v") == catalog.features_version:
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            response.headers["Cache-Control"] = "no-cache"
+        return response.make_conditional(flask.request)
+
+    @server.route(NEAREST_ROUTE)
+    def nearest_hills():
+        catalog = requested_catalog()
+        try:
+            lat, lon, k, radius_km = parse_point(flask.request.args)
+        except (KeyError, ValueError):
+            flask.abort(400)
+        return flask.jsonify({'hills': [
+            {'name': hill.name, 'location_id': hill.location_id, 'lat': hill.lat, 'lon': hill.lon,
+             'distance_km': round(distance_km, 3)}
+            for distance_km, hill in catalog.nearest(lat, lon, k, radius_km)
+        ]})
@@ -0,0 +1,110 @@
+"""
+HTTP compression and caching for the Dash server
+
+Responses are compressed with brotli or gzip. GET responses carry ETags:
+- each Dash app's layout's comes from the static layout hash and the leaderboard data
+  version, so it is answered with a 304 without building the layout;
+- assets' come from the file content;
+- the hill map features set their own, from the catalog (see hill_map);
+- other pages (the index, callback dependencies) hash their body.
+Everything revalidates with no-cache except assets Dash fingerprints with
+a ?m= query, which are cached for a year.
+"""
+
+import hashlib
+from pathlib import Path
+
+import flask
+from flask_compress import Compress
+
+# Under each Dash app's url_base_pathname
+LAYOUT_ROUTE = "_dash-layout"
+ASSETS_ROUTE = "assets/"
+ETAG_MIMETYPES = {"text/html", "application/json"}
+# What this server sends that is worth compressing, Flask-Compress's defaults lack GeoJSON
+COMPRESS_MIMETYPES = [
+    "text/html", "text/css", "text/plain", "text/javascript", "application/javascript",
+    "application/json", "application/geo+json", "image/svg+xml",
+]
+
+_asset_digests = {}  # asset path -> (mtime, size, digest)
+
+
+def etag_matches(etag, if_none_match):
+    """True when If-None-Match names etag, ignoring the compression suffix Flask-Compress adds"""
+    return any(tag.split(":")[0] == etag for tag in if_none_match.as_set()) or if_none_match.star_tag
+
+
+def asset_digest(asset_path):
+    """Content hash of an asset file, recomputed only when the file changes"""
+    stat = asset_path.stat()
+    cached = _asset_digests.get(asset_path)
+    if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+        return cached[2]
+    digest = hashlib.sha1(asset_path.read_bytes()).hexdigest()[:16]
+    _asset_digests[asset_path] = (stat.st_mtime, stat.st_size, digest)
+    return digest
+
+
+def install(server, layout_etags, assets_folder):
+    """Add compression and ETag handling to a Flask server
+
+    layout_etags maps the layout path of every Dash app on the server, e.g. "/_dash-layout",
+    to a function called per layout request that returns the layout's current ETag, or None.
+    """
+    server.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+    server.config["COMPRESS_MIMETYPES"] = COMPRESS_MIMETYPES
+    server.config["COMPRESS_BR_LEVEL"] = 4  # fast enough to compress callback responses per request
+    Compress(server)
+
+    assets_root = Path(assets_folder).resolve()
+    assets_prefixes = tuple(layout_path[:-len(LAYOUT_ROUTE)] + ASSETS_ROUTE for layout_path in layout_etags)
+
+    def asset_path():
+        prefix = next(prefix for prefix in assets_prefixes if flask.request.path.startswith(prefix))
+        path = (assets_root / flask.request.path[len(prefix):]).resolve()
+        if assets_root in path.parents and path.is_file():
+            return path
+        return None
+
+    @server.before_request
+    def answer_not_modified():
+        if flask.request.method != "GET":
+            return None
+        if flask.request.path in layout_etags:
+            flask.g.etag = layout_etags[flask.request.path]()
+        elif flask.request.path.startswith(assets_prefixes):
+            path = asset_path()
+            if path is None:
+                return None
+            flask.g.etag = asset_digest(path)
+        else:
+            return None
+
+        if flask.g.etag and etag_matches(flask.g.etag, flask.request.if_none_match):
+            response = flask.Response(status=304)
+            response.set_etag(flask.g.etag)
+            response.headers["Cache-Control"] = "no-cache"
+            return response
+        return None
+
+    # Registered after Compress so it runs first, Compress then keeps the ETag on the compressed body
+    @server.after_request
+    def add_caching_headers(response):
+        if flask.request.method != "GET" or response.status_code != 200:
+            return response
+
+        etag = flask.g.get("etag")
+        if etag:
+            response.set_etag(etag)
+        elif response.mimetype in ETAG_MIMETYPES and not response.direct_passthrough:
+            response.add_etag()
+            response.make_conditional(flask.request)
+        else:
+            return response
+
+        if flask.request.path.startswith(assets_prefixes) and "m" in flask.request.args:
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            response.headers["Cache-Control"] = "no-cache"
+        return response
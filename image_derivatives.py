@@ -0,0 +1,122 @@
+"""
+Responsive image derivatives for the assets folder
+
+The photos in assets/ are several MB each but are shown at most 250px wide.
+This builds resized WebP and JPEG variants with content-hashed file names,
+caches them on disk and serves them with long-lived cache headers.
+Derivatives are built ahead of time by running this module (the Heroku
+build runs it from bin/post_compile) and on demand for any that are missing.
+
+    python image_derivatives.py
+"""
+
+import hashlib
+import os
+import re
+import threading
+from pathlib import Path
+
+import flask
+from PIL import Image, ImageOps
+
+ROOT_DIRECTORY = Path(os.path.dirname(os.path.realpath(__file__)))
+SOURCE_DIRECTORY = ROOT_DIRECTORY / "assets"
+CACHE_DIRECTORY = Path(os.getenv("DERIVED_IMAGE_DIR", ROOT_DIRECTORY / "_derived_images"))
+SOURCE_PATTERN = "hill_yeah_img*.jpg"
+URL_PREFIX = "/images"
+
+# 1x and 2x of the 250px the images are displayed at
+WIDTHS = (250, 500)
+FORMATS = {"webp": "WEBP", "jpg": "JPEG"}
+QUALITY = 80
+
+DERIVATIVE_NAME = re.compile(r"^(?P<stem>[\w-]+)-(?P<digest>[0-9a-f]{12})-(?P<width>\d+)w\.(?P<extension>webp|jpg)$")
+
+_digests = {}  # source path -> (mtime, size, digest)
+_build_lock = threading.Lock()
+
+
+def source_digest(source_path):
+    """Content hash of a source image, recomputed only when the file changes"""
+    stat = source_path.stat()
+    cached = _digests.get(source_path)
+    if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+        return cached[2]
+    digest = hashlib.sha256(source_path.read_bytes()).hexdigest()[:12]
+    _digests[source_path] = (stat.st_mtime, stat.st_size, digest)
+    return digest
+
+
+def derivative_name(source_path, width, extension):
+    return f"{source_path.stem}-{source_digest(source_path)}-{width}w.{extension}"
+
+
+def build_derivative(source_path, width, extension):
+    """Resize a source image into the cache, returning the derivative's path"""
+    target_path = CACHE_DIRECTORY / derivative_name(source_path, width, extension)
+    if target_path.exists():
+        return target_path
+
+    with _build_lock:
+        if target_path.exists():
+            return target_path
+        CACHE_DIRECTORY.mkdir(parents=True, exist_ok=True)
+        with Image.open(source_path) as image:
+            image = ImageOps.exif_transpose(image).convert("RGB")
+            image.thumbnail((width, width * 4))  # never upscales
+            temporary_path = target_path.with_suffix(".tmp")
+            options = {"method": 6} if extension == "webp" else {"optimize": True, "progressive": True}
+            image.save(temporary_path, FORMATS[extension], quality=QUALITY, **options)
+        os.replace(temporary_path, target_path)
+    return target_path
+
+
+def build_all():
+    """Build every derivative of every source image, returns how many exist"""
+    built = 0
+    for source_path in sorted(SOURCE_DIRECTORY.glob(SOURCE_PATTERN)):
+        for width in WIDTHS:
+            for extension in FORMATS:
+                build_derivative(source_path, width, extension)
+                built += 1
+    return built
+
+
+def srcsets(image_path):
+    """srcset strings for an /assets image, or None when the source doesn't exist
+
+    Returns a dict with "webp" and "jpg" srcsets and the smallest JPEG as "fallback".
+    """
+    source_path = SOURCE_DIRECTORY / Path(image_path).name
+    if not source_path.is_file():
+        return None
+    result = {}
+    for extension in FORMATS:
+        result[extension] = ", ".join(
+            f"{URL_PREFIX}/{derivative_name(source_path, width, extension)} {width}w" for width in WIDTHS
+        )
+    result["fallback"] = f"{URL_PREFIX}/{derivative_name(source_path, WIDTHS[0], 'jpg')}"
+    return result
+
+
+def register_route(server):
+    """Serve derivatives from the cache, building any that are missing"""
+    @server.route(f"{URL_PREFIX}/<filename>")
+    def derived_image(filename):
+        match = DERIVATIVE_NAME.match(filename)
+        if match is None or int(match["width"]) not in WIDTHS:
+            flask.abort(404)
+        source_path = SOURCE_DIRECTORY / f"{match['stem']}.jpg"
+        # Only the current content hash is served, old ones were replaced
+        if not source_path.is_file() or source_digest(source_path) != match["digest"]:
+            flask.abort(404)
+
+        target_path = build_derivative(source_path, int(match["width"]), match["extension"])
+        response = flask.send_file(target_path, mimetype=f"image/{'webp' if match['extension'] == 'webp' else 'jpeg'}")
+        # Content-hashed names never change content
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+
+if __name__ == "__main__":
+    print(f"{build_all()} image derivatives in {CACHE_DIRECTORY}")
@@ -0,0 +1,222 @@
+"""
+Leaderboard snapshot files, served when MongoDB is slow or unreachable
+
+A snapshot holds a challenge's Resource Portal snapshot, every leaderboard
+in full and the windowed leaderboards, as gzipped JSON named by when it was
+taken and a hash of its content, in a directory per challenge. The app starts from the latest one instead of
+empty leaderboards and falls back to it whenever the database fails.
+
+Snapshots are written by one worker of the app every SNAPSHOT_INTERVAL
+seconds, and by the Heroku build (bin/post_compile) so a fresh dyno has
+one before it reaches the database:
+
+    python leaderboard_snapshot.py [--challenge ID] [--directory DIR] [--keep N]
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import operator
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from pymongo.errors import PyMongoError
+
+import challenges
+import robo_adam
+
+try:
+    import fcntl
+except ImportError:  # Windows, every process writes snapshots
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIRECTORY = Path(os.getenv(
+    "LEADERBOARD_SNAPSHOT_DIR", Path(os.path.dirname(os.path.realpath(__file__))) / "_snapshots"))
+SNAPSHOT_INTERVAL = float(os.getenv("LEADERBOARD_SNAPSHOT_SECONDS", "300"))  # seconds between snapshots
+SNAPSHOTS_KEPT = 5
+SNAPSHOT_MAX_ROWS = 10000  # rows kept of each leaderboard
+SNAPSHOT_FORMAT = 1  # bumped when the content changes shape, older files are ignored
+
+SNAPSHOT_PATTERN = "leaderboards-*.json.gz"
+COMPARISONS = {'$eq': operator.eq, '$ne': operator.ne, '$lt': operator.lt,
+               '$lte': operator.le, '$gt': operator.gt, '$gte': operator.ge}
+
+_latest = {}  # directory -> (path, snapshot) of the last snapshot read
+
+
+def take_snapshot(db):
+    """Read everything a snapshot holds from the database"""
+    portal = db.get_portal_snapshot()
+    leaderboards = {}
+    for leaderboard in robo_adam.LEADERBOARDS:
+        row_count = min(portal['row_counts'][leaderboard], SNAPSHOT_MAX_ROWS)
+        leaderboards[leaderboard] = db.get_leaderboard_page(leaderboard, 0, max(row_count, 1))['rows']
+    windows = {}
+    for window in challenges.LEADERBOARD_WINDOWS:
+        start, end = db.challenge.window(window)
+        windows[window] = {'start': start.isoformat(), 'end': end.isoformat(), 'rows': db.get_window_leaderboard(start, end)}
+    return {'format': SNAPSHOT_FORMAT, 'portal': portal, 'leaderboards': leaderboards, 'windows': windows}
+
+
+def challenge_directory(challenge, root=SNAPSHOT_DIRECTORY):
+    """Where a challenge's snapshots are kept"""
+    return Path(root) / challenge.challenge_id
+
+
+def write_snapshot(db, directory, keep=SNAPSHOTS_KEPT):
+    """Write a snapshot file unless the latest one has the same content, returns its path"""
+    snapshot = take_snapshot(db)
+    content = json.dumps(snapshot, sort_keys=True, separators=(",", ":"), default=str)
+    digest = hashlib.sha1(content.encode()).hexdigest()[:12]
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    existing = sorted(directory.glob(SNAPSHOT_PATTERN))
+    if existing and existing[-1].name.endswith(f"-{digest}.json.gz"):
+        return existing[-1]
+
+    created_at = datetime.now(timezone.utc)
+    snapshot['created_at'] = created_at.isoformat()
+    path = directory / f"leaderboards-{created_at:%Y%m%dT%H%M%S%fZ}-{digest}.json.gz"
+    temporary_path = path.with_suffix(".tmp")
+    with gzip.open(temporary_path, "wt", encoding="utf-8") as snapshot_file:
+        json.dump(snapshot, snapshot_file, separators=(",", ":"), default=str)
+    os.replace(temporary_path, path)
+
+    for old_path in existing[:max(len(existing) + 1 - keep, 0)]:
+        old_path.unlink(missing_ok=True)
+    return path
+
+
+def latest_snapshot(directory):
+    """The newest readable snapshot, with created_at as a datetime, or None when there is none
+
+    Files are only read when a newer one appeared, returned snapshots must not be mutated.
+    """
+    directory = Path(directory)
+    latest_path, latest = _latest.get(directory, (None, None))
+    for path in sorted(directory.glob(SNAPSHOT_PATTERN), reverse=True):
+        if path == latest_path:
+            return latest
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except (OSError, ValueError):
+            logger.exception("Skipping unreadable leaderboard snapshot %s", path)
+            continue
+        if snapshot.get('format') != SNAPSHOT_FORMAT:
+            continue
+        snapshot['created_at'] = datetime.fromisoformat(snapshot['created_at'])
+        _latest[directory] = (path, snapshot)
+        return snapshot
+    return None
+
+
+def row_matches(row, filters):
+    """Whether a leaderboard row passes filters given as (column, operator, value)"""
+    for column, comparison, value in filters:
+        cell = row.get(column)
+        if comparison == 'contains':
+            if str(value).lower() not in str(cell).lower():
+                return False
+            continue
+        try:
+            if not COMPARISONS[comparison](cell, value):
+                return False
+        except TypeError:  # e.g. a number compared to text
+            return False
+    return True
+
+
+def snapshot_page(snapshot, leaderboard, skip, limit, sort=(), filters=()):
+    """A page of a snapshot's leaderboard, like RoboAdam.get_leaderboard_page"""
+    rows = [row for row in snapshot['leaderboards'][leaderboard] if row_matches(row, filters)]
+    # The rows are in the default order, stable sorts from the last key apply the rest
+    for column, direction in reversed(sort):
+        rows.sort(key=lambda row: (row.get(column) is None, row.get(column)), reverse=direction == robo_adam.DESCENDING)
+    return {'rows': rows[skip:skip + limit], 'total': len(rows)}
+
+
+def snapshot_window(snapshot, start, end):
+    """A snapshot's windowed leaderboard rows for the day range, empty when it holds another range"""
+    window = next((window for window in snapshot['windows'].values()
+                   if (window['start'], window['end']) == (start.isoformat(), end.isoformat())), None)
+    return window['rows'] if window else []
+
+
+def describe_age(created_at, now=None):
+    """How long ago a snapshot was taken, e.g. "5 minutes" """
+    seconds = max(((now or datetime.now(timezone.utc)) - created_at).total_seconds(), 0)
+    for unit, unit_seconds in (("day", 86400), ("hour", 3600), ("minute", 60)):
+        if seconds >= unit_seconds:
+            count = int(seconds // unit_seconds)
+            return f"{count} {unit}{'s' if count != 1 else ''}"
+    return "less than a minute"
+
+
+class SnapshotWriter:
+    """Writes a snapshot every SNAPSHOT_INTERVAL seconds from one process of those sharing the directory"""
+
+    def __init__(self, db, directory, interval=SNAPSHOT_INTERVAL):
+        self.db = db
+        self.directory = Path(directory)
+        self.interval = interval
+        self._lock_file = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="snapshot-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        # The worker holding the lock writes, the others wait in case it exits
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock_file = open(self.directory / ".writer.lock", "a")
+        while fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                time.sleep(self.interval)
+
+        while True:
+            try:
+                write_snapshot(self.db, self.directory)
+            except (PyMongoError, OSError):
+                logger.exception("Could not write a leaderboard snapshot")
+            time.sleep(self.interval)
+
+
+def main(argv=None):
+    """Command line entry point for writing snapshots"""
+    parser = argparse.ArgumentParser(description="Write the current leaderboards to snapshot files")
+    parser.add_argument("--challenge", help="challenge ID, every challenge by default")
+    parser.add_argument("--directory", default=SNAPSHOT_DIRECTORY, help="where snapshots are kept, a directory per challenge")
+    parser.add_argument("--keep", type=int, default=SNAPSHOTS_KEPT, help="number of snapshots kept per challenge")
+    args = parser.parse_args(argv)
+
+    if args.challenge is not None:
+        selected = [challenges.get_challenge(args.challenge)]
+    else:
+        selected = list(challenges.get_registry())
+    try:
+        for challenge in selected:
+            path = write_snapshot(robo_adam.RoboAdam(challenge=challenge), challenge_directory(challenge, args.directory), args.keep)
+            print(f"Leaderboard snapshot {path}")
+    except PyMongoError as error:
+        print(f"Could not read the leaderboards: {error}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Server-side watcher that reloads the leaderboards once per database write
+
+One thread per process follows a change stream on the submissions and the
+rollups, waits for the burst of writes a submission makes to settle, then
+reloads the leaderboards once however many browsers are viewing them.
+Browsers pick up the new leaderboard version with a cheap poll that
+answers 204 until it changes.
+
+Change streams need a replica set or sharded cluster, a local single-node
+replica set is enough for development:
+
+    mongod --replSet rs0 --dbpath /tmp/rs0
+    mongosh --eval "rs.initiate()"
+
+Against a standalone server, or a client without change streams such as
+mongomock, it polls a cheap marker of the submissions and rollups instead.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from pymongo.errors import OperationFailure
+
+import metrics
+import robo_adam
+
+logger = logging.getLogger(__name__)
+
+# A burst of writes has settled once the stream is quiet this long
+SETTLE_MS = 500
+# Reload at least this often during a continuous stream of writes
+MAX_SETTLE_SECONDS = 2
+# Seconds between reconnects after the stream failed
+RETRY_SECONDS = 5
+# Seconds between polls of the submissions when change streams aren't available
+POLL_SECONDS = float(os.getenv("LEADERBOARD_POLL_SECONDS", "5"))
+
+CHANGE_STREAM_HISTORY_LOST = 286  # the resume token fell off the oplog
+
+
+class LeaderboardWatcher:
+
+    def __init__(self, db, on_change):
+        self.db = db
+        self.on_change = on_change  # reloads the leaderboards, called from the watcher thread
+        self.mode = None  # "change_stream" or "poll" once it is running
+        self.current = False  # True while the leaderboards are reloaded on every write
+        self._resume_token = None
+        self._marker = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the watcher thread"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="leaderboard-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the watcher thread, waiting up to timeout seconds for it to exit"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.mode == "poll":
+                    self.poll()
+                else:
+                    self.follow_change_stream()
+            except robo_adam.ChangeStreamsNotSupported:
+                logger.warning("Change streams are not supported, polling for submissions every %s s", POLL_SECONDS)
+                self.mode = "poll"
+            except OperationFailure as error:
+                if error.code == CHANGE_STREAM_HISTORY_LOST:
+                    logger.warning("Leaderboard change stream can't resume, reopening it")
+                    self._resume_token = None
+                else:
+                    self.wait_to_retry()
+            except Exception:  # PyMongoError, or e.g. on_change failing, the thread must survive either
+                self.wait_to_retry()
+
+    def wait_to_retry(self):
+        logger.exception("Leaderboard watcher failed, retrying in %s s", RETRY_SECONDS)
+        self.current = False  # requests load the leaderboards themselves meanwhile
+        self._stop.wait(RETRY_SECONDS)
+
+    def follow_change_stream(self):
+        """Reload the leaderboards after every settled burst of changes, until stopped"""
+        with self.db.watch_leaderboard_changes(self._resume_token, max_await_time_ms=SETTLE_MS) as stream:
+            self.mode = "change_stream"
+            # Catch up on changes made before the stream opened or while it was down
+            self.reload()
+            self.current = True
+            while not self._stop.is_set() and stream.alive:
+                change = stream.try_next()
+                self._resume_token = stream.resume_token
+                if change is None:
+                    continue
+
+                # A submission writes the submissions and then every rollup, reload once they are all in
+                settle_until = time.monotonic() + MAX_SETTLE_SECONDS
+                while time.monotonic() < settle_until and stream.try_next() is not None:
+                    pass
+                self._resume_token = stream.resume_token
+                self.reload()
+
+    def poll(self):
+        """Reload the leaderboards when the submissions changed since the last poll"""
+        marker = self.db.get_change_marker()
+        if marker != self._marker:
+            self.reload()
+            self._marker = marker
+        self.current = True
+        self._stop.wait(POLL_SECONDS)
+
+    def reload(self):
+        self.db.cache.invalidate()  # also drops results cached before another process's write
+        self.on_change()
+        metrics.LEADERBOARD_RELOADS.labels(self.mode).inc()
@@ -0,0 +1,282 @@
+"""
+Background verification of the links submitted with entries
+
+Participants can add a Strava activity link to a submission. Once the
+submission writer has inserted a batch, its links are queued here and a
+small pool of worker threads resolves each one, following redirects, and
+writes a link_status back to the submission:
+
+- verified: it answers at strava.com, e.g. a strava.app.link short link;
+- not_strava: it isn't on a Strava host, or redirects off one;
+- broken: it answers with a client error, e.g. a deleted activity;
+- invalid: it isn't an http(s) URL;
+- unreachable: a timeout, connection or server error, checked again by the next sweep.
+
+Only Strava hosts are fetched, other links are not_strava without a
+request, and neither they nor their redirects may resolve to a private,
+loopback or link-local address. Requests to one host are spaced HOST_INTERVAL seconds apart, and results
+are cached by URL, so a popular link is fetched once. The submission
+callback only ever journals the submission, and a full queue leaves links
+pending for the sweep, which also covers CSV imports:
+
+    python link_verifier.py [--challenge ID] [--limit N]
+
+The fetcher is pluggable, LinkVerifier(fetcher=...) takes any function
+of (url, timeout) returning (status code, final URL), e.g. one pointed at
+a local stub server.
+"""
+
+import argparse
+import collections
+import functools
+import ipaddress
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import urlsplit
+
+from pymongo.errors import PyMongoError
+
+import challenges
+import metrics
+import robo_adam
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.getenv("LINK_VERIFIER_WORKERS", "4"))  # concurrent link checks per process
+QUEUE_SIZE = 1000  # links waiting for a worker, more are left pending for the sweep
+FETCH_TIMEOUT = 10  # seconds per link, redirects included
+HOST_INTERVAL = 1.0  # seconds between requests to the same host
+CACHE_SIZE = 10000  # URLs whose result is remembered
+CACHE_SECONDS = 24 * 3600
+USER_AGENT = "HillYeahLinkVerifier/1.0"
+
+STRAVA_DOMAIN = "strava.com"
+# Hosts outside STRAVA_DOMAIN links are fetched from, Strava's short links
+STRAVA_LINK_HOSTS = ("strava.app.link",)
+
+VERIFIED = "verified"
+NOT_STRAVA = "not_strava"
+BROKEN = "broken"
+INVALID = "invalid"
+UNREACHABLE = robo_adam.LINK_STATUS_UNREACHABLE
+
+
+class BlockedAddress(urllib.error.URLError):
+    """A link's host resolves to an address that isn't public"""
+
+
+def check_public(host):
+    """Raise BlockedAddress when host resolves to a private, loopback, link-local or other non-public address"""
+    for *_, sockaddr in socket.getaddrinfo(host, None):
+        address = ipaddress.ip_address(sockaddr[0])
+        if not address.is_global:
+            raise BlockedAddress(f"{host} resolves to {address}")
+
+
+class StravaRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Follows redirects between Strava hosts with public addresses only"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if not is_fetchable(newurl):
+            # Where it leads off Strava is the answer, that host isn't requested
+            raise urllib.error.HTTPError(newurl, code, msg, headers, fp)
+        check_public(urlsplit(newurl).hostname)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+_opener = urllib.request.build_opener(StravaRedirectHandler)
+
+
+def fetch(url, timeout):
+    """GET a URL following redirects, returns (status code, final URL) without reading the body"""
+    check_public(urlsplit(url).hostname)
+    request = urllib.request.Request(url, headers={'User-Agent': USER_AGENT})
+    try:
+        with _opener.open(request, timeout=timeout) as response:
+            return response.status, response.geturl()
+    except urllib.error.HTTPError as error:
+        return error.code, error.geturl()
+
+
+def is_strava(url):
+    host = (urlsplit(url).hostname or "").lower()
+    return host == STRAVA_DOMAIN or host.endswith("." + STRAVA_DOMAIN)
+
+
+def is_fetchable(url):
+    """Whether a link is on a Strava host, the only ones fetched"""
+    return is_strava(url) or (urlsplit(url).hostname or "").lower() in STRAVA_LINK_HOSTS
+
+
+def classify(status_code, final_url):
+    """link_status for the response a link ended at"""
+    if status_code >= 500 or status_code == 429:
+        return UNREACHABLE
+    if status_code >= 400:
+        return BROKEN
+    return VERIFIED if is_strava(final_url) else NOT_STRAVA
+
+
+class ResultCache:
+    """Link check results by URL, the least recently used dropped past size"""
+
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_SECONDS):
+        self.size = size
+        self.ttl = ttl
+        self._results = collections.OrderedDict()  # url -> (expires at, (status, final url))
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        with self._lock:
+            cached = self._results.get(url)
+            if cached is None or cached[0] < time.monotonic():
+                return None
+            self._results.move_to_end(url)
+            return cached[1]
+
+    def put(self, url, result):
+        with self._lock:
+            self._results[url] = (time.monotonic() + self.ttl, result)
+            self._results.move_to_end(url)
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+
+
+class LinkVerifier:
+
+    def __init__(self, fetcher=fetch, workers=WORKERS, queue_size=QUEUE_SIZE, host_interval=HOST_INTERVAL, cache=None):
+        self.fetcher = fetcher
+        self.workers = workers
+        self.host_interval = host_interval
+        self.cache = cache if cache is not None else ResultCache()
+        self._queue = queue.Queue(maxsize=queue_size)  # (RoboAdam, submission _id, url)
+        self._host_slots = {}  # host -> time.monotonic() of the next request it may get
+        self._host_lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        """Start the worker threads"""
+        if self._threads:
+            return
+        self._threads = [threading.Thread(target=self._run, name=f"link-verifier-{number}", daemon=True)
+                         for number in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def pending(self):
+        """Links queued for a worker"""
+        return self._queue.qsize()
+
+    def verify(self, db, submission_id, url, block=False):
+        """Queue a submission's link, returns False when the queue is full and it was left pending"""
+        try:
+            self._queue.put((db, submission_id, url), block=block)
+        except queue.Full:
+            return False
+        return True
+
+    def verify_submissions(self, db, submissions):
+        """Queue the links of inserted submissions, never blocks or raises, see SubmissionQueue.on_written"""
+        for submission in submissions:
+            if submission.get('link_status') != robo_adam.LINK_STATUS_PENDING:
+                continue
+            if not self.verify(db, submission['_id'], submission['strava_link']):
+                logger.warning("Link verification queue is full, leaving %s for the sweep", submission['_id'])
+
+    def join(self):
+        """Wait until every queued link is checked"""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            db, submission_id, url = self._queue.get()
+            try:
+                status, final_url = self.check(url)
+                db.set_link_status(submission_id, status, final_url)
+            except PyMongoError:
+                logger.exception("Could not record the link status of %s, leaving it for the sweep", submission_id)
+            except Exception:
+                logger.exception("Checking the link of %s failed", submission_id)
+            finally:
+                self._queue.task_done()
+
+    def check(self, url):
+        """(link_status, final URL) of a link, from the cache when it was checked recently"""
+        if not url or url == robo_adam.NO_LINK:
+            return robo_adam.LINK_STATUS_NONE, None
+        url = url.strip()
+        cached = self.cache.get(url)
+        if cached is not None:
+            metrics.LINK_CHECKS.labels(cached[0], "cache").inc()
+            return cached
+
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            result = (INVALID, None)
+        elif not is_fetchable(url):
+            result = (NOT_STRAVA, url)
+        else:
+            self.wait_for_host(parts.hostname.lower())
+            # Another worker may have checked the same link while this one waited its turn
+            cached = self.cache.get(url)
+            if cached is not None:
+                return cached
+            try:
+                status_code, final_url = self.fetcher(url, FETCH_TIMEOUT)
+                result = (classify(status_code, final_url), final_url)
+            except (OSError, ValueError) as error:  # urllib's errors and timeouts are OSErrors
+                logger.info("Link %s is unreachable: %s", url, error)
+                result = (UNREACHABLE, None)
+
+        metrics.LINK_CHECKS.labels(result[0], "fetch").inc()
+        if result[0] != UNREACHABLE:
+            self.cache.put(url, result)
+        return result
+
+    def wait_for_host(self, host):
+        """Sleep until this worker's turn at a host, HOST_INTERVAL after the previous request to it"""
+        with self._host_lock:
+            now = time.monotonic()
+            slot = max(now, self._host_slots.get(host, now))
+            self._host_slots[host] = slot + self.host_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+@functools.lru_cache(maxsize=None)
+def get_verifier():
+    """The process-wide verifier every challenge's submissions share, so hosts are rate limited once"""
+    return LinkVerifier()
+
+
+def main(argv=None):
+    """Command line entry point for checking the links still pending"""
+    parser = argparse.ArgumentParser(description="Check the submitted links that are pending or were unreachable")
+    parser.add_argument("--challenge", help="challenge ID, every challenge by default")
+    parser.add_argument("--limit", type=int, default=0, help="links checked per challenge, all by default")
+    args = parser.parse_args(argv)
+
+    if args.challenge is not None:
+        selected = [challenges.get_challenge(args.challenge)]
+    else:
+        selected = list(challenges.get_registry())
+    verifier = LinkVerifier()
+    verifier.start()
+    for challenge in selected:
+        db = robo_adam.RoboAdam(challenge=challenge)
+        links = db.get_unchecked_links(args.limit)
+        for submission_id, url in links:
+            verifier.verify(db, submission_id, url, block=True)
+        verifier.join()
+        print(f"{challenge.challenge_id}: checked {len(links)} links")
+
+
+if __name__ == "__main__":
+    main()
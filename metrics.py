@@ -0,0 +1,167 @@
+"""
+Prometheus metrics for the database queries, the query cache and the Dash server
+
+- robo_adam_query_seconds: every RoboAdam query and write, including cache hits
+- mongo_command_seconds and mongo_commands_per_request: MongoDB round trips
+- query_cache_lookups_total: query cache hits and misses
+- dash_callback_seconds and http_request_seconds: end to end per callback and route
+- leaderboard_reloads_total: leaderboard reloads made by the leaderboard watcher
+- link_checks_total: submitted links checked by the link verifier, by result
+
+Served in the Prometheus text format at /metrics to requests sending
+"Authorization: Bearer <METRICS_TOKEN>", the route only exists when
+METRICS_TOKEN is set. With several gunicorn
+workers, set PROMETHEUS_MULTIPROC_DIR to an empty directory so /metrics
+adds up every worker's samples. Queries slower than SLOW_QUERY_MS are logged.
+"""
+
+import functools
+import hmac
+import logging
+import os
+import threading
+import time
+
+import flask
+from pymongo import monitoring
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+logger = logging.getLogger(__name__)
+
+# Log queries slower than this many milliseconds, unset to disable
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS")) if os.getenv("SLOW_QUERY_MS") else None
+
+# /metrics requires "Authorization: Bearer <token>", it isn't served without a token
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+QUERY_SECONDS = Histogram(
+    "robo_adam_query_seconds", "RoboAdam method latency, including query cache hits", ["method"], buckets=LATENCY_BUCKETS)
+MONGO_COMMAND_SECONDS = Histogram(
+    "mongo_command_seconds", "MongoDB command round trip latency", ["command"], buckets=LATENCY_BUCKETS)
+MONGO_COMMAND_FAILURES = Counter("mongo_command_failures_total", "MongoDB commands that failed", ["command"])
+MONGO_COMMANDS_PER_REQUEST = Histogram(
+    "mongo_commands_per_request", "MongoDB round trips made while serving a request", ["endpoint"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34))
+CACHE_LOOKUPS = Counter("query_cache_lookups_total", "Query cache lookups", ["result"])
+CALLBACK_SECONDS = Histogram(
+    "dash_callback_seconds", "Dash callback latency, end to end", ["callback"], buckets=LATENCY_BUCKETS)
+REQUEST_SECONDS = Histogram(
+    "http_request_seconds", "Request latency by route, callbacks excluded", ["endpoint", "status"], buckets=LATENCY_BUCKETS)
+LEADERBOARD_RELOADS = Counter(
+    "leaderboard_reloads_total", "Leaderboard reloads after database writes, by how they were noticed", ["mode"])
+LINK_CHECKS = Counter(
+    "link_checks_total", "Submitted links checked, by link status and whether it was fetched or cached", ["status", "source"])
+
+_request_state = threading.local()  # commands counted for the request this thread serves
+
+
+class CommandTimer(monitoring.CommandListener):
+    """Times every MongoDB command and counts those made for the current request"""
+
+    def started(self, event):
+        if getattr(_request_state, 'commands', None) is not None:
+            _request_state.commands += 1
+
+    def succeeded(self, event):
+        MONGO_COMMAND_SECONDS.labels(event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        MONGO_COMMAND_SECONDS.labels(event.command_name).observe(event.duration_micros / 1e6)
+        MONGO_COMMAND_FAILURES.labels(event.command_name).inc()
+
+
+# Listeners only apply to clients created after they are registered
+monitoring.register(CommandTimer())
+
+
+def timed_query(method=None, label=None):
+    """Time a RoboAdam method into QUERY_SECONDS and log it when slower than SLOW_QUERY_MS
+
+    label(*args, **kwargs) can name the method more specifically, e.g. with the leaderboard queried.
+    """
+    if method is None:
+        return functools.partial(timed_query, label=label)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - started
+            name = label(*args, **kwargs) if label is not None else method.__name__
+            QUERY_SECONDS.labels(name).observe(seconds)
+            if SLOW_QUERY_MS is not None and seconds * 1000 >= SLOW_QUERY_MS:
+                logger.warning("Slow query %s%r took %.0f ms", name, args, seconds * 1000)
+    return wrapper
+
+
+def record_cache_lookup(hit):
+    CACHE_LOOKUPS.labels("hit" if hit else "miss").inc()
+
+
+def callback_name(request, callback_maps):
+    """The first output of the Dash callback a request calls, e.g. "output-container.children"
+
+    Requests are matched against the apps' callback_maps, anything else is "unknown",
+    so clients can't add label values.
+    """
+    body = request.get_json(silent=True) or {}
+    output = body.get('output') if isinstance(body, dict) else None
+    if not isinstance(output, str) or not any(output in callback_map for callback_map in callback_maps):
+        return "unknown"
+    # Multiple outputs are "..a.children...b.style..", allow_duplicate adds "@<hash>"
+    return output.strip(".").split("...")[0].split("@")[0]
+
+
+def registry():
+    """The registry to expose, adding up every worker's samples in multiprocess mode"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        collector_registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(collector_registry)
+        return collector_registry
+    from prometheus_client import REGISTRY
+    return REGISTRY
+
+
+def install(server, callback_maps=()):
+    """Time every request and serve /metrics, install before anything that can answer a request early
+
+    callback_maps are the Dash apps' callback_map, naming the callbacks timed.
+    """
+    @server.before_request
+    def start_timing():
+        flask.g.metrics_started = time.perf_counter()
+        _request_state.commands = 0
+
+    @server.after_request
+    def record_timing(response):
+        started = flask.g.pop("metrics_started", None)
+        commands = getattr(_request_state, 'commands', None)
+        _request_state.commands = None
+        if started is None:
+            return response
+
+        seconds = time.perf_counter() - started
+        endpoint = flask.request.url_rule.rule if flask.request.url_rule is not None else "unmatched"
+        if endpoint.endswith("_dash-update-component"):
+            CALLBACK_SECONDS.labels(callback_name(flask.request, callback_maps)).observe(seconds)
+        else:
+            REQUEST_SECONDS.labels(endpoint, str(response.status_code)).observe(seconds)
+        if commands is not None:
+            MONGO_COMMANDS_PER_REQUEST.labels(endpoint).observe(commands)
+        return response
+
+    if not METRICS_TOKEN:
+        logger.warning("METRICS_TOKEN is not set, /metrics is not served")
+        return
+
+    @server.route("/metrics")
+    def prometheus_metrics():
+        authorization = flask.request.headers.get("Authorization", "")
+        if not hmac.compare_digest(authorization.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+            flask.abort(401)
+        return flask.Response(generate_latest(registry()), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,109 @@
+"""
+Read-through cache for RoboAdam query results
+
+Results are keyed by method name and arguments and tagged with the data
+version they were computed at. Every write bumps the version, so nothing
+computed before a write is ever served after it. An optional TTL bounds
+staleness for writes made by other processes (e.g. other gunicorn workers).
+"""
+
+import functools
+import threading
+import time
+import uuid
+
+from pymongo import _csot
+from pymongo.errors import ExecutionTimeout
+
+
+class QueryCache:
+
+    def __init__(self, ttl=None, on_lookup=None):
+        self.ttl = ttl  # seconds, None keeps entries until the next write
+        self.on_lookup = on_lookup  # called with True on a hit and False on a miss, e.g. for metrics
+        self.data_version = 0
+        self.instance_id = uuid.uuid4().hex[:8]  # keeps version tokens unique across processes
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._pending = {}  # key -> Event set once an in-flight computation finishes
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        """Return the cached value for key, computing and storing it on a miss
+
+        Concurrent misses on the same key wait for the first one instead of
+        running the same query again, for no longer than the caller's pymongo.timeout
+        allows, raising ExecutionTimeout once it ran out.
+        """
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    version, stored_at, value = entry
+                    if version == self.data_version and (self.ttl is None or now - stored_at < self.ttl):
+                        self.hits += 1
+                        if self.on_lookup is not None:
+                            self.on_lookup(True)
+                        return value
+                pending = self._pending.get(key)
+                if pending is None:
+                    self.misses += 1
+                    if self.on_lookup is not None:
+                        self.on_lookup(False)
+                    version = self.data_version
+                    pending = self._pending[key] = threading.Event()
+                    break
+            # pymongo has no public accessor for the time left in a pymongo.timeout block
+            remaining = _csot.remaining()
+            if not pending.wait(None if remaining is None else max(remaining, 0)):
+                raise ExecutionTimeout("Timed out waiting for the same query running in another thread")
+
+        try:
+            value = compute()
+            with self._lock:
+                # Don't store a result if a write happened while it was being computed
+                if version == self.data_version:
+                    self._entries[key] = (version, now, value)
+            return value
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending.set()
+
+    def invalidate(self):
+        """Bump the data version after a write so every cached result is recomputed"""
+        with self._lock:
+            self.data_version += 1
+            self._entries.clear()
+
+    @property
+    def version_token(self):
+        """Data version that can't collide with another process's"""
+        return f"{self.instance_id}-{self.data_version}"
+
+    @property
+    def stats(self):
+        """Hit and miss counters for confirming the cache works under load"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'data_version': self.data_version,
+                'entries': len(self._entries),
+            }
+
+
+def cached_query(method):
+    """Serve a read method through its instance's QueryCache
+
+    Cached results are shared between callers and must not be mutated.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        return self.cache.get_or_compute(key, lambda: method(self, *args, **kwargs))
+    return wrapper
@@ -4,107 +4,973 @@ Date: October 22, 2024
 Mongo DB 
 """
 
-import pandas as pd
+import argparse
+import hashlib
+import logging
 import pprint
 import os
+import re
 import sys
+import threading
+import time
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
 
 from dotenv import load_dotenv
+from pymongo import ASCENDING, DESCENDING, IndexModel, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
 
+import challenges
+import metrics
+from query_cache import QueryCache, cached_query
+
+logger = logging.getLogger(__name__)
+
 # Connection, Database, and Collections
 load_dotenv()  # Loads variables from .env file
 DB_NAME = "wth"
 DB_TEST_NAME = "wth_test"
-COLLECTION_NAME = "submissions"
+COLLECTION_NAME = "submissions"  # every challenge's, keyed by challenge_id
+# Rollups are partitioned into a collection per challenge, see RoboAdam.collection_name
+USER_ROLLUP_COLLECTION_NAME = "user_rollups"  # one document per participant
+USER_LOCATION_ROLLUP_COLLECTION_NAME = "user_location_rollups"  # one document per participant and location
+DAILY_ROLLUP_COLLECTION_NAME = "daily_rollups"  # one document per participant, location and day
+ROLLUP_VERSION_COLLECTION_NAME = "rollup_versions"  # one document per challenge, counts its rollup rebuilds
 URI = os.getenv("MONGODB_URI")  # Fetches the MongoDB URI from an environment variable
 
+# Connection pool of each process. Every gunicorn worker opens up to maxPoolSize
+# connections, keep workers * maxPoolSize under the cluster's connection limit.
+CLIENT_OPTIONS = {
+    'maxPoolSize': int(os.getenv("MONGODB_MAX_POOL_SIZE", "20")),
+    'minPoolSize': int(os.getenv("MONGODB_MIN_POOL_SIZE", "2")),
+    # Fail fast when the cluster is unreachable instead of after pymongo's 30 s default
+    'serverSelectionTimeoutMS': int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+    'connectTimeoutMS': int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS", "5000")),
+    'socketTimeoutMS': int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS", "30000")),
+    # Time a request waits for a connection when all of them are busy
+    'waitQueueTimeoutMS': int(os.getenv("MONGODB_WAIT_QUEUE_TIMEOUT_MS", "5000")),
+}
+
+
+# Seconds a cached query result may be served, bounds staleness from other workers' writes
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL_SECONDS", "30")) or None
+
+# Collections partitioned per challenge, the leaderboards are computed from them
+ROLLUP_COLLECTION_NAMES = (USER_ROLLUP_COLLECTION_NAME, USER_LOCATION_ROLLUP_COLLECTION_NAME, DAILY_ROLLUP_COLLECTION_NAME)
+
+# Leaderboard rows per page, and performers ranked at each location
+LEADERBOARD_PAGE_SIZE = 20
+TOP_VERTICAL_COUNT = 10  # participants in the Top 10 Vert graph, at most a page
+TOP_REPS_PER_LOCATION = 20
+
+# Paged leaderboards: the collection read, display column -> field, and the default sort.
+# The default sorts end on a unique field so pages don't overlap.
+LEADERBOARDS = {
+    'location_counts': {
+        'collection': USER_ROLLUP_COLLECTION_NAME,
+        'columns': {'Name': 'name', 'Locations Covered': 'location_count'},
+        'sort': [('location_count', DESCENDING), ('_id', ASCENDING)],
+    },
+    'total_vertical': {
+        'collection': USER_ROLLUP_COLLECTION_NAME,
+        'columns': {'Name': 'name', 'Total Vertical Feet': 'total_vertical'},
+        'sort': [('total_vertical', DESCENDING), ('_id', ASCENDING)],
+    },
+    # Ranked by RoboAdam.ranked_top_reps_pipeline, whose rows already use the display columns
+    'top_reps': {
+        'collection': USER_LOCATION_ROLLUP_COLLECTION_NAME,
+        'columns': {'Location': 'Location', 'Rank': 'Rank', 'Name': 'Name', 'Reps': 'Reps'},
+        'sort': [('Location', ASCENDING), ('Rank', ASCENDING)],
+    },
+}
+
+# Submitted links are checked in the background by link_verifier, which replaces a pending status
+NO_LINK = "No link provided"
+LINK_STATUS_NONE = "none"
+LINK_STATUS_PENDING = "pending"
+LINK_STATUS_UNREACHABLE = "unreachable"  # checked again by the next sweep
+LINK_STATUSES_TO_CHECK = (None, LINK_STATUS_PENDING, LINK_STATUS_UNREACHABLE)  # None matches submissions from before
+
+# Submissions without a key from the browser get one from their content and this window of time,
+# so a double click or a retry within it is stored once
+IDEMPOTENCY_WINDOW_SECONDS = 60
+
+# Server error codes: a change stream opened on a server that is not a replica set, and a duplicate key
+CHANGE_STREAM_NOT_SUPPORTED = 40573
+DUPLICATE_KEY_ERROR = 11000
+
+# Comparisons leaderboard filters may use, "contains" is a case-insensitive substring match
+FILTER_OPERATORS = ('$eq', '$ne', '$lt', '$lte', '$gt', '$gte', 'contains')
+
+# Indexes supporting every RoboAdam query, created by RoboAdam.ensure_indexes in each challenge's collections
+INDEXES = {
+    # Shared by every challenge, so every index starts with the challenge
+    COLLECTION_NAME: [
+        # Covers a participant's progress, the fields it sums are read from the index alone.
+        # Also serves every query the smaller challenge_email index did, which it replaces.
+        IndexModel([('challenge_id', ASCENDING), ('email', ASCENDING), ('location', ASCENDING),
+                    ('repetitions', ASCENDING), ('vertical_gain', ASCENDING)], name='challenge_email_location_repetitions_vertical'),
+        IndexModel([('challenge_id', ASCENDING), ('location', ASCENDING)], name='challenge_location'),
+        # Rebuilding the user and location rollups groups on location and email
+        IndexModel([('challenge_id', ASCENDING), ('location', ASCENDING), ('email', ASCENDING), ('repetitions', ASCENDING)],
+                   name='challenge_location_email_repetitions'),
+        # The latest submission, polled for changes without change streams
+        IndexModel([('challenge_id', ASCENDING), ('_id', DESCENDING)], name='challenge_latest'),
+        # Rejects a submission sent twice, see idempotency_key. Submissions from before have no key.
+        IndexModel([('challenge_id', ASCENDING), ('idempotency_key', ASCENDING)], name='challenge_idempotency_key',
+                   unique=True, partialFilterExpression={'idempotency_key': {'$exists': True}}),
+        # Links still to check, see get_unchecked_links
+        IndexModel([('challenge_id', ASCENDING), ('link_status', ASCENDING)], name='challenge_link_status'),
+    ],
+    USER_ROLLUP_COLLECTION_NAME: [
+        # Leaderboard pages sort on these with _id breaking ties
+        IndexModel([('total_vertical', DESCENDING), ('_id', ASCENDING)], name='total_vertical_id'),
+        IndexModel([('location_count', DESCENDING), ('_id', ASCENDING)], name='location_count_id'),
+    ],
+    USER_LOCATION_ROLLUP_COLLECTION_NAME: [
+        IndexModel([('_id.email', ASCENDING)], name='email'),
+        IndexModel([('_id.location', ASCENDING), ('repetitions', DESCENDING)], name='location_repetitions'),
+    ],
+    DAILY_ROLLUP_COLLECTION_NAME: [
+        # Windowed leaderboards read a range of days
+        IndexModel([('_id.day', ASCENDING)], name='day'),
+    ],
+}
+
+# Queries that read a whole collection on purpose, find_collection_scans doesn't report them.
+# The portal snapshot aggregates every user location rollup, walking an index instead would
+# read the same documents and add a FETCH for each.
+EXPECTED_COLLECTION_SCANS = ('get_portal_snapshot',)
+
+# Indexes RoboAdam.ensure_indexes drops, each replaced by one in INDEXES
+RETIRED_INDEXES = {
+    COLLECTION_NAME: ['challenge_email'],
+}
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class ChangeStreamsNotSupported(Exception):
+    """The server or client can't open change streams, poll RoboAdam.get_change_marker instead"""
+
+
+def get_client():
+    """This process's MongoClient, created on first use"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = MongoClient(URI, server_api=ServerApi('1'), **CLIENT_OPTIONS)
+    return _client
+
+
+def _forget_client():
+    """MongoClients aren't fork-safe, a forked worker creates its own instead of using its parent's"""
+    global _client, _client_lock
+    _client = None
+    _client_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_client)
+
+
+def to_frame(records, columns=None):
+    """DataFrame of a getter's records for analysis, pandas is only imported when this is used"""
+    import pandas as pd
+    return pd.DataFrame(records, columns=columns)
+
+
+def submission_day(submission_data):
+    """The day of a submission, also for documents still holding the old string dates"""
+    day = submission_data['date']
+    if isinstance(day, str):
+        return datetime.strptime(day, "%Y-%m-%d")
+    return datetime(day.year, day.month, day.day)
+
+
+def idempotency_key(challenge, *parts, moment=None):
+    """Key shared by the same submission made again within IDEMPOTENCY_WINDOW_SECONDS of a moment (now)
+
+    Windows are fixed, so two clicks either side of a window's end still get two keys.
+    """
+    window = int((moment or datetime.now(timezone.utc)).timestamp() // IDEMPOTENCY_WINDOW_SECONDS)
+    return content_key(challenge, window, *parts)
+
+
+def content_key(challenge, *parts):
+    """Idempotency key of a submission identified by parts alone, whenever it is made"""
+    content = "\x1f".join(str(part) for part in (challenge.challenge_id, *parts))
+    return hashlib.sha256(content.encode()).hexdigest()[:32]
+
+
+def normalize_email(email):
+    """The form e-mails are stored and looked up in, so one participant's entries share their rollups"""
+    return email.strip().lower()
+
+
+def make_submission(challenge, name, email, location, repetitions, vertical_gain, strava_link=None, key=None):
+    """Build the submission document stored for one entry of a challenge
+
+    date_time is the moment submitted, date the challenge's local day of it. key is the
+    idempotency key, e.g. generated by the browser, derived from the entry without one.
+    """
+    now = datetime.now(timezone.utc)
+    email = normalize_email(email)
+    if key is None:
+        key = idempotency_key(challenge, email, location, repetitions, moment=now)
+    return {
+        "challenge_id": challenge.challenge_id,
+        "name": name,
+        "email": email,
+        "location": location,
+        "repetitions": repetitions,
+        "vertical_gain": vertical_gain,
+        "strava_link": strava_link if strava_link else NO_LINK,
+        "link_status": LINK_STATUS_PENDING if strava_link else LINK_STATUS_NONE,
+        "date": challenge.day(now),
+        "date_time": now,
+        "idempotency_key": key,
+    }
 
-# Number of Locations
-TOTAL_LOCATION_COUNT = 40 
 
 class RoboAdam():
 
-    def __init__(self):
+    def __init__(self, client=None, database_name=DB_TEST_NAME, challenge=None):
+
+        # A client and database can be passed in, e.g. by the benchmarks,
+        # otherwise the process's client is looked up on use so it is never shared across a fork
+        self._client = client
+        self.database_name = database_name
+        # Every query reads and writes one challenge's submissions and leaderboards, the default one's by default
+        self.challenge = challenge if challenge is not None else challenges.get_challenge()
+        self.cache = QueryCache(ttl=QUERY_CACHE_TTL, on_lookup=metrics.record_cache_lookup)
 
-        self._client = MongoClient(URI, server_api=ServerApi('1'))
-        self.db_test = self._client[DB_TEST_NAME]
+    @property
+    def client(self):
+        return self._client if self._client is not None else get_client()
+
+    @property
+    def db_test(self):
         # self._db = client[DB_NAME]
-        self.collection_test = self.db_test[COLLECTION_NAME]
+        return self.client[self.database_name]
+
+    @property
+    def collection_test(self):
+        return self.db_test[COLLECTION_NAME]
+
+    @property
+    def user_rollups_test(self):
+        return self.db_test[self.collection_name(USER_ROLLUP_COLLECTION_NAME)]
+
+    @property
+    def user_location_rollups_test(self):
+        return self.db_test[self.collection_name(USER_LOCATION_ROLLUP_COLLECTION_NAME)]
+
+    @property
+    def daily_rollups_test(self):
+        return self.db_test[self.collection_name(DAILY_ROLLUP_COLLECTION_NAME)]
+
+    @property
+    def rollup_versions_test(self):
+        return self.db_test[ROLLUP_VERSION_COLLECTION_NAME]
+
+    def collection_name(self, base_name):
+        """This challenge's collection for a collection name, the submissions are shared by every challenge"""
+        if base_name == COLLECTION_NAME:
+            return COLLECTION_NAME
+        return self.challenge.collection_name(base_name)
+
+    @property
+    def challenge_match(self):
+        """Condition selecting this challenge's submissions"""
+        return {'challenge_id': self.challenge.challenge_id}
+
+    def warm_pool(self):
+        """Select a server and open a connection now rather than on the first request
+
+        The pool then opens the rest of its minPoolSize connections in the background.
+        """
+        self.client.admin.command('ping')
+
+    def health_check(self):
+        """Ping the database, returns {'ok', 'latency_ms'} or {'ok', 'error'} when it failed"""
+        started = time.perf_counter()
+        try:
+            self.client.admin.command('ping')
+        except PyMongoError as error:
+            return {'ok': False, 'error': str(error)}
+        return {'ok': True, 'latency_ms': round((time.perf_counter() - started) * 1000, 1)}
+
+    def watch_leaderboard_changes(self, resume_after=None, max_await_time_ms=None):
+        """Change stream of the writes to this challenge's submissions and the rollups the leaderboards read
+
+        Needs a replica set or sharded cluster. Rebuilds replace a rollup collection with $out,
+        which shows up as a rename to it.
+        """
+        rollups = [self.collection_name(name) for name in ROLLUP_COLLECTION_NAMES]
+        pipeline = [
+            {'$match': {'$or': [
+                {'ns.coll': COLLECTION_NAME, 'fullDocument.challenge_id': self.challenge.challenge_id},
+                {'ns.coll': {'$in': rollups}},
+                {'to.coll': {'$in': rollups}},
+            ]}},
+            # Only whether something changed matters, not the documents
+            {'$project': {'operationType': 1, 'ns': 1, 'to': 1}},
+        ]
+        if not hasattr(type(self.db_test), 'watch'):
+            raise ChangeStreamsNotSupported("This client has no change streams")  # e.g. mongomock
+        try:
+            return self.db_test.watch(pipeline, resume_after=resume_after, max_await_time_ms=max_await_time_ms)
+        except OperationFailure as error:
+            if error.code == CHANGE_STREAM_NOT_SUPPORTED:
+                raise ChangeStreamsNotSupported(str(error)) from error
+            raise
+
+    def get_change_marker(self):
+        """Cheap value that changes with the submissions and rollup rebuilds, for polling without change streams
+
+        The submission count catches writes with older _ids, e.g. replayed journals and imports,
+        and the rollup version catches rebuilds, which don't change the submissions.
+        """
+        count = self.collection_test.estimated_document_count()
+        latest = self.collection_test.find_one(self.challenge_match, {'_id': 1}, sort=[('_id', DESCENDING)])
+        rollups = self.rollup_versions_test.find_one({'_id': self.challenge.challenge_id})
+        return count, latest['_id'] if latest else None, rollups['version'] if rollups else 0
+
+    def ensure_indexes(self):
+        """Create any missing indexes declared in INDEXES, in this challenge's collections"""
+        for collection_name, indexes in INDEXES.items():
+            self.db_test[self.collection_name(collection_name)].create_indexes(indexes)
+        for collection_name, index_names in RETIRED_INDEXES.items():
+            for index_name in index_names:
+                try:
+                    self.db_test[self.collection_name(collection_name)].drop_index(index_name)
+                except OperationFailure:
+                    pass  # already dropped, e.g. for another challenge
+
+    def query_plans(self):
+        """Explain commands for every query RoboAdam runs, keyed by the method running it"""
+        def aggregate(collection, pipeline):
+            return {'aggregate': self.collection_name(collection), 'pipeline': pipeline, 'cursor': {}}
+
+        return {
+            'rebuild_rollups (users)': aggregate(COLLECTION_NAME, self.rebuild_user_rollups_pipeline()),
+            'rebuild_rollups (user locations)': aggregate(COLLECTION_NAME, self.rebuild_user_location_rollups_pipeline()),
+            'rebuild_rollups (days)': aggregate(COLLECTION_NAME, self.rebuild_daily_rollups_pipeline()),
+            'get_location_reps_by_email': aggregate(USER_LOCATION_ROLLUP_COLLECTION_NAME, self.location_reps_by_email_pipeline('')),
+            'get_locations_covered': {'distinct': self.collection_name(USER_LOCATION_ROLLUP_COLLECTION_NAME), 'key': '_id.location'},
+            'get_portal_snapshot': aggregate(USER_LOCATION_ROLLUP_COLLECTION_NAME, self.portal_snapshot_pipeline()),
+            **{
+                f'get_leaderboard_page ({leaderboard})': aggregate(
+                    definition['collection'], self.leaderboard_page_pipeline(leaderboard, 0, LEADERBOARD_PAGE_SIZE))
+                for leaderboard, definition in LEADERBOARDS.items()
+            },
+            'get_top_reps_per_location': aggregate(USER_LOCATION_ROLLUP_COLLECTION_NAME, self.top_reps_pipeline()),
+            'get_total_vertical_per_person': aggregate(USER_ROLLUP_COLLECTION_NAME, self.total_vertical_pipeline()),
+            'get_unique_location_counts': aggregate(USER_ROLLUP_COLLECTION_NAME, self.unique_location_counts_pipeline()),
+            'get_participant_progress': aggregate(COLLECTION_NAME, self.participant_progress_pipeline('')),
+            'get_participant_progress (rank)': {
+                'count': self.collection_name(USER_ROLLUP_COLLECTION_NAME), 'query': {'total_vertical': {'$gt': 0}}},
+            'get_window_leaderboard': aggregate(
+                DAILY_ROLLUP_COLLECTION_NAME, self.window_leaderboard_pipeline(*self.challenge.window("today"), LEADERBOARD_PAGE_SIZE)),
+            'get_change_marker': {'find': COLLECTION_NAME, 'filter': self.challenge_match, 'sort': {'_id': -1}, 'limit': 1},
+            'get_unchecked_links': {'find': COLLECTION_NAME, 'filter': self.unchecked_links_filter(), 'limit': 1},
+        }
+
+    def find_collection_scans(self):
+        """Explain every query and return the names of those whose winning plan is a COLLSCAN
+
+        Queries in EXPECTED_COLLECTION_SCANS are left out.
+        """
+        def has_collection_scan(plan):
+            if isinstance(plan, dict):
+                if plan.get('stage') == 'COLLSCAN':
+                    return True
+                # Only the winning plan matters
+                return any(has_collection_scan(value) for key, value in plan.items() if key != 'rejectedPlans')
+            if isinstance(plan, list):
+                return any(has_collection_scan(value) for value in plan)
+            return False
+
+        collection_scans = []
+        for name, command in self.query_plans().items():
+            if name in EXPECTED_COLLECTION_SCANS:
+                continue
+            explanation = self.db_test.command('explain', command, verbosity='queryPlanner')
+            if has_collection_scan(explanation):
+                collection_scans.append(name)
+        return collection_scans
+
+    @property
+    def data_version(self):
+        """Token that changes whenever this process writes to the database"""
+        return self.cache.version_token
+
+    @property
+    def cache_stats(self):
+        """Query cache hit/miss counters"""
+        return self.cache.stats
 
     @property
     def display_data(self):
         """display all data from database"""
-        return pprint.pprint(list(self.collection_test.find()))
+        return pprint.pprint(list(self.collection_test.find(self.challenge_match)))
 
+    @metrics.timed_query
     def insert_submitted_data(self, submission_data):
-        """insert the submitted data into MongoDB"""
-        self.collection_test.insert_one(submission_data)
+        """insert the submitted data into MongoDB and update the leaderboard rollups
+
+        Returns False when it was already inserted, only rolling it up if that insert's rollups failed.
+        """
+        submission_data.setdefault('challenge_id', self.challenge.challenge_id)  # journaled before there were challenges
+        submission_data['rolled_up'] = False
+        try:
+            self.collection_test.insert_one(submission_data)
+        except DuplicateKeyError:
+            self.roll_up(list(self.collection_test.find({'_id': submission_data['_id'], 'rolled_up': False})))
+            return False
+        self.roll_up([submission_data])
+        return True
+
+    @metrics.timed_query
+    def insert_submissions_bulk(self, submissions):
+        """Insert many submissions in one unordered batch and update the rollups for those inserted
+
+        Returns the number inserted and the write errors as {'index', 'code', 'message'} dicts.
+        """
+        if not submissions:
+            return {'inserted': 0, 'errors': []}
+        for submission_data in submissions:
+            submission_data.setdefault('challenge_id', self.challenge.challenge_id)
+            submission_data['rolled_up'] = False
+
+        errors = []
+        try:
+            self.collection_test.insert_many(submissions, ordered=False)
+        except BulkWriteError as error:
+            errors = [{'index': write_error['index'], 'code': write_error['code'], 'message': write_error['errmsg']}
+                      for write_error in error.details['writeErrors']]
+
+        # Roll up the submissions written now, and those written by an earlier try whose rollups failed.
+        # A duplicate _id is the same journal entry, its writer is this one.
+        failed = {error['index'] for error in errors}
+        inserted = [submission for index, submission in enumerate(submissions) if index not in failed]
+        written_before = [submissions[error['index']]['_id'] for error in errors if error['code'] == DUPLICATE_KEY_ERROR]
+        if written_before:
+            inserted_before = list(self.collection_test.find({'_id': {'$in': written_before}, 'rolled_up': False}))
+        else:
+            inserted_before = []
+        self.roll_up(inserted + inserted_before)
+        return {'inserted': len(inserted), 'errors': errors}
+
+    def roll_up(self, submissions):
+        """Add inserted submissions to their challenge's rollups, then flag them rolled_up
+
+        Submissions are inserted with rolled_up False, so retrying a write whose rollups failed rolls up
+        only what it missed. A failure between the rollups and the flag counts them twice, until the
+        rollups are rebuilt. A journal replayed after the default challenge changed can hold another
+        challenge's submissions, they go to that challenge's rollups.
+        """
+        by_challenge = {}
+        for submission_data in submissions:
+            by_challenge.setdefault(submission_data['challenge_id'], []).append(submission_data)
+        for challenge_id, challenge_submissions in by_challenge.items():
+            if challenge_id == self.challenge.challenge_id:
+                db = self
+            else:
+                try:
+                    db = RoboAdam(self._client, self.database_name, challenges.get_challenge(challenge_id))
+                except KeyError:
+                    logger.error("Not rolling up %d submissions of unknown challenge %r",
+                                 len(challenge_submissions), challenge_id)
+                    continue
+            db.update_rollups(challenge_submissions)
+            self.collection_test.update_many(
+                {'_id': {'$in': [submission_data['_id'] for submission_data in challenge_submissions]}},
+                {'$set': {'rolled_up': True}})
+        self.cache.invalidate()
+
+    @metrics.timed_query
+    def update_rollups(self, submissions):
+        """Add submissions to the per-user, per-(user, location) and daily rollups, one bulk write each"""
+        # Sum the submissions per user and location first, so each rollup gets a single update
+        location_totals = {}
+        user_totals = {}
+        daily_totals = {}
+        for submission_data in submissions:
+            email = submission_data['email']
+            location = submission_data['location']
+            repetitions = submission_data['repetitions']
+            vertical_feet = repetitions * submission_data['vertical_gain']
+
+            location_total = location_totals.setdefault((email, location), {
+                'name': submission_data['name'], 'repetitions': 0, 'vertical_feet': 0})
+            location_total['repetitions'] += repetitions
+            location_total['vertical_feet'] += vertical_feet
+
+            user_total = user_totals.setdefault(email, {
+                'name': submission_data['name'], 'total_repetitions': 0, 'total_vertical': 0, 'locations': []})
+            user_total['total_repetitions'] += repetitions
+            user_total['total_vertical'] += vertical_feet
+            if location not in user_total['locations']:
+                user_total['locations'].append(location)
+
+            daily_total = daily_totals.setdefault((email, location, submission_day(submission_data)), {
+                'name': submission_data['name'], 'repetitions': 0, 'vertical_feet': 0, 'submissions': 0})
+            daily_total['repetitions'] += repetitions
+            daily_total['vertical_feet'] += vertical_feet
+            daily_total['submissions'] += 1
+
+        # Per user and location totals
+        location_keys = list(location_totals)
+        location_result = self.user_location_rollups_test.bulk_write([
+            UpdateOne(
+                {'_id': {'email': email, 'location': location}},
+                {
+                    '$setOnInsert': {'name': total['name']},  # Keep the first name submitted
+                    '$inc': {'repetitions': total['repetitions'], 'vertical_feet': total['vertical_feet']},
+                },
+                upsert=True
+            )
+            for (email, location), total in location_totals.items()
+        ], ordered=False)
+
+        # An upserted location rollup means a location this user hadn't visited yet
+        new_locations = {}
+        for index in location_result.upserted_ids:
+            email = location_keys[index][0]
+            new_locations[email] = new_locations.get(email, 0) + 1
+
+        # Per user totals and the set of locations visited
+        self.user_rollups_test.bulk_write([
+            UpdateOne(
+                {'_id': email},
+                {
+                    '$setOnInsert': {'name': total['name']},
+                    '$inc': {
+                        'total_repetitions': total['total_repetitions'],
+                        'total_vertical': total['total_vertical'],
+                        'location_count': new_locations.get(email, 0),
+                    },
+                    '$addToSet': {'locations': {'$each': total['locations']}},
+                },
+                upsert=True
+            )
+            for email, total in user_totals.items()
+        ], ordered=False)
+
+        # Per user, location and day totals for the windowed leaderboards
+        self.daily_rollups_test.bulk_write([
+            UpdateOne(
+                {'_id': {'email': email, 'location': location, 'day': day}},
+                {
+                    '$setOnInsert': {'name': total['name']},
+                    '$inc': {
+                        'repetitions': total['repetitions'],
+                        'vertical_feet': total['vertical_feet'],
+                        'submissions': total['submissions'],
+                    },
+                },
+                upsert=True
+            )
+            for (email, location, day), total in daily_totals.items()
+        ], ordered=False)
+
+    @metrics.timed_query
+    def rebuild_rollups(self):
+        """Recompute this challenge's rollup collections from its submissions"""
+        # Every submission is counted by the rebuild, none is left for a retried write to roll up
+        self.collection_test.update_many({**self.challenge_match, 'rolled_up': False}, {'$set': {'rolled_up': True}})
+        # $out replaces each rollup collection atomically once the aggregation finishes
+        self.collection_test.aggregate(self.rebuild_user_rollups_pipeline())
+        self.collection_test.aggregate(self.rebuild_user_location_rollups_pipeline())
+        self.collection_test.aggregate(self.rebuild_daily_rollups_pipeline())
+        self.rollup_versions_test.update_one(
+            {'_id': self.challenge.challenge_id}, {'$inc': {'version': 1}}, upsert=True)
+        self.cache.invalidate()
+
+    def rebuild_user_rollups_pipeline(self):
+        """Pipeline recomputing the per-user rollups from the submissions"""
+        return [
+            # Walk the (challenge, email) index rather than scanning the collection
+            {'$match': self.challenge_match},
+            {'$sort': {'email': 1}},
+            {'$group': {
+                '_id': '$email',
+                'name': {'$first': '$name'},
+                'total_repetitions': {'$sum': '$repetitions'},
+                'total_vertical': {'$sum': {'$multiply': ['$repetitions', '$vertical_gain']}},
+                'locations': {'$addToSet': '$location'}
+            }},
+            {'$addFields': {'location_count': {'$size': '$locations'}}},
+            {'$out': self.collection_name(USER_ROLLUP_COLLECTION_NAME)}
+        ]
+
+    def rebuild_user_location_rollups_pipeline(self):
+        """Pipeline recomputing the per-(user, location) rollups from the submissions"""
+        return [
+            # Walk the (challenge, location, email, repetitions) index rather than scanning the collection
+            {'$match': self.challenge_match},
+            {'$sort': {'location': 1, 'email': 1}},
+            {'$group': {
+                '_id': {'email': '$email', 'location': '$location'},
+                'name': {'$first': '$name'},
+                'repetitions': {'$sum': '$repetitions'},
+                'vertical_feet': {'$sum': {'$multiply': ['$repetitions', '$vertical_gain']}}
+            }},
+            {'$out': self.collection_name(USER_LOCATION_ROLLUP_COLLECTION_NAME)}
+        ]
+
+    def rebuild_daily_rollups_pipeline(self):
+        """Pipeline recomputing the per-(user, location, day) rollups from the submissions"""
+        return [
+            # Walk the (challenge, location, email, repetitions) index rather than scanning the collection
+            {'$match': self.challenge_match},
+            {'$sort': {'location': 1, 'email': 1}},
+            {'$group': {
+                '_id': {'email': '$email', 'location': '$location', 'day': '$date'},
+                'name': {'$first': '$name'},
+                'repetitions': {'$sum': '$repetitions'},
+                'vertical_feet': {'$sum': {'$multiply': ['$repetitions', '$vertical_gain']}},
+                'submissions': {'$sum': 1}
+            }},
+            {'$out': self.collection_name(DAILY_ROLLUP_COLLECTION_NAME)}
+        ]
+
+    def migrate_submission_dates(self, source_timezone=timezone.utc, batch_size=1000):
+        """Convert submissions' string date and date_time into datetimes, returns how many changed
+
+        The strings were written in the server's local time, source_timezone.
+        Rebuild the rollups afterwards so the daily rollups use the new days.
+        """
+        migrated = 0
+        query = {**self.challenge_match, 'date_time': {'$type': 'string'}}
+        while True:
+            batch = list(self.collection_test.find(query, {'date_time': 1}).limit(batch_size))
+            if not batch:
+                return migrated
+            updates = []
+            for submission_data in batch:
+                moment = datetime.strptime(submission_data['date_time'], "%Y-%m-%d %H:%M:%S").replace(tzinfo=source_timezone)
+                updates.append(UpdateOne(
+                    {'_id': submission_data['_id']},
+                    {'$set': {'date_time': moment, 'date': self.challenge.day(moment)}}
+                ))
+            self.collection_test.bulk_write(updates, ordered=False)
+            migrated += len(updates)
+
+    def normalize_emails(self, batch_size=1000):
+        """Store submissions' e-mails in normalize_email's form, returns how many changed
+
+        Rebuild the rollups afterwards so each participant's entries are rolled up together.
+        """
+        migrated = 0
+        # Upper case letters or surrounding white space
+        query = {**self.challenge_match, 'email': {'$regex': r'[A-Z]|^\s|\s$'}}
+        while True:
+            batch = list(self.collection_test.find(query, {'email': 1}).limit(batch_size))
+            if not batch:
+                return migrated
+            self.collection_test.bulk_write([
+                UpdateOne({'_id': submission_data['_id']}, {'$set': {'email': normalize_email(submission_data['email'])}})
+                for submission_data in batch
+            ], ordered=False)
+            migrated += len(batch)
+
+    def assign_challenge(self):
+        """Assign submissions made before there were several challenges to this one, returns how many
+
+        Rebuild the rollups afterwards so the leaderboards include them.
+        """
+        result = self.collection_test.update_many({'challenge_id': {'$exists': False}}, {'$set': self.challenge_match})
+        return result.modified_count
+
+    @metrics.timed_query
+    def set_link_status(self, submission_id, status, final_url=None):
+        """Record the result of checking a submission's link, the leaderboards don't change"""
+        self.collection_test.update_one({'_id': submission_id}, {'$set': {
+            'link_status': status,
+            'link_final_url': final_url,
+            'link_checked_at': datetime.now(timezone.utc),
+        }})
+
+    @metrics.timed_query
+    def get_unchecked_links(self, limit=0):
+        """(_id, strava_link) of the submissions whose link is still to be checked"""
+        cursor = self.collection_test.find(self.unchecked_links_filter(), {'strava_link': 1}, limit=limit)
+        return [(submission['_id'], submission.get('strava_link', NO_LINK)) for submission in cursor]
+
+    def unchecked_links_filter(self):
+        return {**self.challenge_match, 'link_status': {'$in': list(LINK_STATUSES_TO_CHECK)}}
 
     def retrieve_data(self):
         """retrieve data from mongoDB"""
-        return list(self.collection_test.find())
+        return list(self.collection_test.find(self.challenge_match))
 
+    @metrics.timed_query
+    @cached_query
     def get_location_reps_by_email(self, email):
-        # Query MongoDB for the selected email
-        pipeline = [
-            {'$match': {'email': email}},
-            {'$group': {
-                '_id': '$location', 
-                'total_repetitions': {'$sum': '$repetitions'},
+        # Query the rollups for the selected email
+        return list(self.user_location_rollups_test.aggregate(self.location_reps_by_email_pipeline(email)))
+
+    def location_reps_by_email_pipeline(self, email):
+        """Pipeline listing the total repetitions per location for an email"""
+        return [
+            {'$match': {'_id.email': email}},
+            {'$project': {
+                '_id': '$_id.location',
+                'total_repetitions': '$repetitions',
                 }
             }
         ]
-        return list(self.collection_test.aggregate(pipeline))
 
+    @metrics.timed_query
+    @cached_query
     def get_locations_covered(self):
-        """Returns a df of locations completed and locations left"""
-        completed_locations = len(self.collection_test.distinct("location"))
-        remaining_locations = TOTAL_LOCATION_COUNT - completed_locations
+        """Returns the counts of locations completed and locations left"""
+        completed_locations = len(self.user_location_rollups_test.distinct("_id.location"))
+        return self.locations_covered_records(completed_locations)
+
+    def locations_covered_records(self, completed_locations):
+        """Returns the counts of locations completed and locations left for a completed count"""
+        remaining_locations = len(self.challenge.catalog) - completed_locations
+        return [
+            {"Status": "Hilled", "Count": completed_locations},
+            {"Status": "Not Hilled", "Count": remaining_locations},
+        ]
 
-        completed_location_data = {
-            "Status": ["Hilled", "Not Hilled"],
-            "Count":[completed_locations, remaining_locations]
+    def empty_portal_snapshot(self):
+        """Portal snapshot with no submissions, used before the first snapshot loads"""
+        return {
+            'location_counts': [],
+            'top_reps': [],
+            'total_vertical': [],
+            'top_vertical': [],
+            'locations_covered': self.locations_covered_records(0),
+            'row_counts': {leaderboard: 0 for leaderboard in LEADERBOARDS},
+            'total_repetitions': 0,
         }
-        df = pd.DataFrame(completed_location_data)
-        return df
 
+    @metrics.timed_query
+    @cached_query
+    def get_portal_snapshot(self):
+        """Retrieve the first page of every Resource Portal leaderboard in a single $facet round trip
+
+        Besides the leaderboards' first pages, as lists of row dicts, this holds the
+        Top 10 Vert, the row counts for paging and the total repetitions, which
+        change with every submission.
+        """
+        result = next(self.user_location_rollups_test.aggregate(self.portal_snapshot_pipeline()))
+
+        def first(facet, field):
+            return result[facet][0][field] if result[facet] else 0
+
+        participants = first('participants', 'count')
+        return {
+            'location_counts': result['location_counts'],
+            'top_reps': self.format_ranked_top_reps(result['top_reps']),
+            'total_vertical': result['total_vertical'],
+            # The first page is already the highest totals, sorted and limited by the query
+            'top_vertical': result['total_vertical'][:TOP_VERTICAL_COUNT],
+            'locations_covered': self.locations_covered_records(first('locations_covered', 'completed')),
+            'row_counts': {
+                'location_counts': participants,
+                'total_vertical': participants,
+                'top_reps': first('top_reps_count', 'count'),
+            },
+            'total_repetitions': first('total_repetitions', 'repetitions'),
+        }
+
+    def portal_snapshot_pipeline(self):
+        """Single $facet pipeline computing the first page of every Resource Portal leaderboard
+
+        The pages match get_leaderboard_page's default sort, ties included.
+        """
+        return [
+            {'$facet': {
+                # Number of locations each user has covered
+                'location_counts': [
+                    {'$group': {
+                        '_id': '$_id.email',
+                        'name': {'$first': '$name'},
+                        'locations_covered': {'$sum': 1}
+                    }},
+                    {'$sort': {'locations_covered': -1, '_id': 1}},
+                    {'$limit': LEADERBOARD_PAGE_SIZE},
+                    {'$project': {
+                        'Name': '$name',
+                        'Locations Covered': '$locations_covered',
+                        '_id': 0
+                    }}
+                ],
+                # Top performers at each location
+                'top_reps': self.ranked_top_reps_pipeline() + [
+                    {'$sort': {'Location': 1, 'Rank': 1}},
+                    {'$limit': LEADERBOARD_PAGE_SIZE}
+                ],
+                'top_reps_count': [
+                    {'$group': {'_id': '$_id.location', 'count': {'$sum': 1}}},
+                    {'$group': {'_id': None, 'count': {'$sum': {'$min': ['$count', TOP_REPS_PER_LOCATION]}}}}
+                ],
+                # Total vertical feet per user
+                'total_vertical': [
+                    {'$group': {
+                        '_id': '$_id.email',
+                        'name': {'$first': '$name'},
+                        'total_vertical': {'$sum': '$vertical_feet'}
+                    }},
+                    {'$sort': {'total_vertical': -1, '_id': 1}},
+                    {'$limit': LEADERBOARD_PAGE_SIZE},
+                    {'$project': {
+                        'Name': '$name',
+                        'Total Vertical Feet': '$total_vertical',
+                        '_id': 0
+                    }}
+                ],
+                'participants': [
+                    {'$group': {'_id': '$_id.email'}},
+                    {'$count': 'count'}
+                ],
+                'total_repetitions': [
+                    {'$group': {'_id': None, 'repetitions': {'$sum': '$repetitions'}}}
+                ],
+                # Number of distinct locations anyone has covered
+                'locations_covered': [
+                    {'$group': {'_id': '$_id.location'}},
+                    {'$count': 'completed'}
+                ]
+            }}
+        ]
+
+    @metrics.timed_query(label=lambda leaderboard, *args, **kwargs: f"get_leaderboard_page:{leaderboard}")
+    def get_leaderboard_page(self, leaderboard, skip, limit, sort=(), filters=()):
+        """Retrieve one page of a leaderboard in LEADERBOARDS
+
+        sort is a sequence of (column, ASCENDING or DESCENDING) applied before the
+        leaderboard's default sort, filters a sequence of (column, operator, value)
+        with an operator from FILTER_OPERATORS, both using display column names.
+        Returns {'rows': list of row dicts, 'total': number of rows matching the filters}.
+        """
+        if filters:
+            # Typed in filters would fill the cache with one-off entries
+            return self.query_leaderboard_page(leaderboard, skip, limit, tuple(sort), tuple(filters))
+        return self.cached_leaderboard_page(leaderboard, skip, limit, tuple(sort))
+
+    def query_leaderboard_page(self, leaderboard, skip, limit, sort=(), filters=()):
+        collection = self.db_test[self.collection_name(LEADERBOARDS[leaderboard]['collection'])]
+        result = next(collection.aggregate(self.leaderboard_page_pipeline(leaderboard, skip, limit, sort, filters)))
+        rows = result['rows']
+        if leaderboard == 'top_reps':
+            rows = self.format_ranked_top_reps(rows)
+        return {'rows': rows, 'total': result['total'][0]['count'] if result['total'] else 0}
+
+    cached_leaderboard_page = cached_query(query_leaderboard_page)
+
+    def leaderboard_page_pipeline(self, leaderboard, skip, limit, sort=(), filters=()):
+        """Pipeline filtering, sorting and paging a leaderboard, and counting the rows matching the filters"""
+        definition = LEADERBOARDS[leaderboard]
+        columns = definition['columns']
+
+        pipeline = self.ranked_top_reps_pipeline() if leaderboard == 'top_reps' else []
+        match = self.leaderboard_match(columns, filters)
+        if match:
+            pipeline.append({'$match': match})
+
+        sort_fields = {columns[column]: direction for column, direction in sort if column in columns}
+        for field, direction in definition['sort']:
+            sort_fields.setdefault(field, direction)
+        pipeline.append({'$sort': sort_fields})
+
+        pipeline.append({'$facet': {
+            'rows': [
+                {'$skip': skip},
+                {'$limit': limit},
+                {'$project': {'_id': 0, **{column: f'${field}' for column, field in columns.items()}}}
+            ],
+            'total': [{'$count': 'count'}]
+        }})
+        return pipeline
+
+    def leaderboard_match(self, columns, filters):
+        """$match conditions for leaderboard filters given as (column, operator, value)"""
+        match = {}
+        for column, operator, value in filters:
+            if column not in columns or operator not in FILTER_OPERATORS:
+                raise ValueError(f"Can't filter {column!r} with {operator!r}")
+            if operator == 'contains':
+                condition = {'$regex': re.escape(str(value)), '$options': 'i'}
+            else:
+                condition = {operator: value}
+            match.setdefault(columns[column], {}).update(condition)
+        return match
 
+
+    @metrics.timed_query
+    @cached_query
     def get_top_reps_per_location(self):
         """Retrieve the top 3 people with the most repetitions for each location, displaying the location once."""
-        pipeline = [
-            # Group by location and email to calculate total repetitions per person per location
-            {'$group': {
-                '_id': {'location': '$location', 'email': '$email'},
-                'total_reps': {'$sum': '$repetitions'},
-                'name': {'$first': '$name'}  # Take the first name encountered for this email
-            }},
-            # Sort each grouped result by total repetitions in descending order
-            {'$sort': {'_id.location': 1, 'total_reps': -1}},
+        result = list(self.user_location_rollups_test.aggregate(self.top_reps_pipeline()))
+        return self.format_top_reps(result)
+
+    def top_reps_pipeline(self):
+        """Pipeline stages ranking the top performers at each location from the rollups"""
+        return [
+            # Each rollup already holds the total repetitions per person per location
+            # Sort them by total repetitions in descending order
+            {'$sort': {'_id.location': 1, 'repetitions': -1}},
             # Group by location to create an array of top performers per location
             {'$group': {
                 '_id': '$_id.location',
                 'top_performers': {
                     '$push': {
                         'name': '$name',
-                        'reps': '$total_reps'
+                        'reps': '$repetitions'
                     }
                 }
             }},
-            # Limit each location's top performers array to the top 20 entries
+            # Limit each location's top performers array to the top entries
             {'$project': {
                 'Location': '$_id',
-                'TopPerformers': {'$slice': ['$top_performers', 20]},
+                'TopPerformers': {'$slice': ['$top_performers', TOP_REPS_PER_LOCATION]},
                 '_id': 0
             }},
             # Sort the output by Location alphabetically
             {'$sort': {'Location': 1}}
         ]
 
-        result = list(self.collection_test.aggregate(pipeline))
+    def ranked_top_reps_pipeline(self):
+        """Pipeline stages listing the top performers at each location as one row per rank"""
+        return self.top_reps_pipeline() + [
+            {'$unwind': {'path': '$TopPerformers', 'includeArrayIndex': 'Rank'}},
+            {'$project': {
+                'Location': 1,
+                'Rank': {'$add': ['$Rank', 1]},
+                'Name': '$TopPerformers.name',
+                'Reps': '$TopPerformers.reps'
+            }}
+        ]
+
+    def format_ranked_top_reps(self, rows):
+        """Ranked top performer rows, showing each location once per run of its rows"""
+        formatted_rows = []
+        previous_location = None
+        for row in rows:
+            formatted_rows.append({
+                'Location': row['Location'] if row['Location'] != previous_location else "",
+                'Rank': row['Rank'],
+                'Name': row['Name'],
+                'Reps': row['Reps']
+            })
+            previous_location = row['Location']
+        return formatted_rows
 
-        # Flatten the results for a cleaner DataFrame format with Rank and Location shown once
+    def format_top_reps(self, result):
+        """Flatten the top performers per location into rows"""
+        # Flatten the results into rows with Rank and Location shown once
         formatted_result = []
         for entry in result:
             location = entry['Location']
@@ -116,25 +982,22 @@ class RoboAdam():
                     'Reps': performer['reps']
                 })
 
-        return pd.DataFrame(formatted_result)
+        return formatted_result
 
-    def get_total_vertical_per_person(self):
-        """Calculate total vertical feet for each person, grouped by email."""
-        pipeline = [
-            # Calculate vertical feet for each entry
-            {'$project': {
-                'email': 1,
-                'name': 1,
-                'vertical_feet': {'$multiply': ['$repetitions', '$vertical_gain']}
-            }},
-            # Group by email and sum up the vertical feet
-            {'$group': {
-                '_id': '$email',
-                'name': {'$first': '$name'},  # Retrieve the associated name
-                'total_vertical': {'$sum': '$vertical_feet'}
-            }},
+    @metrics.timed_query
+    @cached_query
+    def get_total_vertical_per_person(self, limit=None):
+        """Calculate total vertical feet for each person, grouped by email, optionally only the top limit."""
+        return list(self.user_rollups_test.aggregate(self.total_vertical_pipeline(limit)))
+
+    def total_vertical_pipeline(self, limit=None):
+        """Pipeline listing every user's total vertical feet, highest first"""
+        limit_stage = [{'$limit': limit}] if limit else []
+        return [
+            # Each user rollup already holds the summed vertical feet
             # Sort by total vertical feet in descending order (optional)
             {'$sort': {'total_vertical': -1}},
+            *limit_stage,
             # Rename fields for the final output
             {'$project': {
                 'Email': '$_id',
@@ -143,30 +1006,104 @@ class RoboAdam():
                 '_id': 0
             }}
         ]
-        result = list(self.collection_test.aggregate(pipeline))
-        return pd.DataFrame(result)
 
+    @metrics.timed_query
+    @cached_query
     def get_unique_location_counts(self):
         """Get the count of unique locations visited by each user (grouped by email)"""
-        pipeline = [
+        return list(self.user_rollups_test.aggregate(self.unique_location_counts_pipeline()))
+
+    @metrics.timed_query
+    @cached_query
+    def get_window_leaderboard(self, start, end, limit=LEADERBOARD_PAGE_SIZE):
+        """Leaderboard of the days from start up to end, from the daily rollups
+
+        Days outside the challenge are left out. Rows hold Name, Total Vertical Feet,
+        Reps and Hills, highest vertical first.
+        """
+        return list(self.daily_rollups_test.aggregate(self.window_leaderboard_pipeline(start, end, limit)))
+
+    def window_leaderboard_pipeline(self, start, end, limit):
+        """Pipeline summing the daily rollups from start up to end per user"""
+        first_day, after_last_day = self.challenge.window("challenge")
+        return [
+            # Only the buckets of the window, through the day index
+            {'$match': {'_id.day': {'$gte': max(start, first_day), '$lt': min(end, after_last_day)}}},
             {'$group': {
-                '_id': '$email', 
-                'unique_locations': {'$addToSet': '$location'},
-                'name': {'$first': '$name'}  # Use the first name encountered for display
+                '_id': '$_id.email',
+                'name': {'$first': '$name'},
+                'repetitions': {'$sum': '$repetitions'},
+                'vertical_feet': {'$sum': '$vertical_feet'},
+                'locations': {'$addToSet': '$_id.location'}
             }},
+            {'$sort': {'vertical_feet': -1, '_id': 1}},
+            {'$limit': limit},
             {'$project': {
-                'Email': '$_id',
                 'Name': '$name',
-                'Locations Covered': {'$size': '$unique_locations'}
+                'Total Vertical Feet': '$vertical_feet',
+                'Reps': '$repetitions',
+                'Hills': {'$size': '$locations'},
+                '_id': 0
+            }}
+        ]
+
+    @metrics.timed_query
+    def get_participant_progress(self, email):
+        """A participant's reps and vertical feet per location, their totals and total vertical rank
+
+        Locations come from the submissions through a covering index, so the cost grows with the
+        participant's own submissions. The rank counts the participants with more vertical feet,
+        ties share a rank, and is None before their first submission is rolled up.
+
+        The rank is counted on the total_vertical_id index rather than stored, so it is exact as soon
+        as a submission is rolled up. The count reads an index key per participant ranked above, at
+        most every participant and no documents; a stored rank would instead have to be rewritten
+        for everyone passed by each submission, or go stale between rollup rebuilds.
+        """
+        # Normalized before the cache key, so every spelling of an e-mail shares one entry
+        return self._participant_progress(normalize_email(email))
+
+    @cached_query
+    def _participant_progress(self, email):
+        locations = list(self.collection_test.aggregate(self.participant_progress_pipeline(email)))
+        total_vertical = sum(location['vertical_feet'] for location in locations)
+        rank = None
+        if locations:
+            rank = self.user_rollups_test.count_documents({'total_vertical': {'$gt': total_vertical}}) + 1
+        return {
+            'locations': [
+                {'location': location['_id'], 'repetitions': location['repetitions'], 'vertical_feet': location['vertical_feet']}
+                for location in locations
+            ],
+            'total_repetitions': sum(location['repetitions'] for location in locations),
+            'total_vertical': total_vertical,
+            'rank': rank,
+        }
+
+    def participant_progress_pipeline(self, email):
+        """Pipeline summing an email's submissions per location, only reading covered fields"""
+        return [
+            {'$match': {**self.challenge_match, 'email': email}},
+            {'$group': {
+                '_id': '$location',
+                'repetitions': {'$sum': '$repetitions'},
+                'vertical_feet': {'$sum': {'$multiply': ['$repetitions', '$vertical_gain']}},
             }},
-            {'$sort': {'Locations Covered': -1}}
+            {'$sort': {'_id': 1}},
         ]
-        result = list(self.collection_test.aggregate(pipeline))
 
-        # Convert result to DataFrame
-        df = pd.DataFrame(result)
-        df = df[['Name', 'Locations Covered']]  # Select relevant columns
-        return df
+    def unique_location_counts_pipeline(self):
+        """Pipeline listing the number of locations each user has covered, most first"""
+        return [
+            # Each user rollup already counts the locations visited
+            {'$sort': {'location_count': -1}},
+            # Only the relevant columns
+            {'$project': {
+                'Name': '$name',
+                'Locations Covered': '$location_count',
+                '_id': 0
+            }}
+        ]
 
 
 """
@@ -179,25 +1116,97 @@ print(get_data_frame)
 """
 Number of Locations Covered Count
 robo_adam = RoboAdam()
-location_counts_df = robo_adam.get_unique_location_counts()
+location_counts_df = to_frame(robo_adam.get_unique_location_counts())
 print(location_counts_df)
 """
 
 """
 # Reps of each location winner
 robo_adam = RoboAdam()
-top_reps_df = robo_adam.get_top_reps_per_location()
+top_reps_df = to_frame(robo_adam.get_top_reps_per_location())
 print(top_reps_df)
 """
 
 
 """
 robo_adam = RoboAdam()
-total_vert_df = robo_adam.get_total_vertical_per_person()
+total_vert_df = to_frame(robo_adam.get_total_vertical_per_person())
 print(total_vert_df)
 """
 """
 robo_adam = RoboAdam()
 locations_coverage = robo_adam.get_locations_covered()
 print(locations_coverage)
-"""
\ No newline at end of file
+"""
+
+
+def main(argv=None):
+    """Command line entry point for database maintenance"""
+    parser = argparse.ArgumentParser(description="Robo-Adam database maintenance")
+    parser.add_argument("--challenge", help="challenge ID, every challenge by default (the default one for assign-challenge)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("rebuild-rollups", help="recompute the leaderboard rollups from the submissions collection")
+    subparsers.add_parser("ensure-indexes", help="create any missing indexes")
+    subparsers.add_parser("check-query-plans", help="fail if any query plan scans a whole collection")
+    migrate_parser = subparsers.add_parser(
+        "migrate-dates", help="assign submissions without a challenge to the default one, "
+                              "convert string submission dates into datetimes and rebuild the rollups")
+    migrate_parser.add_argument(
+        "--source-timezone", default="UTC", help="time zone the string dates were written in (default UTC, Heroku's)")
+    subparsers.add_parser(
+        "assign-challenge", help="assign submissions without a challenge to one and rebuild its rollups")
+    subparsers.add_parser(
+        "normalize-emails", help="lower case and trim the submissions' e-mails and rebuild the rollups")
+    args = parser.parse_args(argv)
+
+    if args.challenge is not None:
+        selected = [challenges.get_challenge(args.challenge)]
+    elif args.command == "assign-challenge":
+        selected = [challenges.get_challenge()]
+    else:
+        selected = list(challenges.get_registry())
+
+    if args.command == "migrate-dates":
+        # Dates are migrated per challenge, submissions from before there were several are the default one's
+        default_challenge = challenges.get_challenge()
+        assigned = RoboAdam(challenge=default_challenge).assign_challenge()
+        if assigned:
+            print(f"{default_challenge.challenge_id}: assigned {assigned} submissions")
+            if default_challenge not in selected:
+                selected.append(default_challenge)
+
+    collection_scans = []
+    for challenge in selected:
+        robo_adam = RoboAdam(challenge=challenge)
+        name = challenge.challenge_id
+        if args.command == "rebuild-rollups":
+            robo_adam.rebuild_rollups()
+            print(f"{name}: rebuilt the leaderboard rollups from the submissions collection")
+        elif args.command == "ensure-indexes":
+            robo_adam.ensure_indexes()
+            print(f"{name}: indexes are up to date")
+        elif args.command == "check-query-plans":
+            for query in robo_adam.find_collection_scans():
+                print(f"COLLSCAN: {name} {query}")
+                collection_scans.append((name, query))
+        elif args.command == "migrate-dates":
+            migrated = robo_adam.migrate_submission_dates(ZoneInfo(args.source_timezone))
+            robo_adam.rebuild_rollups()
+            print(f"{name}: migrated the dates of {migrated} submissions and rebuilt the rollups")
+        elif args.command == "assign-challenge":
+            assigned = robo_adam.assign_challenge()
+            robo_adam.rebuild_rollups()
+            print(f"{name}: assigned {assigned} submissions and rebuilt the rollups")
+        elif args.command == "normalize-emails":
+            normalized = robo_adam.normalize_emails()
+            robo_adam.rebuild_rollups()
+            print(f"{name}: normalized the e-mails of {normalized} submissions and rebuilt the rollups")
+
+    if args.command == "check-query-plans":
+        if collection_scans:
+            sys.exit(1)
+        print("Every query plan uses an index")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Spatial index of points on the earth
+
+A KD-tree over the points as 3D unit vectors, so straight-line distances
+order points like great-circle ones do, with no special case at the poles
+or across the antimeridian. Built once per catalog, it answers k-nearest
+and within-radius queries by visiting O(log n) nodes rather than computing
+a haversine per point.
+"""
+
+import heapq
+import math
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def unit_vector(lat, lon):
+    lat, lon = math.radians(lat), math.radians(lon)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+
+def chord_to_km(chord):
+    """Great-circle distance for a straight-line distance between unit vectors"""
+    return 2 * EARTH_RADIUS_KM * math.asin(min(chord / 2, 1.0))
+
+
+def km_to_chord(distance_km):
+    """Straight-line distance between unit vectors for a great-circle distance"""
+    return 2 * math.sin(min(distance_km / EARTH_RADIUS_KM, math.pi) / 2)
+
+
+class SpatialIndex:
+
+    def __init__(self, points):
+        """points are (lat, lon, item) with any item, e.g. a Hill"""
+        entries = [(unit_vector(lat, lon), item) for lat, lon, item in points]
+        self._size = len(entries)
+        self._root = self._build(entries, 0)
+
+    def _build(self, entries, depth):
+        # Nodes are (vector, item, axis, left, right), split at the median of the axis
+        if not entries:
+            return None
+        axis = depth % 3
+        entries.sort(key=lambda entry: entry[0][axis])
+        median = len(entries) // 2
+        vector, item = entries[median]
+        return (vector, item, axis,
+                self._build(entries[:median], depth + 1), self._build(entries[median + 1:], depth + 1))
+
+    def __len__(self):
+        return self._size
+
+    def nearest(self, lat, lon, k=1, radius_km=None):
+        """Up to k (distance_km, item), closest first, optionally only those within radius_km"""
+        if k <= 0 or self._root is None:
+            return []
+        target = unit_vector(lat, lon)
+        limit = km_to_chord(radius_km) ** 2 if radius_km is not None else math.inf
+        best = []  # max-heap of (-squared distance, tiebreak, item) holding the k closest so far
+        stack = [(self._root, 0.0)]  # nodes to visit, with a lower bound of their squared distance
+        while stack:
+            node, lower_bound = stack.pop()
+            if node is None or lower_bound > (limit if len(best) < k else min(limit, -best[0][0])):
+                continue
+            vector, item, axis, left, right = node
+            squared = sum((a - b) ** 2 for a, b in zip(vector, target))
+            if squared <= limit:
+                if len(best) < k:
+                    heapq.heappush(best, (-squared, id(item), item))
+                elif squared < -best[0][0]:
+                    heapq.heapreplace(best, (-squared, id(item), item))
+
+            # Push the side of the split holding the target last so it is searched first
+            offset = target[axis] - vector[axis]
+            near, far = (left, right) if offset < 0 else (right, left)
+            stack.append((far, max(lower_bound, offset * offset)))
+            stack.append((near, lower_bound))
+
+        return [(chord_to_km(math.sqrt(-negated)), item) for negated, _, item in sorted(best, reverse=True)]
+
+    def within(self, lat, lon, radius_km):
+        """Every (distance_km, item) within radius_km, closest first"""
+        return self.nearest(lat, lon, k=self._size, radius_km=radius_km)
@@ -0,0 +1,218 @@
+"""
+Write-behind submission queue backed by a local append-only journal
+
+Submissions are appended to a journal file and acknowledged right away. A
+background writer thread batches them into MongoDB with retries, then
+records how much of the journal is committed in a checkpoint file. On
+restart, journal entries past the checkpoint are replayed. Every
+submission gets its _id when it is journaled, so a replayed entry that
+already made it to MongoDB is rejected as a duplicate instead of counted
+twice.
+
+A submission sent twice, e.g. by a double click, has the same idempotency
+key. The queue drops it when it saw the key recently, and the unique index
+on the key rejects the ones sent to another process.
+
+Each process writes its own journal and holds a lock on it. Journals left
+behind by processes that exited are replayed by the next one to start.
+"""
+
+import collections
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from bson import ObjectId, json_util
+from pymongo.errors import PyMongoError
+
+try:
+    import fcntl
+except ImportError:  # Windows, run single process without journal locks
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_DIRECTORY = Path(os.getenv(
+    "SUBMISSION_JOURNAL_DIR", Path(os.path.dirname(os.path.realpath(__file__))) / "_journal"))
+BATCH_SIZE = 100  # submissions per insert_many
+FLUSH_INTERVAL = 0.2  # seconds to wait for more submissions before writing a batch
+MAX_RETRY_DELAY = 30  # seconds between retries while MongoDB is unavailable
+DUPLICATE_KEY_ERROR = 11000
+RECENT_KEYS = 10000  # idempotency keys remembered per process
+
+
+class SubmissionQueue:
+
+    def __init__(self, db, journal_directory=JOURNAL_DIRECTORY, on_written=None):
+        self.db = db
+        self.on_written = on_written  # called from the writer thread with the submissions inserted by each batch
+        self.journal_directory = Path(journal_directory)
+        self.journal_path = None
+        self._journal = None
+        self._journal_lines = 0  # lines written to this process's journal
+        self._committed_lines = 0  # lines known to be in MongoDB
+        self._queue = queue.Queue()
+        self._recent_keys = collections.OrderedDict()  # idempotency keys of the latest submissions
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Open this process's journal and start the writer thread"""
+        if self._thread is not None:
+            return
+        self.journal_directory.mkdir(parents=True, exist_ok=True)
+        self.journal_path = self.journal_directory / f"submissions-{os.getpid()}-{uuid.uuid4().hex[:8]}.jsonl"
+        # Lock the journal before giving it a name other processes replay, workers start at the same time
+        opening_path = self.journal_path.with_suffix(".opening")
+        self._journal = open(opening_path, "a", encoding="utf-8")
+        if fcntl is not None:
+            fcntl.flock(self._journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.replace(opening_path, self.journal_path)
+        self._thread = threading.Thread(target=self._run, name="submission-writer", daemon=True)
+        self._thread.start()
+
+    @property
+    def pending(self):
+        """Number of submissions acknowledged but not yet written to MongoDB"""
+        return self._journal_lines - self._committed_lines
+
+    def submit(self, submission_data):
+        """Journal a submission and queue it for the writer, returns once it is on disk
+
+        Returns False without journaling it when a submission with its idempotency key was just submitted.
+        """
+        submission_data.setdefault("_id", ObjectId())
+        line = json_util.dumps(submission_data) + "\n"
+        key = submission_data.get("idempotency_key")
+        with self._lock:
+            if key is not None and key in self._recent_keys:
+                return False
+            self._journal.write(line)
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._journal_lines += 1
+            self._queue.put(submission_data)
+            if key is not None:
+                self._recent_keys[key] = None
+                if len(self._recent_keys) > RECENT_KEYS:
+                    self._recent_keys.popitem(last=False)
+        return True
+
+    def _run(self):
+        """Writer thread, replays orphaned journals then drains the queue in batches"""
+        for journal_path in sorted(self.journal_directory.glob("submissions-*.jsonl")):
+            if journal_path != self.journal_path:
+                try:
+                    self._replay(journal_path)
+                except Exception:
+                    logger.exception("Replaying %s failed, leaving it for the next process", journal_path.name)
+
+        # Nothing may stop the writer, a failed batch is kept and written again
+        batch = []
+        retry_delay = 1
+        while True:
+            try:
+                if not batch:
+                    batch = self._next_batch()
+                self._write(batch)
+                self._commit(len(batch))
+                batch = []
+                retry_delay = 1
+                self._rotate_journal()
+            except Exception:
+                logger.exception("Submission writer failed, retrying in %d s", retry_delay)
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY)
+
+    def _next_batch(self):
+        """Wait for a submission, then up to FLUSH_INTERVAL for more to write with it"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + FLUSH_INTERVAL
+        while len(batch) < BATCH_SIZE:
+            try:
+                batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def _commit(self, written_lines):
+        """Record that the next written_lines journal lines are in MongoDB"""
+        with self._lock:
+            committed_lines = self._committed_lines + written_lines
+            self._write_checkpoint(self.journal_path, committed_lines)
+            self._committed_lines = committed_lines
+
+    def _rotate_journal(self):
+        """Start a fresh journal once everything in it is committed"""
+        with self._lock:
+            if self._committed_lines == self._journal_lines:
+                self._journal.truncate(0)
+                self._journal_lines = self._committed_lines = 0
+                self._write_checkpoint(self.journal_path, 0)
+
+    def _write(self, batch):
+        """Insert a batch, retrying with backoff until MongoDB accepts it"""
+        retry_delay = 1
+        while True:
+            try:
+                result = self.db.insert_submissions_bulk(batch)
+                for error in result['errors']:
+                    # Duplicates are entries replayed after they already made it to MongoDB,
+                    # or submissions also sent to another process
+                    if error['code'] != DUPLICATE_KEY_ERROR:
+                        logger.error("Dropped submission %s: %s", batch[error['index']]["_id"], error['message'])
+            except PyMongoError:
+                logger.exception("Writing %d submissions failed, retrying in %d s", len(batch), retry_delay)
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY)
+                continue
+
+            if self.on_written is not None:
+                failed = {error['index'] for error in result['errors']}
+                try:
+                    self.on_written([submission for index, submission in enumerate(batch) if index not in failed])
+                except Exception:
+                    # The batch is in MongoDB, writing it again would only hit duplicates
+                    logger.exception("Handling %d written submissions failed", len(batch) - len(failed))
+            return
+
+    def _replay(self, journal_path):
+        """Write the uncommitted entries of a journal left by an exited process, then remove it"""
+        try:
+            journal = open(journal_path, "r+", encoding="utf-8")
+        except FileNotFoundError:
+            return  # another process replayed it first
+        with journal:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return  # still owned by a running process
+            committed = self._read_checkpoint(journal_path)
+            entries = [json_util.loads(line) for line in journal.read().splitlines()[committed:] if line.strip()]
+            for start in range(0, len(entries), BATCH_SIZE):
+                self._write(entries[start:start + BATCH_SIZE])
+            if entries:
+                logger.info("Replayed %d submissions from %s", len(entries), journal_path.name)
+            journal_path.unlink(missing_ok=True)
+            self._checkpoint_path(journal_path).unlink(missing_ok=True)
+
+    def _checkpoint_path(self, journal_path):
+        return journal_path.with_suffix(".checkpoint")
+
+    def _read_checkpoint(self, journal_path):
+        try:
+            return int(self._checkpoint_path(journal_path).read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _write_checkpoint(self, journal_path, committed_lines):
+        """Atomically record how many journal lines are in MongoDB"""
+        checkpoint_path = self._checkpoint_path(journal_path)
+        temporary_path = checkpoint_path.with_suffix(".tmp")
+        temporary_path.write_text(str(committed_lines))
+        os.replace(temporary_path, checkpoint_path)
@@ -0,0 +1,33 @@
+import time
+
+import mongomock
+import pytest
+
+import challenges
+import robo_adam
+
+
+def wait_for(condition, timeout=5):
+    """Wait for a background thread to make condition() true, fails after timeout seconds"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def challenge():
+    return challenges.get_challenge()
+
+
+@pytest.fixture
+def hill(challenge):
+    return challenge.catalog.hills[0].name
+
+
+@pytest.fixture
+def db(challenge):
+    """RoboAdam on an in-memory database, mongomock has no change streams"""
+    db = robo_adam.RoboAdam(client=mongomock.MongoClient(), challenge=challenge)
+    db.ensure_indexes()
+    return db
@@ -0,0 +1,135 @@
+from datetime import datetime, timezone
+
+from bson import ObjectId
+
+import leaderboard_watcher
+import robo_adam
+from conftest import wait_for
+from leaderboard_watcher import LeaderboardWatcher
+
+
+class FakeChangeStream:
+    """Change stream returning changes, then closing once they are read"""
+
+    def __init__(self, changes):
+        self.changes = list(changes)
+        self.alive = True
+        self.resume_token = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.alive = False
+
+    def try_next(self):
+        if not self.changes:
+            self.alive = False
+            return None
+        change = self.changes.pop(0)
+        if change is not None:
+            self.resume_token = {'_data': change}
+        return change
+
+
+class FakeCache:
+
+    def __init__(self):
+        self.invalidations = 0
+
+    def invalidate(self):
+        self.invalidations += 1
+
+
+class ChangeStreamDatabase:
+    """RoboAdam stand-in for a replica set, each watch opens the next stream"""
+
+    def __init__(self, *streams):
+        self.streams = list(streams)
+        self.resumed_after = []
+        self.cache = FakeCache()
+
+    def watch_leaderboard_changes(self, resume_after=None, max_await_time_ms=None):
+        self.resumed_after.append(resume_after)
+        return self.streams.pop(0)
+
+
+def insert(db, challenge, hill, repetitions=1, _id=None):
+    submission = robo_adam.make_submission(challenge, "Runner", "runner@example.com", hill, repetitions, 100)
+    if _id is not None:
+        submission["_id"] = _id
+    db.insert_submitted_data(submission)
+
+
+def test_change_stream_reloads_once_per_burst(monkeypatch):
+    monkeypatch.setattr(leaderboard_watcher, "SETTLE_MS", 0)
+    # A submission, then its rollup writes arriving together
+    db = ChangeStreamDatabase(FakeChangeStream([None, "submission", "user rollup", "location rollup", None]))
+    reloads = []
+    watcher = LeaderboardWatcher(db, lambda: reloads.append(watcher.mode))
+
+    watcher.follow_change_stream()
+
+    # Once to catch up when the stream opened, once for the burst
+    assert reloads == ["change_stream", "change_stream"]
+    assert db.cache.invalidations == 2
+    assert watcher.current
+
+
+def test_change_stream_resumes_after_the_last_change():
+    db = ChangeStreamDatabase(FakeChangeStream(["submission"]), FakeChangeStream([]))
+    watcher = LeaderboardWatcher(db, lambda: None)
+
+    watcher.follow_change_stream()
+    watcher.follow_change_stream()
+
+    assert db.resumed_after == [None, {'_data': "submission"}]
+
+
+def test_falls_back_to_polling_without_change_streams(monkeypatch, db, challenge, hill):
+    monkeypatch.setattr(leaderboard_watcher, "POLL_SECONDS", 0.01)
+    reloads = []
+    watcher = LeaderboardWatcher(db, lambda: reloads.append(watcher.mode))
+    watcher.start()
+    try:
+        wait_for(lambda: watcher.current)
+        assert watcher.mode == "poll"
+        assert reloads == ["poll"]
+
+        insert(db, challenge, hill)
+        wait_for(lambda: len(reloads) == 2)
+    finally:
+        watcher.stop(timeout=5)
+
+
+def test_poll_reloads_only_when_the_marker_changed(monkeypatch, db, challenge, hill):
+    monkeypatch.setattr(leaderboard_watcher, "POLL_SECONDS", 0)
+    reloads = []
+    watcher = LeaderboardWatcher(db, lambda: reloads.append(True))
+    watcher.mode = "poll"
+
+    watcher.poll()
+    watcher.poll()
+    assert len(reloads) == 1
+
+    insert(db, challenge, hill)
+    watcher.poll()
+    watcher.poll()
+    assert len(reloads) == 2
+
+
+def test_change_marker_changes_with_submissions_and_rebuilds(db, challenge, hill):
+    marker = db.get_change_marker()
+    assert db.get_change_marker() == marker
+
+    insert(db, challenge, hill)
+    assert db.get_change_marker() != marker
+    marker = db.get_change_marker()
+
+    # A replayed journal entry or import, older than the latest submission
+    insert(db, challenge, hill, 2, ObjectId.from_datetime(datetime(2024, 11, 1, tzinfo=timezone.utc)))
+    assert db.get_change_marker() != marker
+    marker = db.get_change_marker()
+
+    db.rebuild_rollups()
+    assert db.get_change_marker() != marker
@@ -0,0 +1,108 @@
+import socket
+import urllib.error
+import urllib.request
+
+import pytest
+
+import link_verifier
+from link_verifier import LinkVerifier
+
+
+def resolve_to(monkeypatch, address):
+    """Make every host name resolve to address"""
+    family = socket.AF_INET6 if ":" in address else socket.AF_INET
+    monkeypatch.setattr(socket, "getaddrinfo", lambda host, port, *args, **kwargs: [
+        (family, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", (address, 0))])
+
+
+class RecordingFetcher:
+
+    def __init__(self, final_url=None, status_code=200):
+        self.final_url = final_url
+        self.status_code = status_code
+        self.urls = []
+
+    def __call__(self, url, timeout):
+        self.urls.append(url)
+        return self.status_code, self.final_url or url
+
+
+@pytest.mark.parametrize("url", [
+    "http://127.0.0.1/",
+    "http://localhost:8050/metrics",
+    "http://10.0.0.5/",
+    "http://192.168.1.1/admin",
+    "http://169.254.169.254/latest/meta-data/",
+    "http://[::1]/",
+    "https://example.com/activities/1",
+    "https://strava.com.example.com/activities/1",
+])
+def test_links_off_strava_are_not_fetched(url):
+    fetcher = RecordingFetcher()
+
+    assert LinkVerifier(fetcher=fetcher).check(url) == (link_verifier.NOT_STRAVA, url)
+    assert fetcher.urls == []
+
+
+@pytest.mark.parametrize("url, final_url", [
+    ("https://www.strava.com/activities/1", None),
+    ("https://strava.app.link/abc", "https://www.strava.com/activities/1"),
+])
+def test_strava_links_are_fetched(url, final_url):
+    fetcher = RecordingFetcher(final_url)
+
+    assert LinkVerifier(fetcher=fetcher, host_interval=0).check(url)[0] == link_verifier.VERIFIED
+    assert fetcher.urls == [url]
+
+
+def test_strava_link_redirecting_off_strava_is_not_strava():
+    fetcher = RecordingFetcher("http://10.0.0.5/", status_code=302)
+
+    assert LinkVerifier(fetcher=fetcher, host_interval=0).check("https://strava.app.link/abc") == (
+        link_verifier.NOT_STRAVA, "http://10.0.0.5/")
+
+
+@pytest.mark.parametrize("address", [
+    "127.0.0.1", "10.0.0.5", "172.16.0.1", "192.168.1.1", "169.254.169.254", "0.0.0.0", "::1", "fd00::1", "fe80::1",
+])
+def test_non_public_addresses_are_blocked(monkeypatch, address):
+    resolve_to(monkeypatch, address)
+
+    with pytest.raises(link_verifier.BlockedAddress):
+        link_verifier.check_public("www.strava.com")
+
+
+def test_public_addresses_are_allowed(monkeypatch):
+    resolve_to(monkeypatch, "151.101.1.1")
+
+    link_verifier.check_public("www.strava.com")
+
+
+def test_strava_host_resolving_to_a_private_address_is_unreachable(monkeypatch):
+    resolve_to(monkeypatch, "127.0.0.1")
+    monkeypatch.setattr(link_verifier._opener, "open", lambda *args, **kwargs: pytest.fail("requested"))
+
+    assert LinkVerifier(host_interval=0).check("https://www.strava.com/activities/1") == (
+        link_verifier.UNREACHABLE, None)
+
+
+def test_redirects_off_strava_are_not_followed(monkeypatch):
+    resolve_to(monkeypatch, "151.101.1.1")
+    handler = link_verifier.StravaRedirectHandler()
+    request = urllib.request.Request("https://strava.app.link/abc")
+
+    with pytest.raises(urllib.error.HTTPError) as error:
+        handler.redirect_request(request, None, 302, "Found", {}, "http://169.254.169.254/latest/meta-data/")
+    assert error.value.code == 302
+    assert error.value.geturl() == "http://169.254.169.254/latest/meta-data/"
+
+    assert handler.redirect_request(request, None, 302, "Found", {}, "https://www.strava.com/activities/1") is not None
+
+
+def test_redirects_to_strava_hosts_with_private_addresses_are_blocked(monkeypatch):
+    resolve_to(monkeypatch, "10.0.0.5")
+    handler = link_verifier.StravaRedirectHandler()
+    request = urllib.request.Request("https://strava.app.link/abc")
+
+    with pytest.raises(link_verifier.BlockedAddress):
+        handler.redirect_request(request, None, 302, "Found", {}, "https://www.strava.com/activities/1")
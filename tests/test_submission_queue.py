@@ -0,0 +1,100 @@
+from bson import ObjectId, json_util
+from pymongo.errors import AutoReconnect
+
+import robo_adam
+from conftest import wait_for
+from submission_queue import SubmissionQueue
+
+
+def write_journal(directory, submissions, committed_lines):
+    """A journal left behind by an exited process, with its checkpoint"""
+    journal_path = directory / "submissions-1-orphaned.jsonl"
+    journal_path.write_text("".join(json_util.dumps(submission) + "\n" for submission in submissions))
+    journal_path.with_suffix(".checkpoint").write_text(str(committed_lines))
+    return journal_path
+
+
+def make_submissions(challenge, hill, count):
+    submissions = []
+    for number in range(count):
+        submission = robo_adam.make_submission(challenge, "Runner", "runner@example.com", hill, number + 1, 100)
+        submission["_id"] = ObjectId()
+        submissions.append(submission)
+    return submissions
+
+
+def total_repetitions(db, email="runner@example.com"):
+    rollup = db.user_rollups_test.find_one({'_id': email})
+    return rollup['total_repetitions'] if rollup else 0
+
+
+def test_replay_writes_the_entries_past_the_checkpoint(tmp_path, db, challenge, hill):
+    submissions = make_submissions(challenge, hill, 3)
+    journal_path = write_journal(tmp_path, submissions, committed_lines=2)
+
+    SubmissionQueue(db, tmp_path).start()
+    wait_for(lambda: not journal_path.exists())
+
+    assert db.collection_test.distinct('_id') == [submissions[2]["_id"]]
+    assert total_repetitions(db) == 3
+    assert not journal_path.with_suffix(".checkpoint").exists()
+
+
+def test_replayed_entries_already_written_are_not_counted_twice(tmp_path, db, challenge, hill):
+    submissions = make_submissions(challenge, hill, 2)
+    db.insert_submissions_bulk([dict(submission) for submission in submissions])
+    # The process exited after the insert, before its checkpoint
+    journal_path = write_journal(tmp_path, submissions, committed_lines=0)
+
+    SubmissionQueue(db, tmp_path).start()
+    wait_for(lambda: not journal_path.exists())
+
+    assert db.collection_test.count_documents({}) == 2
+    assert total_repetitions(db) == 1 + 2
+
+
+def test_submission_sent_twice_is_journaled_once(tmp_path, db, challenge, hill):
+    queue = SubmissionQueue(db, tmp_path)
+    queue.start()
+    submission = robo_adam.make_submission(challenge, "Runner", "runner@example.com", hill, 2, 100, key="double-click")
+
+    assert queue.submit(dict(submission))
+    assert not queue.submit(dict(submission))
+    wait_for(lambda: queue.pending == 0)
+    assert db.collection_test.count_documents({}) == 1
+
+
+def test_submission_sent_to_another_process_is_rejected(db, challenge, hill):
+    submission = robo_adam.make_submission(challenge, "Runner", "runner@example.com", hill, 2, 100, key="double-click")
+    db.insert_submitted_data(dict(submission))
+
+    assert not db.insert_submitted_data(dict(submission))
+    assert db.insert_submissions_bulk([dict(submission)])['errors'][0]['code'] == robo_adam.DUPLICATE_KEY_ERROR
+    assert total_repetitions(db) == 2
+
+
+def test_write_retried_after_its_rollups_failed_is_rolled_up_once(monkeypatch, db, challenge, hill):
+    update_rollups = db.update_rollups
+    failures = [AutoReconnect("connection lost")]
+
+    def update_rollups_failing_once(submissions):
+        if failures:
+            raise failures.pop()
+        update_rollups(submissions)
+
+    monkeypatch.setattr(db, "update_rollups", update_rollups_failing_once)
+    submissions = make_submissions(challenge, hill, 2)
+
+    try:
+        db.insert_submissions_bulk([dict(submission) for submission in submissions])
+    except AutoReconnect:
+        pass
+    assert total_repetitions(db) == 0
+
+    result = db.insert_submissions_bulk([dict(submission) for submission in submissions])
+    assert [error['code'] for error in result['errors']] == [robo_adam.DUPLICATE_KEY_ERROR] * 2
+    assert total_repetitions(db) == 1 + 2
+
+    db.insert_submissions_bulk([dict(submission) for submission in submissions])
+    assert total_repetitions(db) == 1 + 2
+    assert db.collection_test.count_documents({'rolled_up': False}) == 0